@@ -0,0 +1,612 @@
+"""Offline benchmark for the Zapata handlers against a simulated Bot API.
+
+Runs synthetic workloads through the real application (handlers, update
+processor, outbound scheduler, state) with the HTTP layer replaced by
+FakeBotAPI, which answers every Bot API method locally and can inject
+latency, server errors and 429 RetryAfter responses.
+
+    python bench.py                              # all scenarios, defaults
+    python bench.py --users 5000 --latency-ms 20
+    python bench.py --json out.json              # save results
+    python bench.py --baseline out.json          # exit 1 on regression (CI)
+
+Workloads are generated from --seed, so two runs on the same machine push
+identical traffic. Telegram's own limits (per-user tiers, the global limit
+and the outbound send rates) are lifted by default so the numbers show the
+bot's overhead rather than configured throttling; --production-limits keeps
+them, which only makes sense for small workloads.
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+from typing import Any, Dict, List, Optional, Tuple
+
+from telegram import Update
+from telegram.request import BaseRequest, RequestData
+
+import zapata
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Zapata", "username": "zapata_bot"}
+ADMIN_IDS = [900_001, 900_002, 900_003, 900_004, 900_005]
+FIRST_USER_ID = 100_000
+
+
+class FakeBotAPI(BaseRequest):
+    """BaseRequest that answers Bot API calls locally.
+
+    Every call sleeps for ``latency_ms`` plus up to ``jitter_ms``. A fraction
+    ``error_rate`` of calls fails with HTTP 500, and ``retry_after_rate``
+    fails with 429 asking to retry after ``retry_after_seconds``.
+    """
+
+    def __init__(
+        self,
+        latency_ms: float = 5.0,
+        jitter_ms: float = 5.0,
+        error_rate: float = 0.0,
+        retry_after_rate: float = 0.0,
+        retry_after_seconds: int = 1,
+        seed: int = 0,
+    ) -> None:
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.retry_after_rate = retry_after_rate
+        self.retry_after_seconds = retry_after_seconds
+        self._random = random.Random(seed)
+        self._message_ids = itertools.count(1_000_000)
+        self.calls: Counter = Counter()
+        self.injected: Counter = Counter()
+        # Group messages that carry the Block button, i.e. the ones admins reply to
+        self.info_message_ids: List[int] = []
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    @property
+    def read_timeout(self) -> Optional[float]:
+        return 5.0
+
+    def reset(self) -> None:
+        self.calls.clear()
+        self.injected.clear()
+        self.info_message_ids.clear()
+
+    async def do_request(
+        self,
+        url: str,
+        method: str,
+        request_data: Optional[RequestData] = None,
+        read_timeout: Any = None,
+        write_timeout: Any = None,
+        connect_timeout: Any = None,
+        pool_timeout: Any = None,
+    ) -> Tuple[int, bytes]:
+        endpoint = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data else {}
+        self.calls[endpoint] += 1
+
+        delay = self.latency_ms + self._random.uniform(0, self.jitter_ms)
+        if delay > 0:
+            await asyncio.sleep(delay / 1000)
+
+        roll = self._random.random()
+        if roll < self.retry_after_rate:
+            self.injected["retry_after"] += 1
+            return 429, self._error(
+                429,
+                f"Too Many Requests: retry after {self.retry_after_seconds}",
+                parameters={"retry_after": self.retry_after_seconds},
+            )
+        if roll < self.retry_after_rate + self.error_rate:
+            self.injected["server_error"] += 1
+            return 500, self._error(500, "Internal Server Error")
+
+        result = self._result(endpoint, params)
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+    @staticmethod
+    def _error(code: int, description: str, **extra: Any) -> bytes:
+        body = {"ok": False, "error_code": code, "description": description}
+        body.update(extra)
+        return json.dumps(body).encode()
+
+    def _message(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        chat_id = int(params.get("chat_id", 0))
+        is_group = chat_id in zapata.support_groups()
+        chat_type = "supergroup" if is_group else "private"
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": chat_type},
+            "from": BOT_USER,
+        }
+        if "text" in params:
+            message["text"] = params["text"]
+        if is_group and "reply_markup" in params:
+            self.info_message_ids.append(message["message_id"])
+        return message
+
+    def _result(self, endpoint: str, params: Dict[str, Any]) -> Any:
+        if endpoint == "getMe":
+            return BOT_USER
+        if endpoint == "copyMessage":
+            return {"message_id": self._message(params)["message_id"]}
+        if endpoint == "sendMediaGroup":
+            return [self._message(params) for _ in params.get("media", [None])]
+        if endpoint.startswith("send") and endpoint != "sendChatAction":
+            return self._message(params)
+        if endpoint == "createForumTopic":
+            return {
+                "message_thread_id": next(self._message_ids),
+                "name": params.get("name", ""),
+                "icon_color": 0x6FB9F0,
+            }
+        if endpoint == "getChatAdministrators":
+            return [admin_member(user_id) for user_id in ADMIN_IDS]
+        if endpoint == "getChatMember":
+            user_id = int(params.get("user_id", 0))
+            if user_id in ADMIN_IDS:
+                return admin_member(user_id)
+            return {"status": "member", "user": user_json(user_id)}
+        return True
+
+
+def user_json(user_id: int) -> Dict[str, Any]:
+    return {"id": user_id, "is_bot": False, "first_name": f"User {user_id}"}
+
+
+def admin_member(user_id: int) -> Dict[str, Any]:
+    rights = (
+        "can_be_edited can_manage_chat can_delete_messages can_manage_video_chats "
+        "can_restrict_members can_promote_members can_change_info can_invite_users "
+        "can_post_stories can_edit_stories can_delete_stories"
+    )
+    member = {"status": "administrator", "user": user_json(user_id), "is_anonymous": False}
+    member.update({right: True for right in rights.split()})
+    return member
+
+
+class UpdateFactory:
+    """Builds raw update dicts; ids are sequential so workloads are repeatable."""
+
+    def __init__(self, seed: int) -> None:
+        self.random = random.Random(seed)
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._file_ids = itertools.count(1)
+        self._media_groups = itertools.count(1)
+
+    def _file(self) -> Dict[str, Any]:
+        n = next(self._file_ids)
+        return {"file_id": f"file-{n}", "file_unique_id": f"unique-{n}"}
+
+    def _photo(self) -> List[Dict[str, Any]]:
+        return [dict(self._file(), width=1280, height=720, file_size=120_000)]
+
+    def _message(self, chat: Dict[str, Any], user_id: int, **content: Any) -> Dict:
+        return {
+            "update_id": next(self._update_ids),
+            "message": dict(
+                message_id=next(self._message_ids),
+                date=int(time.time()),
+                chat=chat,
+                **{"from": user_json(user_id)},
+                **content,
+            ),
+        }
+
+    def private(self, user_id: int, **content: Any) -> Dict[str, Any]:
+        chat = {"id": user_id, "type": "private", "first_name": f"User {user_id}"}
+        return self._message(chat, user_id, **content)
+
+    def text(self, user_id: int) -> Dict[str, Any]:
+        words = self.random.randint(3, 60)
+        return self.private(user_id, text=" ".join(["lorem"] * words))
+
+    def photo(self, user_id: int) -> Dict[str, Any]:
+        return self.private(user_id, photo=self._photo(), caption="screenshot")
+
+    def document(self, user_id: int) -> Dict[str, Any]:
+        document = dict(self._file(), file_name="log.txt", mime_type="text/plain")
+        return self.private(user_id, document=document)
+
+    def album(self, user_id: int, size: int) -> List[Dict[str, Any]]:
+        group = f"album-{next(self._media_groups)}"
+        return [
+            self.private(user_id, photo=self._photo(), media_group_id=group)
+            for _ in range(size)
+        ]
+
+    def group_reply(self, admin_id: int, reply_to: int, photo: bool) -> Dict:
+        group = {"id": zapata.GROUP_CHAT_ID, "type": "supergroup", "title": "Support"}
+        reply_to_message = {
+            "message_id": reply_to,
+            "date": int(time.time()),
+            "chat": group,
+            "from": BOT_USER,
+            "text": "info",
+        }
+        content: Dict[str, Any] = {"reply_to_message": reply_to_message}
+        if photo:
+            content.update(photo=self._photo(), caption="see attached")
+        else:
+            content["text"] = "Thanks, we are looking into it."
+        return self._message(group, admin_id, **content)
+
+    def callback(self, admin_id: int, data: str, message_id: int) -> Dict:
+        group = {"id": zapata.GROUP_CHAT_ID, "type": "supergroup", "title": "Support"}
+        return {
+            "update_id": next(self._update_ids),
+            "callback_query": {
+                "id": f"cq-{next(self._update_ids)}",
+                "from": user_json(admin_id),
+                "chat_instance": "bench",
+                "data": data,
+                "message": {
+                    "message_id": message_id,
+                    "date": int(time.time()),
+                    "chat": group,
+                    "from": BOT_USER,
+                    "text": "info",
+                },
+            },
+        }
+
+
+class ErrorCounter(logging.Handler):
+    """Counts errors the handlers log (they catch their own exceptions)."""
+
+    def __init__(self) -> None:
+        super().__init__(logging.ERROR)
+        self.count = 0
+
+    def emit(self, record: logging.LogRecord) -> None:
+        self.count += 1
+
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(math.ceil(pct / 100 * len(ordered)) - 1, 0)
+    return ordered[index]
+
+
+class Bench:
+    """Runs one scenario on a freshly built application."""
+
+    def __init__(self, args: argparse.Namespace, api: FakeBotAPI) -> None:
+        self.args = args
+        self.api = api
+        self.factory = UpdateFactory(args.seed)
+        self.application = zapata.build_application(api)
+        self.handler_latencies: List[float] = []
+        self.e2e_latencies: List[float] = []
+
+    async def __aenter__(self) -> "Bench":
+        await self.application.initialize()
+        await zapata.post_init(self.application)
+        return self
+
+    async def __aexit__(self, *exc_info: Any) -> None:
+        await zapata.post_stop(self.application)
+        await self.application.shutdown()
+        await zapata.post_shutdown(self.application)
+
+    async def _process(self, data: Dict[str, Any], measure: bool) -> None:
+        application = self.application
+        update = Update.de_json(data, application.bot)
+        submitted = time.perf_counter()
+
+        async def timed() -> None:
+            started = time.perf_counter()
+            await application.process_update(update)
+            if measure:
+                self.handler_latencies.append(time.perf_counter() - started)
+
+        await application.update_processor.process_update(update, timed())
+        if measure:
+            self.e2e_latencies.append(time.perf_counter() - submitted)
+
+    async def run(self, updates: List[Dict[str, Any]], measure: bool = True) -> None:
+        """Submit every update at once (or at --arrival-rate) and drain."""
+        tasks = []
+        interval = 1 / self.args.arrival_rate if self.args.arrival_rate else 0
+        for data in updates:
+            tasks.append(asyncio.create_task(self._process(data, measure)))
+            if interval:
+                await asyncio.sleep(interval)
+            else:
+                await asyncio.sleep(0)
+        await asyncio.gather(*tasks)
+        await self.drain()
+
+    async def drain(self) -> None:
+        """Wait for batches still being collected and queued outbound sends."""
+        for name in ("text_batcher", "album_batcher"):
+            await self.application.bot_data[name].flush_all()
+        scheduler = self.application.bot.rate_limiter.limiter
+        while scheduler.queue_depth:
+            await asyncio.sleep(0.01)
+
+
+def users(args: argparse.Namespace) -> range:
+    return range(FIRST_USER_ID, FIRST_USER_ID + args.users)
+
+
+def interleave(per_user: List[List[Dict[str, Any]]]) -> List[Dict[str, Any]]:
+    """Round-robin the users' messages, as concurrent senders would arrive."""
+    return [
+        update
+        for batch in itertools.zip_longest(*per_user)
+        for update in batch
+        if update is not None
+    ]
+
+
+async def seed_info_messages(bench: Bench) -> List[int]:
+    """Relay one message per user (unmeasured) and return the info message ids."""
+    await bench.run([bench.factory.text(user_id) for user_id in users(bench.args)], False)
+    info_message_ids = list(bench.api.info_message_ids)
+    bench.api.reset()
+    return info_message_ids
+
+
+async def scenario_private_text(bench: Bench) -> int:
+    factory, args = bench.factory, bench.args
+    updates = interleave(
+        [[factory.text(user_id) for _ in range(args.messages)] for user_id in users(args)]
+    )
+    await bench.run(updates)
+    return len(updates)
+
+
+async def scenario_media(bench: Bench) -> int:
+    factory, args = bench.factory, bench.args
+    per_user = []
+    for user_id in users(args):
+        updates = [factory.photo(user_id), factory.document(user_id)]
+        updates += factory.album(user_id, factory.random.randint(2, 5))
+        per_user.append(updates)
+    updates = interleave(per_user)
+    await bench.run(updates)
+    return len(updates)
+
+
+async def scenario_admin_replies(bench: Bench) -> int:
+    factory = bench.factory
+    info_message_ids = await seed_info_messages(bench)
+    updates = [
+        factory.group_reply(ADMIN_IDS[i % len(ADMIN_IDS)], message_id, i % 4 == 0)
+        for i, message_id in enumerate(info_message_ids)
+    ]
+    await bench.run(updates)
+    return len(updates)
+
+
+async def scenario_block_callbacks(bench: Bench) -> int:
+    factory = bench.factory
+    info_message_ids = await seed_info_messages(bench)
+    # Each target is blocked and then unblocked by the same admin, so the
+    # per-user update ordering keeps the pair in sequence.
+    targets = list(zip(users(bench.args), info_message_ids))
+    updates = [
+        factory.callback(ADMIN_IDS[i % len(ADMIN_IDS)], f"{action}:{user_id}", message_id)
+        for action in ("block", "unblock")
+        for i, (user_id, message_id) in enumerate(targets)
+    ]
+    await bench.run(updates)
+    return len(updates)
+
+
+SCENARIOS = {
+    "private_text": scenario_private_text,
+    "media": scenario_media,
+    "admin_replies": scenario_admin_replies,
+    "block_callbacks": scenario_block_callbacks,
+}
+
+
+def configure(args: argparse.Namespace, state_dir: str) -> None:
+    """Point zapata's module settings at the benchmark environment."""
+    zapata.TOKEN = "123456:bench"
+    zapata.STATE_BACKEND = args.state
+    zapata.STATE_DB_PATH = os.path.join(state_dir, "bench.sqlite3")
+    zapata.ARCHIVE_DB_PATH = os.path.join(state_dir, "bench-archive.sqlite3")
+    zapata.FORWARDING_MODE = args.mode
+    zapata.CONCURRENT_UPDATES = args.concurrency
+    zapata.METRICS_PORT = None
+    zapata.CAPTURE_PATH = ""
+    if not args.production_limits:
+        lift_limits()
+
+
+def lift_limits() -> None:
+    """Turn off the inbound, outbound and load-shedding limits."""
+    unlimited = 1_000_000_000
+    zapata.RATE_LIMIT_TIERS = {tier: (unlimited, 1) for tier in zapata.RATE_LIMIT_TIERS}
+    zapata.GLOBAL_RATE_LIMIT_MAX_MESSAGES = unlimited
+    zapata.OUTBOUND_GLOBAL_RATE = zapata.OUTBOUND_GLOBAL_BURST = unlimited
+    zapata.OUTBOUND_PRIVATE_CHAT_RATE = zapata.OUTBOUND_PRIVATE_CHAT_BURST = unlimited
+    zapata.OUTBOUND_GROUP_CHAT_RATE = zapata.OUTBOUND_GROUP_CHAT_BURST = unlimited
+    zapata.LOAD_MAX_IN_FLIGHT_FORWARDS = zapata.LOAD_MAX_QUEUE_DEPTH = unlimited
+
+
+async def run_scenario(name: str, args: argparse.Namespace) -> Dict[str, Any]:
+    api = FakeBotAPI(
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        error_rate=args.error_rate,
+        retry_after_rate=args.retry_after_rate,
+        retry_after_seconds=args.retry_after_seconds,
+        seed=args.seed,
+    )
+    errors = ErrorCounter()
+    zapata.logger.addHandler(errors)
+    # Count handler errors without printing a traceback for each one
+    zapata.logger.setLevel(logging.ERROR)
+    zapata.logger.propagate = False
+    try:
+        with tempfile.TemporaryDirectory() as state_dir:
+            configure(args, state_dir)
+            bench = Bench(args, api)
+            async with bench:
+                api.reset()
+                if args.memory:
+                    tracemalloc.start()
+                started = time.perf_counter()
+                count = await SCENARIOS[name](bench)
+                elapsed = time.perf_counter() - started
+                peak = None
+                if args.memory:
+                    _, peak = tracemalloc.get_traced_memory()
+                    tracemalloc.stop()
+                retries = bench.application.bot.rate_limiter.limiter.retries
+    finally:
+        zapata.logger.removeHandler(errors)
+
+    handler = bench.handler_latencies
+    e2e = bench.e2e_latencies
+    api_calls = sum(api.calls.values())
+    return {
+        "updates": count,
+        "seconds": round(elapsed, 3),
+        "updates_per_second": round(len(handler) / elapsed, 1) if elapsed else 0.0,
+        "handler_ms": {
+            f"p{pct}": round(percentile(handler, pct) * 1000, 2) for pct in (50, 95, 99)
+        },
+        "e2e_ms": {f"p{pct}": round(percentile(e2e, pct) * 1000, 2) for pct in (50, 95, 99)},
+        "api_calls": api_calls,
+        "api_calls_per_update": round(api_calls / count, 3) if count else 0.0,
+        "api_calls_by_method": dict(api.calls.most_common()),
+        "injected_failures": dict(api.injected),
+        "scheduler_retries": retries,
+        "logged_errors": errors.count,
+        "peak_memory_mib": None if peak is None else round(peak / 2**20, 2),
+    }
+
+
+def print_report(results: Dict[str, Dict[str, Any]]) -> None:
+    header = (
+        f"{'scenario':<16} {'updates':>8} {'upd/s':>9} {'p50 ms':>8} {'p95 ms':>8} "
+        f"{'p99 ms':>8} {'calls/upd':>9} {'errors':>6} {'peak MiB':>9}"
+    )
+    print(header)
+    print("-" * len(header))
+    for name, result in results.items():
+        latency = result["handler_ms"]
+        print(
+            f"{name:<16} {result['updates']:>8} {result['updates_per_second']:>9} "
+            f"{latency['p50']:>8} {latency['p95']:>8} {latency['p99']:>8} "
+            f"{result['api_calls_per_update']:>9} {result['logged_errors']:>6} "
+            f"{result['peak_memory_mib'] or '-':>9}"
+        )
+
+
+def compare(
+    results: Dict[str, Dict[str, Any]], baseline: Dict[str, Any], tolerance: float
+) -> List[str]:
+    """Return one line per metric that regressed beyond ``tolerance``."""
+    regressions = []
+    for name, result in results.items():
+        before = baseline.get("results", {}).get(name)
+        if not before:
+            continue
+        checks = [
+            ("p95 handler ms", result["handler_ms"]["p95"], before["handler_ms"]["p95"], 1),
+            ("updates/s", result["updates_per_second"], before["updates_per_second"], -1),
+            ("API calls/update", result["api_calls_per_update"], before["api_calls_per_update"], 1),
+            ("peak MiB", result["peak_memory_mib"], before["peak_memory_mib"], 1),
+        ]
+        for label, now, then, direction in checks:
+            if then and now is not None and (now - then) * direction > then * tolerance:
+                regressions.append(f"{name}: {label} {then} -> {now}")
+    return regressions
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "scenarios", nargs="*", metavar="scenario",
+        help=f"scenarios to run (default: all of {', '.join(SCENARIOS)})",
+    )
+    parser.add_argument("--users", type=int, default=1000, help="simulated users")
+    parser.add_argument(
+        "--messages", type=int, default=3, help="texts per user in private_text"
+    )
+    parser.add_argument("--latency-ms", type=float, default=5.0)
+    parser.add_argument("--jitter-ms", type=float, default=5.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--retry-after-rate", type=float, default=0.0)
+    parser.add_argument("--retry-after-seconds", type=int, default=1)
+    parser.add_argument(
+        "--arrival-rate", type=float, default=0.0,
+        help="updates per second to submit (default: all at once)",
+    )
+    parser.add_argument("--concurrency", type=int, default=zapata.CONCURRENT_UPDATES)
+    parser.add_argument("--mode", choices=("classic", "compact"), default="classic")
+    parser.add_argument("--state", choices=("memory", "sqlite", "sqlite-shared"), default="memory")
+    parser.add_argument("--production-limits", action="store_true")
+    parser.add_argument(
+        "--no-memory", dest="memory", action="store_false",
+        help="skip tracemalloc, which slows handlers down noticeably",
+    )
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", metavar="PATH", help="write results as JSON")
+    parser.add_argument("--baseline", metavar="PATH", help="fail on regression vs this JSON")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    args = parser.parse_args(argv)
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenario(s): {', '.join(sorted(unknown))}")
+    return args
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.CRITICAL)
+    results = {}
+    for name in args.scenarios or SCENARIOS:
+        results[name] = asyncio.run(run_scenario(name, args))
+    print_report(results)
+
+    config = {
+        key: value
+        for key, value in vars(args).items()
+        if key not in ("scenarios", "json", "baseline", "tolerance")
+    }
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as fh:
+            json.dump({"config": config, "results": results}, fh, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as fh:
+            baseline = json.load(fh)
+        if baseline.get("config") != config:
+            print("warning: baseline was recorded with different settings", file=sys.stderr)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print("Regressions:", *regressions, sep="\n  ", file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
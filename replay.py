@@ -0,0 +1,489 @@
+"""Replay a traffic capture through the Zapata handlers against a fake Bot API.
+
+Feeds the updates recorded with zapata.CAPTURE_PATH through the application
+that zapata.build_application builds for main() (same handlers, update
+processor, outbound scheduler and state), with the HTTP layer replaced by
+bench.FakeBotAPI. Updates arrive with their recorded spacing divided by
+--speed, so a spike or a spam raid keeps its shape.
+
+    python replay.py zapata.capture                  # 1x, real time
+    python replay.py zapata.capture.2.gz zapata.capture.1.gz zapata.capture --speed 10
+    python replay.py zapata.capture --speed 0        # as fast as possible
+    python replay.py zapata.capture --json build-a.json
+    python replay.py zapata.capture --baseline build-a.json   # exit 1 on divergence
+
+Rotated files are read oldest first in the order given; .gz files are
+decompressed on the fly. The report shows each handler's runs, latency and
+Bot API calls, and the calls per method next to the capture's.
+
+Outbound calls are compared per update, as counts of (method, chat). The
+comparison is made against the calls in the capture and, with --baseline,
+against a --json report from another build. Chat actions and admin lookups
+depend on timing and caches, so they are counted but not compared.
+
+Group ids and the forwarding and threading modes are taken from the
+capture. Rate limits stay as configured unless --no-limits is given.
+Admin lookups get the answers recorded in the capture.
+
+The fake API numbers the bot's messages (and topics) differently from
+Telegram. Each id the bot got in production is therefore paired with the id
+it gets in the replay, from the same call of the same handler run. Updates
+that point at one of the bot's messages, such as a reply to an info
+message, are rewritten to the replay id. If that message hasn't been sent
+yet, the update is held back, for up to --causal-wait seconds.
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import gzip
+import itertools
+import json
+import logging
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+
+import bench
+import zapata
+
+# Calls whose number depends on timing or cache state rather than on the build
+UNCOMPARED_METHODS = {"sendChatAction", "getChatMember", "getChatAdministrators", "getMe"}
+# Calls answered from the capture, keyed by (method, chat_id, user_id)
+RECORDED_METHODS = ("getChatMember", "getChatAdministrators")
+
+
+def read_capture(paths: List[str]) -> Iterator[Dict[str, Any]]:
+    for path in paths:
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, "rt", encoding="utf-8") as fh:
+            for line in fh:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def run_key(handler: Optional[str], update_id: Optional[int]) -> str:
+    """Which handler run a call belongs to, comparable across builds."""
+    if update_id is None:
+        return handler or "background"
+    return f"{handler}:{update_id}"
+
+
+def call_signature(endpoint: str, data: Dict[str, Any]) -> str:
+    return f"{endpoint} {data.get('chat_id', '-')}"
+
+
+def answer_key(endpoint: str, data: Dict[str, Any]) -> Tuple[str, int, int]:
+    return endpoint, int(data.get("chat_id") or 0), int(data.get("user_id") or 0)
+
+
+def sent_ids(result: Any) -> List[int]:
+    """Ids of the messages (or the topic) a call's result created."""
+    if isinstance(result, list):
+        return [
+            item["message_id"]
+            for item in result
+            if isinstance(item, dict) and "message_id" in item
+        ]
+    if isinstance(result, dict):
+        for field in ("message_id", "message_thread_id"):
+            if field in result:
+                return [result[field]]
+    return []
+
+
+def message_objects(data: Any) -> Iterator[Dict[str, Any]]:
+    """Every message nested in raw update data (replied-to ones included)."""
+    if isinstance(data, dict):
+        if "message_id" in data and isinstance(data.get("chat"), dict):
+            yield data
+        for value in data.values():
+            yield from message_objects(value)
+    elif isinstance(data, list):
+        for value in data:
+            yield from message_objects(value)
+
+
+class Capture:
+    """What a first pass over the capture files learns, without keeping updates."""
+
+    def __init__(self, paths: List[str]) -> None:
+        self.paths = paths
+        self.settings: Dict[str, Any] = {}
+        self.updates = 0
+        self.first_at: Optional[float] = None
+        self.last_at: Optional[float] = None
+        self.calls: Counter = Counter()
+        self.errors: Counter = Counter()
+        self.outbound: Dict[str, Counter] = defaultdict(Counter)
+        self.answers: Dict[Tuple[str, int, int], Any] = {}
+        # (run, call signature) -> ids created by each such call, in order
+        self.created: Dict[Tuple[str, str], List[List[int]]] = defaultdict(list)
+        # (chat_id, id) of every message and topic the bot created
+        self.bot_messages: Set[Tuple[int, int]] = set()
+        for record in read_capture(paths):
+            if record["type"] == "start":
+                self.settings = self.settings or record
+            elif record["type"] == "update":
+                self.updates += 1
+                if self.first_at is None:
+                    self.first_at = record["t"]
+                self.last_at = record["t"]
+            elif record["type"] == "call":
+                self.add_call(record)
+
+    def add_call(self, record: Dict[str, Any]) -> None:
+        endpoint, data = record["endpoint"], record["data"]
+        key = run_key(record["handler"], record["update_id"])
+        signature = call_signature(endpoint, data)
+        self.calls[endpoint] += 1
+        if record["error"]:
+            self.errors[record["error"].split(":", 1)[0]] += 1
+        elif endpoint in RECORDED_METHODS:
+            self.answers[answer_key(endpoint, data)] = record["result"]
+        ids = sent_ids(record["result"])
+        self.created[(key, signature)].append(ids)
+        if ids and "chat_id" in data:
+            chat_id = int(data["chat_id"])
+            self.bot_messages.update((chat_id, message_id) for message_id in ids)
+        if endpoint not in UNCOMPARED_METHODS:
+            self.outbound[key][signature] += 1
+
+    @property
+    def span(self) -> float:
+        if self.first_at is None:
+            return 0.0
+        return self.last_at - self.first_at
+
+    def iter_updates(self) -> Iterator[Tuple[float, Dict[str, Any]]]:
+        for record in read_capture(self.paths):
+            if record["type"] == "update":
+                yield record["t"], record["update"]
+
+
+class ReplayBotAPI(bench.FakeBotAPI):
+    """FakeBotAPI that answers admin lookups as production did."""
+
+    def __init__(self, answers: Dict[Tuple[str, int, int], Any], **kwargs: Any) -> None:
+        super().__init__(**kwargs)
+        self.answers = answers
+        # Far above real message ids, so the two can't be confused
+        self._message_ids = itertools.count(1 << 40)
+
+    def _result(self, endpoint: str, params: Dict[str, Any]) -> Any:
+        key = answer_key(endpoint, params)
+        if key in self.answers:
+            return self.answers[key]
+        return super()._result(endpoint, params)
+
+
+class Replay(bench.Bench):
+    """Feeds captured updates in on their recorded schedule."""
+
+    def __init__(
+        self, args: argparse.Namespace, api: bench.FakeBotAPI, capture: Capture
+    ) -> None:
+        super().__init__(args, api)
+        self.capture = capture
+        self.outbound: Dict[str, Counter] = defaultdict(Counter)
+        self.seen: Counter = Counter()
+        # (chat_id, production id) -> replay id of the bot's messages and topics
+        self.ids: Dict[Tuple[int, int], int] = {}
+        self.new_ids = asyncio.Event()
+        self.held_back = 0
+        self.untranslated = 0
+        self.application.bot_data["api_tracer"].add_hook(self.record_call)
+
+    def record_call(
+        self,
+        endpoint: str,
+        data: Dict[str, Any],
+        result: Any,
+        error: Optional[BaseException],
+        seconds: float,
+    ) -> None:
+        account = zapata.CURRENT_API_ACCOUNT.get()
+        key = run_key(
+            account.handler if account else None, account.update_id if account else None
+        )
+        signature = call_signature(endpoint, data)
+        index = self.seen[(key, signature)]
+        self.seen[(key, signature)] += 1
+        recorded = self.capture.created.get((key, signature), [])
+        ids = sent_ids(result)
+        if index < len(recorded) and ids and "chat_id" in data:
+            chat_id = int(data["chat_id"])
+            for production_id, replay_id in zip(recorded[index], ids):
+                self.ids[(chat_id, production_id)] = replay_id
+            self.new_ids.set()
+        if endpoint not in UNCOMPARED_METHODS:
+            self.outbound[key][signature] += 1
+
+    def references(self, data: Dict[str, Any]) -> List[Tuple[int, int]]:
+        """The bot's messages and topics an update points at."""
+        refs = []
+        for message in message_objects(data):
+            chat_id = message["chat"]["id"]
+            for field in ("message_id", "message_thread_id"):
+                ref = (chat_id, message.get(field))
+                if ref in self.capture.bot_messages:
+                    refs.append(ref)
+        return refs
+
+    async def translate(self, data: Dict[str, Any], timeout: float) -> None:
+        """Rewrite production ids to replay ids, waiting for unsent messages."""
+        missing = [ref for ref in self.references(data) if ref not in self.ids]
+        if missing:
+            self.held_back += 1
+            deadline = time.perf_counter() + timeout
+            while missing and time.perf_counter() < deadline:
+                self.new_ids.clear()
+                try:
+                    await asyncio.wait_for(
+                        self.new_ids.wait(), deadline - time.perf_counter()
+                    )
+                except asyncio.TimeoutError:
+                    pass
+                missing = [ref for ref in missing if ref not in self.ids]
+            self.untranslated += bool(missing)
+        for message in message_objects(data):
+            chat_id = message["chat"]["id"]
+            for field in ("message_id", "message_thread_id"):
+                if (chat_id, message.get(field)) in self.ids:
+                    message[field] = self.ids[(chat_id, message[field])]
+
+    async def replay(
+        self,
+        updates: Iterator[Tuple[float, Dict[str, Any]]],
+        speed: float,
+        causal_wait: float,
+    ) -> int:
+        """Submit each update at its (scaled) offset from the first; drain."""
+        tasks = set()
+        started = time.perf_counter()
+        first_at = None
+        count = 0
+        for at, data in updates:
+            if first_at is None:
+                first_at = at
+            delay = (at - first_at) / speed - (time.perf_counter() - started) if speed else 0
+            await asyncio.sleep(max(delay, 0))
+            await self.translate(data, causal_wait)
+            task = asyncio.create_task(self._process(data, True))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            count += 1
+        if tasks:
+            await asyncio.gather(*tasks)
+        await self.drain()
+        return count
+
+
+def configure(args: argparse.Namespace, capture: Capture, state_dir: str) -> None:
+    """Point zapata at the replay environment and the capture's settings."""
+    zapata.TOKEN = "123456:replay"
+    zapata.STATE_BACKEND = args.state
+    zapata.STATE_DB_PATH = f"{state_dir}/replay.sqlite3"
+    zapata.ARCHIVE_DB_PATH = f"{state_dir}/replay-archive.sqlite3"
+    zapata.CONCURRENT_UPDATES = args.concurrency
+    zapata.METRICS_PORT = None
+    zapata.CAPTURE_PATH = ""
+    groups = capture.settings.get("support_groups")
+    if groups:
+        zapata.GROUP_CHAT_ID = groups[0]
+        zapata.SUPPORT_GROUP_IDS = tuple(groups) if len(groups) > 1 else ()
+    zapata.FORWARDING_MODE = capture.settings.get("forwarding_mode", zapata.FORWARDING_MODE)
+    zapata.THREADING_MODE = capture.settings.get("threading_mode", zapata.THREADING_MODE)
+    if args.no_limits:
+        bench.lift_limits()
+
+
+def divergence(
+    ours: Dict[str, Counter], theirs: Dict[str, Counter]
+) -> Dict[str, Dict[str, int]]:
+    """Per handler run, the calls we made more (+) or fewer (-) times."""
+    diverged = {}
+    for key in sorted(set(ours) | set(theirs)):
+        delta = Counter(ours.get(key, {}))
+        delta.subtract(theirs.get(key, {}))
+        changed = {signature: count for signature, count in delta.items() if count}
+        if changed:
+            diverged[key] = changed
+    return diverged
+
+
+async def run_replay(args: argparse.Namespace, capture: Capture) -> Dict[str, Any]:
+    api = ReplayBotAPI(
+        capture.answers,
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        error_rate=args.error_rate,
+        retry_after_rate=args.retry_after_rate,
+        retry_after_seconds=args.retry_after_seconds,
+        seed=args.seed,
+    )
+    errors = bench.ErrorCounter()
+    zapata.logger.addHandler(errors)
+    zapata.logger.setLevel(logging.ERROR)
+    zapata.logger.propagate = False
+    try:
+        with tempfile.TemporaryDirectory() as state_dir:
+            configure(args, capture, state_dir)
+            replay = Replay(args, api, capture)
+            async with replay:
+                api.reset()
+                started = time.perf_counter()
+                count = await replay.replay(
+                    capture.iter_updates(), args.speed, args.causal_wait
+                )
+                elapsed = time.perf_counter() - started
+                metrics: zapata.Metrics = replay.application.bot_data["metrics"]
+                retries = replay.application.bot.rate_limiter.limiter.retries
+    finally:
+        zapata.logger.removeHandler(errors)
+
+    handler_calls: Counter = Counter()
+    for labels, value in metrics.counters("zapata_handler_api_calls_total"):
+        handler_calls[labels["handler"]] += value
+    handlers = {
+        labels["handler"]: {
+            "runs": runs,
+            "mean_ms": round(mean * 1000, 2),
+            "p95_ms": round(p95 * 1000, 2),
+            "api_calls": int(handler_calls[labels["handler"]]),
+        }
+        for labels, runs, mean, p95 in metrics.summaries("zapata_handler_seconds")
+    }
+    e2e = replay.e2e_latencies
+    return {
+        "updates": count,
+        "seconds": round(elapsed, 3),
+        "updates_per_second": round(count / elapsed, 1) if elapsed else 0.0,
+        "e2e_ms": {
+            f"p{pct}": round(bench.percentile(e2e, pct) * 1000, 2) for pct in (50, 95, 99)
+        },
+        "handlers": handlers,
+        "api_calls_by_method": dict(api.calls.most_common()),
+        "injected_failures": dict(api.injected),
+        "scheduler_retries": retries,
+        "logged_errors": errors.count,
+        "held_back": replay.held_back,
+        "untranslated": replay.untranslated,
+        "outbound": {key: dict(calls) for key, calls in replay.outbound.items()},
+    }
+
+
+def print_divergence(title: str, diverged: Dict[str, Dict[str, int]], limit: int) -> None:
+    print(f"\n{title}: {len(diverged)} handler run(s) differ")
+    for key, changed in list(diverged.items())[:limit]:
+        calls = ", ".join(f"{signature} {count:+d}" for signature, count in changed.items())
+        print(f"  {key}: {calls}")
+    if len(diverged) > limit:
+        print(f"  ... and {len(diverged) - limit} more")
+
+
+def print_report(
+    result: Dict[str, Any], capture: Capture, args: argparse.Namespace
+) -> None:
+    speed = f"{args.speed:g}x" if args.speed else "full speed"
+    print(
+        f"Replayed {result['updates']} updates ({capture.span:.1f}s of traffic) "
+        f"in {result['seconds']}s at {speed}: {result['updates_per_second']} upd/s, "
+        f"e2e p50/p95/p99 {result['e2e_ms']['p50']}/{result['e2e_ms']['p95']}/"
+        f"{result['e2e_ms']['p99']} ms, {result['scheduler_retries']} retries, "
+        f"{result['logged_errors']} logged errors"
+    )
+    print(
+        f"{result['held_back']} updates held back for a message they point at, "
+        f"{result['untranslated']} gave up waiting\n"
+    )
+    header = f"{'handler':<30} {'runs':>7} {'mean ms':>9} {'p95 ms':>9} {'API calls':>10}"
+    print(header)
+    print("-" * len(header))
+    for name, row in result["handlers"].items():
+        print(
+            f"{name:<30} {row['runs']:>7} {row['mean_ms']:>9} {row['p95_ms']:>9} "
+            f"{row['api_calls']:>10}"
+        )
+
+    print(f"\n{'Bot API method':<30} {'replay':>9} {'capture':>9}")
+    calls = result["api_calls_by_method"]
+    for method in sorted(set(calls) | set(capture.calls), key=lambda m: -calls.get(m, 0)):
+        print(f"{method:<30} {calls.get(method, 0):>9} {capture.calls.get(method, 0):>9}")
+    if capture.errors:
+        errors = ", ".join(f"{name} {count}" for name, count in capture.errors.most_common())
+        print(f"\nErrors in the capture: {errors}")
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("captures", nargs="+", metavar="capture", help="capture files, oldest first")
+    parser.add_argument(
+        "--speed", type=float, default=1.0,
+        help="time compression, e.g. 10 for 10x (0: no pauses at all)",
+    )
+    parser.add_argument("--latency-ms", type=float, default=5.0)
+    parser.add_argument("--jitter-ms", type=float, default=5.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--retry-after-rate", type=float, default=0.0)
+    parser.add_argument("--retry-after-seconds", type=int, default=1)
+    parser.add_argument("--concurrency", type=int, default=zapata.CONCURRENT_UPDATES)
+    parser.add_argument("--state", choices=("memory", "sqlite", "sqlite-shared"), default="memory")
+    parser.add_argument(
+        "--no-limits", action="store_true",
+        help="lift rate limits and load shedding to see the bot's own ceiling",
+    )
+    parser.add_argument(
+        "--causal-wait", type=float, default=5.0,
+        help="seconds an update may wait for a bot message it points at",
+    )
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--show", type=int, default=10, help="diverging runs to list")
+    parser.add_argument("--json", metavar="PATH", help="write the report as JSON")
+    parser.add_argument(
+        "--baseline", metavar="PATH", help="fail if outbound calls differ from this report"
+    )
+    args = parser.parse_args(argv)
+    if args.speed < 0:
+        parser.error("--speed must not be negative")
+    return args
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.CRITICAL)
+    capture = Capture(args.captures)
+    result = asyncio.run(run_replay(args, capture))
+    print_report(result, capture, args)
+    print_divergence(
+        "Outbound calls vs capture",
+        divergence(result["outbound"], capture.outbound),
+        args.show,
+    )
+
+    config = {
+        key: value
+        for key, value in vars(args).items()
+        if key not in ("json", "baseline", "show")
+    }
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as fh:
+            json.dump({"config": config, "results": result}, fh, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as fh:
+            baseline = json.load(fh)
+        if baseline.get("config") != config:
+            print("warning: baseline was recorded with different settings", file=sys.stderr)
+        diverged = divergence(result["outbound"], baseline["results"]["outbound"])
+        print_divergence("Outbound calls vs baseline", diverged, args.show)
+        if diverged:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
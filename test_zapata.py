@@ -0,0 +1,371 @@
+"""Unit tests for zapata.py. Run with: python -m pytest -q"""
+
+import asyncio
+import os
+import tempfile
+import time
+import unittest
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from unittest import mock
+
+from telegram import Audio, Chat, Message, PhotoSize, User
+from telegram.error import BadRequest, NetworkError, TimedOut
+
+import zapata
+
+USER_ID = 4242
+
+# Sends and rate limits that never hold a test up
+UNLIMITED = {
+    "OUTBOUND_GLOBAL_RATE": 1e6,
+    "OUTBOUND_GLOBAL_BURST": 1e6,
+    "OUTBOUND_PRIVATE_CHAT_RATE": 1e6,
+    "OUTBOUND_PRIVATE_CHAT_BURST": 1e6,
+    "OUTBOUND_GROUP_CHAT_RATE": 1e6,
+    "OUTBOUND_GROUP_CHAT_BURST": 1e6,
+}
+
+
+class FakeBot:
+    """Records Bot API calls; each returns a message with a fresh id.
+
+    ``failures`` maps a method to exceptions raised by its next calls.
+    """
+
+    defaults = None
+
+    def __init__(self, **failures) -> None:
+        self.calls = []
+        self.failures = {method: list(excs) for method, excs in failures.items()}
+
+    def __getattr__(self, method):
+        async def call(**kwargs):
+            self.calls.append((method, kwargs))
+            if self.failures.get(method):
+                raise self.failures[method].pop(0)
+            return SimpleNamespace(message_id=len(self.calls))
+
+        return call
+
+    def sent(self, chat_id):
+        """Methods called for a chat, chat actions aside."""
+        return [
+            method
+            for method, kwargs in self.calls
+            if kwargs.get("chat_id") == chat_id and method != "send_chat_action"
+        ]
+
+
+def private_message(message_id: int, **content) -> Message:
+    return Message(
+        message_id=message_id,
+        date=datetime.now(timezone.utc),
+        chat=Chat(id=USER_ID, type=Chat.PRIVATE),
+        from_user=User(id=USER_ID, first_name="Ada", is_bot=False),
+        **content,
+    )
+
+
+def photo(message_id: int, **content) -> Message:
+    sizes = (PhotoSize(f"p{message_id}", f"u{message_id}", 90, 90),)
+    return private_message(message_id, photo=sizes, **content)
+
+
+class OutboundSchedulerTest(unittest.TestCase):
+    def setUp(self) -> None:
+        patcher = mock.patch.multiple(zapata, **UNLIMITED)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_lanes_go_out_in_priority_order(self) -> None:
+        sent = []
+
+        async def call(name):
+            sent.append(name)
+            return name
+
+        async def scenario() -> None:
+            scheduler = zapata.OutboundScheduler()
+            await scheduler.initialize()
+            lanes = [
+                ("ack", zapata.PRIORITY_ACK),
+                ("forward", zapata.PRIORITY_FORWARD),
+                ("reply", zapata.PRIORITY_REPLY),
+            ]
+            await asyncio.gather(
+                *(
+                    scheduler.process_request(
+                        call,
+                        (name,),
+                        {},
+                        "sendMessage",
+                        {"chat_id": chat_id},
+                        {"priority": priority},
+                    )
+                    for chat_id, (name, priority) in enumerate(lanes, start=1)
+                )
+            )
+            await scheduler.shutdown()
+
+        asyncio.run(scenario())
+        self.assertEqual(sent, ["reply", "forward", "ack"])
+
+    def test_queued_chat_action_is_dropped_after_a_message(self) -> None:
+        sent = []
+
+        async def call(name):
+            sent.append(name)
+            return True
+
+        async def scenario() -> None:
+            scheduler = zapata.OutboundScheduler()
+            await scheduler.initialize()
+            # chat_id arrives as a string from some callers
+            await asyncio.gather(
+                scheduler.process_request(
+                    call, ("message",), {}, "sendMessage", {"chat_id": "7"}, None
+                ),
+                scheduler.process_request(
+                    call, ("action",), {}, "sendChatAction", {"chat_id": "7"}, None
+                ),
+            )
+            await asyncio.sleep(0.01)
+            self.assertEqual(scheduler.queue_depth, 0)
+            await scheduler.shutdown()
+
+        asyncio.run(scenario())
+        self.assertEqual(sent, ["message"])
+
+
+class AlbumBatchTest(unittest.TestCase):
+    def setUp(self) -> None:
+        patcher = mock.patch.multiple(
+            zapata, FORWARDING_MODE="classic", THREADING_MODE="replies", **UNLIMITED
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.bot = FakeBot()
+        self.context = SimpleNamespace(
+            bot=self.bot, application=SimpleNamespace(bot_data={})
+        )
+
+    def relay(self, messages) -> None:
+        asyncio.run(zapata.relay_private_messages(self.context, messages))
+
+    def test_single_unsupported_album_item_is_refused(self) -> None:
+        audio = Audio("a1", "ua1", duration=3)
+        self.relay([private_message(1, audio=audio, media_group_id="g1")])
+        self.assertEqual(self.bot.sent(zapata.GROUP_CHAT_ID), [])
+        replies = [kwargs["text"] for _, kwargs in self.bot.calls if "text" in kwargs]
+        self.assertEqual(replies, ["⚠️ Unsupported content type."])
+
+    def test_single_photo_album_item_is_forwarded(self) -> None:
+        self.relay([photo(1, media_group_id="g1")])
+        self.assertEqual(
+            self.bot.sent(zapata.GROUP_CHAT_ID), ["send_message", "send_photo"]
+        )
+        self.assertEqual(self.bot.sent(USER_ID), ["send_message"])
+
+
+class GCRALimiterTest(unittest.TestCase):
+    def test_burst_then_steady_rate(self) -> None:
+        limiter = zapata.GCRALimiter(100, idle_ttl=60)
+        now = 1000.0
+        for _ in range(3):
+            tat, wait = limiter.peek("k", 3, 3.0, now)
+            self.assertEqual(wait, 0)
+            limiter.commit("k", tat)
+        _, wait = limiter.peek("k", 3, 3.0, now)
+        self.assertAlmostEqual(wait, 1.0)
+        _, wait = limiter.peek("k", 3, 3.0, now + 1.0)
+        self.assertEqual(wait, 0)
+
+    def test_rate_limit_charges_all_checks_or_none(self) -> None:
+        state = zapata.LocalState(zapata.provision_bot_data({}))
+
+        async def scenario():
+            first = await state.rate_limit([("global", 1, 10)])
+            refused = await state.rate_limit([("user", 1, 10), ("global", 1, 10)])
+            user_only = await state.rate_limit([("user", 1, 10)])
+            return first, refused, user_only
+
+        first, refused, user_only = asyncio.run(scenario())
+        self.assertEqual(first, (0.0, -1))
+        self.assertEqual(refused[1], 1)
+        self.assertGreater(refused[0], 0)
+        self.assertEqual(user_only, (0.0, -1))
+
+
+class BroadcastClaimTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        path = os.path.join(self.tmp.name, "state.sqlite3")
+        self.stores = [zapata.SQLiteStateStore(path) for _ in range(2)]
+        for store in self.stores:
+            self.addCleanup(store.close)
+
+    @staticmethod
+    def claim(store, owner: str, stale_before: float):
+        rows = store.claim(owner, stale_before, ["broadcasts"])["broadcasts"]
+        return [row[0] for row in rows]
+
+    def test_only_a_stopped_owners_broadcast_is_claimed(self) -> None:
+        alive, other = self.stores
+        journal = zapata.StateJournal()
+        zapata.Broadcast(1, {"type": "text"}, 10, -100).save(journal, "alive")
+        alive.write(journal.drain())
+        stale_before = time.time() - 30
+
+        # The claim is also the owner's heartbeat; its own rows are left alone
+        self.assertEqual(self.claim(alive, "alive", stale_before), [])
+        self.assertEqual(self.claim(other, "other", stale_before), [])
+        # Shutting down releases it right away, no need to wait for the timeout
+        alive.write({("state_owners", "alive"): None})
+        self.assertEqual(self.claim(other, "other", stale_before), [1])
+        self.assertEqual(self.claim(alive, "alive", stale_before), [])
+
+
+class OutboxTest(unittest.TestCase):
+    def setUp(self) -> None:
+        patcher = mock.patch.multiple(
+            zapata, FORWARDING_MODE="classic", THREADING_MODE="replies", **UNLIMITED
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.bot_data = zapata.provision_bot_data({})
+        self.outbox: zapata.Outbox = self.bot_data["outbox"]
+
+    def job(self, message_id: int):
+        return zapata.new_outbox_job(
+            "forward",
+            [photo(message_id)],
+            USER_ID,
+            notify={"chat_id": USER_ID, "delivered": "ok", "failed": "failed"},
+            group_id=zapata.GROUP_CHAT_ID,
+        )
+
+    def test_retry_does_not_resend_delivered_steps(self) -> None:
+        bot = FakeBot(send_photo=[NetworkError("connection reset")])
+        job = self.job(1)
+
+        async def scenario():
+            first = await self.outbox.submit(bot, job)
+            second = await self.outbox._attempt(bot, job)
+            return first, second
+
+        with self.assertLogs(zapata.logger, "WARNING"):
+            self.assertEqual(asyncio.run(scenario()), ("queued", "delivered"))
+        self.assertEqual(
+            bot.sent(zapata.GROUP_CHAT_ID), ["send_message", "send_photo", "send_photo"]
+        )
+        self.assertNotIn(job["job_id"], self.outbox.jobs)
+
+    def test_only_network_errors_and_flood_control_are_retried(self) -> None:
+        cases = [
+            (TimedOut(), "queued", "pending"),
+            (BadRequest("Chat not found"), "failed", "dead"),
+            (TypeError("bug"), "failed", "dead"),
+        ]
+        for message_id, (exc, outcome, status) in enumerate(cases, start=1):
+            with self.subTest(error=type(exc).__name__):
+                bot = FakeBot(send_photo=[exc])
+                job = self.job(message_id)
+                with self.assertLogs(zapata.logger, "WARNING") as logs:
+                    self.assertEqual(asyncio.run(self.outbox.submit(bot, job)), outcome)
+                self.assertEqual(job["status"], status)
+                self.assertEqual(job["attempts"], 1)
+                if status == "dead":
+                    self.assertIsNotNone(logs.records[-1].exc_info)
+
+
+class StateJournalTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "state.sqlite3")
+
+    def tearDown(self) -> None:
+        self.tmp.cleanup()
+
+    def test_group_mappings_survive_flush_and_reload(self) -> None:
+        group_id = -1001234567890
+        store = zapata.SQLiteStateStore(self.path)
+        bot_data = zapata.provision_bot_data({})
+        bot_data["state_store"] = store
+        state = zapata.LocalState(bot_data)
+
+        async def scenario() -> None:
+            for message_id in range(10, 20):
+                await state.map_message(group_id, message_id, 1000 + message_id)
+            await state.map_message(-1009876543210, 10, 42)
+            await state.forget_message(group_id, 15)
+            await zapata.flush_state(bot_data)
+
+        asyncio.run(scenario())
+        store.close()
+
+        reloaded = zapata.SQLiteStateStore(self.path)
+        try:
+            rows = reloaded.load()["info_message_map"]
+        finally:
+            reloaded.close()
+        mapped = {(chat_id, message_id): user_id for chat_id, message_id, user_id, _ in rows}
+        expected = {(group_id, m): 1000 + m for m in range(10, 20) if m != 15}
+        expected[(-1009876543210, 10)] = 42
+        self.assertEqual(mapped, expected)
+
+    def test_composite_keys_collapse_put_and_delete(self) -> None:
+        journal = zapata.StateJournal()
+        journal.put("group_message_map", (-100, 1, 7, 0.0))
+        journal.put("group_message_map", (-100, 2, 8, 0.0))
+        journal.delete("group_message_map", (-100, 1))
+        self.assertEqual(
+            journal.drain(),
+            {
+                ("group_message_map", (-100, 1)): None,
+                ("group_message_map", (-100, 2)): (-100, 2, 8, 0.0),
+            },
+        )
+
+
+class GroupRoutingTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        path = os.path.join(self.tmp.name, "state.sqlite3")
+        self.store = zapata.SQLiteStateStore(path)
+        self.addCleanup(self.store.close)
+
+    def route(self, user, groups):
+        bot_data = zapata.provision_bot_data({})
+        bot_data["state_store"] = self.store
+
+        async def scenario():
+            group = await zapata.route_user(bot_data, user)
+            await zapata.flush_state(bot_data)
+            return group
+
+        with mock.patch.object(zapata, "SUPPORT_GROUP_IDS", groups):
+            return asyncio.run(scenario())
+
+    def test_assigned_group_sticks_when_groups_are_added(self) -> None:
+        before, after = (-1, -2), (-1, -2, -3)
+        # A user the hash ring would move once the third group is added
+        for user_id in range(1, 1000):
+            user = SimpleNamespace(id=user_id, language_code=None)
+            with mock.patch.object(zapata, "SUPPORT_GROUP_IDS", before):
+                old = zapata.preferred_group(user)
+            with mock.patch.object(zapata, "SUPPORT_GROUP_IDS", after):
+                if zapata.preferred_group(user) != old:
+                    break
+        # Each call starts from empty memory, so the assignment comes from the store
+        group = self.route(user, before)
+        self.assertEqual(self.route(user, after), group)
+        # Only removing the group moves the user
+        remaining = tuple(g for g in after if g != group)
+        self.assertIn(self.route(user, remaining), remaining)
+
+
+if __name__ == "__main__":
+    unittest.main()
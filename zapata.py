@@ -1,578 +1,5396 @@
-from __future__ import annotations
-
-import html
-import logging
-from collections import defaultdict, deque
-from datetime import datetime, timedelta
-from typing import Any, Dict, Optional
-
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
-from telegram.constants import ChatAction, ParseMode
-from telegram.ext import (
-    ApplicationBuilder,
-    CallbackQueryHandler,
-    CommandHandler,
-    ContextTypes,
-    MessageHandler,
-    filters,
-)
-
-# ⚠️ Replace with your real token & group id
-TOKEN = "YOUR_TELEGRAM_BOT_TOKEN"
-GROUP_CHAT_ID = -1001234567890
-
-RATE_LIMIT_MAX_MESSAGES = 5
-RATE_LIMIT_WINDOW_SECONDS = 10
-
-logger = logging.getLogger(__name__)
-
-
-def ensure_bot_data(context: ContextTypes.DEFAULT_TYPE) -> Dict[str, Any]:
-    """Provision shared bot data containers."""
-    bot_data = context.application.bot_data
-    bot_data.setdefault("blocked_users", set())
-    bot_data.setdefault("rate_limiter", defaultdict(deque))
-    bot_data.setdefault("info_message_map", {})
-    bot_data.setdefault("user_info", {})
-    return bot_data
-
-
-def is_user_blocked(context: ContextTypes.DEFAULT_TYPE, user_id: int) -> bool:
-    bot_data = ensure_bot_data(context)
-    return user_id in bot_data["blocked_users"]
-
-
-def add_user_to_blocklist(context: ContextTypes.DEFAULT_TYPE, user_id: int) -> None:
-    bot_data = ensure_bot_data(context)
-    bot_data["blocked_users"].add(user_id)
-
-
-def remove_user_from_blocklist(context: ContextTypes.DEFAULT_TYPE, user_id: int) -> bool:
-    """Remove a user from the blocklist. Returns True if removed."""
-    bot_data = ensure_bot_data(context)
-    if user_id in bot_data["blocked_users"]:
-        bot_data["blocked_users"].remove(user_id)
-        return True
-    return False
-
-
-def track_rate_limit(context: ContextTypes.DEFAULT_TYPE, user_id: int) -> bool:
-    """Return False if user exceeded rate limit."""
-    bot_data = ensure_bot_data(context)
-    history: deque = bot_data["rate_limiter"][user_id]
-    now = datetime.utcnow()
-    cutoff = now - timedelta(seconds=RATE_LIMIT_WINDOW_SECONDS)
-
-    while history and history[0] < cutoff:
-        history.popleft()
-
-    if len(history) >= RATE_LIMIT_MAX_MESSAGES:
-        return False
-
-    history.append(now)
-    return True
-
-
-async def send_text(bot, chat_id: int, text: str) -> None:
-    await bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
-    await bot.send_message(chat_id=chat_id, text=text)
-
-
-def resolve_message_payload(update_message) -> Optional[Dict[str, Any]]:
-    msg = update_message
-    if msg.text:
-        return {
-            "type": "text",
-            "action": ChatAction.TYPING,
-            "label": "📨 Message",
-            "data": {"text": msg.text_html, "parse_mode": ParseMode.HTML},
-        }
-    if msg.photo:
-        return {
-            "type": "photo",
-            "action": ChatAction.UPLOAD_PHOTO,
-            "label": "📸 Photo",
-            "data": {
-                "photo": msg.photo[-1].file_id,
-                "caption": msg.caption_html,
-                "parse_mode": ParseMode.HTML,
-            },
-        }
-    if msg.video:
-        return {
-            "type": "video",
-            "action": ChatAction.UPLOAD_VIDEO,
-            "label": "🎥 Video",
-            "data": {
-                "video": msg.video.file_id,
-                "caption": msg.caption_html,
-                "parse_mode": ParseMode.HTML,
-            },
-        }
-    if msg.animation:
-        return {
-            "type": "animation",
-            "action": ChatAction.UPLOAD_VIDEO,
-            "label": "🎞 GIF",
-            "data": {
-                "animation": msg.animation.file_id,
-                "caption": msg.caption_html,
-                "parse_mode": ParseMode.HTML,
-            },
-        }
-    if msg.document:
-        return {
-            "type": "document",
-            "action": ChatAction.UPLOAD_DOCUMENT,
-            "label": "📁 Document",
-            "data": {
-                "document": msg.document.file_id,
-                "caption": msg.caption_html,
-                "parse_mode": ParseMode.HTML,
-            },
-        }
-    if msg.voice:
-        return {
-            "type": "voice",
-            "action": ChatAction.RECORD_VOICE,
-            "label": "🎙 Voice",
-            "data": {
-                "voice": msg.voice.file_id,
-                "caption": msg.caption_html,
-                "parse_mode": ParseMode.HTML,
-            },
-        }
-    return None
-
-
-async def send_payload(
-    bot, chat_id: int, payload: Dict[str, Any], reply_to: Optional[int] = None
-):
-    action = payload["action"]
-    await bot.send_chat_action(chat_id=chat_id, action=action)
-    data = payload["data"].copy()
-
-    # Clean empty captions
-    if "caption" in data and data["caption"] is None:
-        data.pop("caption", None)
-        data.pop("parse_mode", None)
-
-    if reply_to:
-        data["reply_to_message_id"] = reply_to
-
-    payload_type = payload["type"]
-    if payload_type == "text":
-        return await bot.send_message(chat_id=chat_id, **data)
-    if payload_type == "photo":
-        return await bot.send_photo(chat_id=chat_id, **data)
-    if payload_type == "video":
-        return await bot.send_video(chat_id=chat_id, **data)
-    if payload_type == "animation":
-        return await bot.send_animation(chat_id=chat_id, **data)
-    if payload_type == "document":
-        return await bot.send_document(chat_id=chat_id, **data)
-    if payload_type == "voice":
-        return await bot.send_voice(chat_id=chat_id, **data)
-    raise ValueError("Unsupported payload type")
-
-
-def build_info_text(message, label: str) -> str:
-    user = message.from_user
-    raw_username = f"@{user.username}" if user.username else "No username"
-    username = html.escape(raw_username)
-    full_name = html.escape(user.full_name)
-
-    lines = [
-        f"{label} from <b>{full_name}</b> ({username})",
-        f"🆔 <code>{user.id}</code>",
-    ]
-
-    if message.caption_html:
-        lines.append(f"💬 {message.caption_html}")
-    elif message.text_html:
-        lines.append(f"💬 {message.text_html}")
-
-    return "\n".join(lines)
-
-
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    try:
-        if update.effective_chat.type != "private":
-            return
-        await send_text(
-            context.bot,
-            update.effective_chat.id,
-            "Welcome! Send any message and I'll forward it to the admins.",
-        )
-    except Exception as exc:
-        logger.exception("Failed to handle /start: %s", exc)
-
-
-async def handle_private_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    message = update.effective_message
-    user = update.effective_user
-    payload = resolve_message_payload(message)
-    bot_data = ensure_bot_data(context)
-
-    # Cache basic user info for admin views (/blocked)
-    if user:
-        bot_data["user_info"][user.id] = {
-            "username": user.username,
-            "full_name": user.full_name,
-        }
-
-    if not payload:
-        await send_text(context.bot, message.chat.id, "⚠️ Unsupported content type.")
-        return
-
-    if is_user_blocked(context, user.id):
-        await send_text(
-            context.bot,
-            message.chat.id,
-            "🚫 You have been blocked and cannot send messages.",
-        )
-        return
-
-    if not track_rate_limit(context, user.id):
-        await send_text(
-            context.bot,
-            message.chat.id,
-            "⚠️ You are sending messages too quickly. Please slow down.",
-        )
-        return
-
-    try:
-        info_text = build_info_text(message, payload["label"])
-        keyboard = InlineKeyboardMarkup(
-            [[InlineKeyboardButton("🚫 Block User", callback_data=f"block:{user.id}")]]
-        )
-        await context.bot.send_chat_action(
-            chat_id=GROUP_CHAT_ID, action=ChatAction.TYPING
-        )
-        info_message = await context.bot.send_message(
-            chat_id=GROUP_CHAT_ID,
-            text=info_text,
-            parse_mode=ParseMode.HTML,
-            reply_markup=keyboard,
-        )
-        bot_data["info_message_map"][info_message.message_id] = user.id
-
-        await send_payload(
-            context.bot,
-            GROUP_CHAT_ID,
-            payload,
-            reply_to=info_message.message_id,
-        )
-
-        await send_text(
-            context.bot,
-            message.chat.id,
-            "✅ Delivered to the group. Await their reply here.",
-        )
-    except Exception as exc:
-        logger.exception("Failed to forward private message: %s", exc)
-        await send_text(context.bot, message.chat.id, "❌ Failed to send your message.")
-
-
-async def handle_group_reply(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    message = update.effective_message
-    bot_data = ensure_bot_data(context)
-    reply_to = message.reply_to_message
-
-    if not reply_to:
-        return
-
-    user_id = bot_data["info_message_map"].get(reply_to.message_id)
-    if not user_id:
-        await send_text(
-            context.bot,
-            message.chat.id,
-            "⚠️ Please reply directly to the bot's info message.",
-        )
-        return
-
-    if is_user_blocked(context, user_id):
-        await send_text(
-            context.bot, message.chat.id, "ℹ️ That user is currently blocked."
-        )
-        return
-
-    payload = resolve_message_payload(message)
-    if not payload:
-        await send_text(context.bot, message.chat.id, "⚠️ Unsupported reply type.")
-        return
-
-    try:
-        await send_text(context.bot, user_id, "📩 Reply from the group chat:")
-        await send_payload(context.bot, user_id, payload)
-        await send_text(context.bot, message.chat.id, "✅ Reply delivered.")
-
-        # 🧹 Clean up mapping once the reply has been successfully delivered
-        bot_data["info_message_map"].pop(reply_to.message_id, None)
-    except Exception as exc:
-        logger.exception("Failed to deliver reply: %s", exc)
-        await send_text(context.bot, message.chat.id, "❌ Could not deliver the reply.")
-
-
-async def handle_block_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """You said everyone in the group is admin, so no admin-check here."""
-    query = update.callback_query
-    if not query or not query.data or not query.data.startswith("block:"):
-        return
-
-    try:
-        await query.answer()
-        user_id = int(query.data.split(":", maxsplit=1)[1])
-        add_user_to_blocklist(context, user_id)
-        await query.edit_message_reply_markup(reply_markup=None)
-        await query.message.reply_text(f"🚫 User {user_id} has been blocked.")
-    except Exception as exc:
-        logger.exception("Failed to block user: %s", exc)
-        await query.answer("Failed to block user.", show_alert=True)
-
-
-async def handle_unblock_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handle inline 'Unblock' button presses."""
-    query = update.callback_query
-    if not query or not query.data or not query.data.startswith("unblock:"):
-        return
-
-    try:
-        admin_id = query.from_user.id
-        member = await context.bot.get_chat_member(
-            chat_id=GROUP_CHAT_ID, user_id=admin_id
-        )
-        if member.status not in ("administrator", "creator"):
-            await query.answer("Permission denied.", show_alert=True)
-            return
-
-        user_id = int(query.data.split(":", maxsplit=1)[1])
-        removed = remove_user_from_blocklist(context, user_id)
-        if removed:
-            await query.answer()
-            await query.message.reply_text(f"✅ User {user_id} has been unblocked.")
-        else:
-            await query.answer("User not found in blocklist.", show_alert=True)
-    except Exception as exc:
-        logger.exception("Failed to unblock user via callback: %s", exc)
-        await query.answer("Failed to unblock user.", show_alert=True)
-
-
-async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Explain how the bot works and its limitations."""
-    try:
-        chat = update.effective_chat
-        user = update.effective_user
-
-        # Base text for everyone
-        base_text = (
-            "ℹ️ <b>Zapata Support Bot</b>\n\n"
-            "• <b>What I do</b>\n"
-            "  - I forward your private messages (text, photos, videos, GIFs, documents, voice notes) "
-            "to a support group.\n"
-            "  - Replies from the group are delivered back to you here.\n\n"
-            "• <b>Supported content</b>\n"
-            "  - Text messages\n"
-            "  - Photos (with captions)\n"
-            "  - Videos (with captions)\n"
-            "  - GIFs / animations\n"
-            "  - Documents and files\n"
-            "  - Voice messages\n\n"
-            "• <b>Limitations & safety</b>\n"
-            "  - Anti-spam: sending too many messages too quickly will temporarily stop forwarding.\n"
-            "  - Blocked users: the support team can block abusive users.\n"
-            "    Blocks are stored in memory and reset if the bot restarts.\n\n"
-        )
-
-        extra = ""
-
-        if chat.type == "private":
-            extra = (
-                "• <b>How to use (you)</b>\n"
-                "  - Just send me a message here in private.\n"
-                "  - Wait for the group’s reply, which will appear in this chat.\n"
-            )
-        elif chat.type in ("group", "supergroup"):
-            # If this user is an admin, show admin help too
-            try:
-                member = await context.bot.get_chat_member(
-                    chat_id=GROUP_CHAT_ID, user_id=user.id
-                )
-                if member.status in ("administrator", "creator"):
-                    extra = (
-                        "• <b>Admin tools</b>\n"
-                        "  - Reply to the bot's info message to answer a user.\n"
-                        "  - Press \"🚫 Block User\" under an info message to block them.\n"
-                        "  - Use /blocked to see the current blocklist and unblock via buttons.\n"
-                        "  - Use /unblock &lt;user_id&gt; to unblock manually.\n"
-                    )
-            except Exception:
-                # If we can't resolve admin status, just show base text
-                pass
-
-        text = base_text + extra
-
-        await context.bot.send_chat_action(
-            chat_id=chat.id, action=ChatAction.TYPING
-        )
-        await chat.send_message(text=text, parse_mode=ParseMode.HTML)
-    except Exception as exc:
-        logger.exception("Failed to send /help: %s", exc)
-
-
-async def blocked_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Admin-only: list blocked users and provide inline Unblock buttons."""
-    try:
-        bot_data = ensure_bot_data(context)
-        requester = update.effective_user
-
-        member = await context.bot.get_chat_member(
-            chat_id=GROUP_CHAT_ID, user_id=requester.id
-        )
-        if member.status not in ("administrator", "creator"):
-            await send_text(
-                context.bot,
-                update.effective_chat.id,
-                "🚫 You don't have permission to use this command.",
-            )
-            return
-
-        blocked_users = bot_data["blocked_users"]
-        user_info = bot_data["user_info"]
-
-        if not blocked_users:
-            await send_text(
-                context.bot,
-                update.effective_chat.id,
-                "✅ No users are currently blocked.",
-            )
-            return
-
-        lines = ["🚫 <b>Blocked users</b>:"]
-        keyboard_rows = []
-        for uid in sorted(blocked_users):
-            info = user_info.get(uid, {})
-            username = info.get("username")
-            full_name = info.get("full_name")
-
-            label_parts = [str(uid)]
-            if full_name or username:
-                pretty = []
-                if full_name:
-                    pretty.append(html.escape(full_name))
-                if username:
-                    pretty.append(html.escape(f"@{username}"))
-                label_parts.append(f"({', '.join(pretty)})")
-
-            label = " ".join(label_parts)
-            lines.append(f"• <code>{label}</code>")
-            keyboard_rows.append(
-                [
-                    InlineKeyboardButton(
-                        text=f"Unblock {uid}", callback_data=f"unblock:{uid}"
-                    )
-                ]
-            )
-
-        text = "\n".join(lines)
-        keyboard = InlineKeyboardMarkup(keyboard_rows)
-
-        await context.bot.send_chat_action(
-            chat_id=update.effective_chat.id, action=ChatAction.TYPING
-        )
-        await update.effective_chat.send_message(
-            text=text, parse_mode=ParseMode.HTML, reply_markup=keyboard
-        )
-    except Exception as exc:
-        logger.exception("Failed to handle /blocked: %s", exc)
-
-
-async def unblock_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Admin-only: /unblock <user_id> to remove from blocklist."""
-    try:
-        requester = update.effective_user
-        member = await context.bot.get_chat_member(
-            chat_id=GROUP_CHAT_ID, user_id=requester.id
-        )
-        if member.status not in ("administrator", "creator"):
-            await send_text(
-                context.bot,
-                update.effective_chat.id,
-                "🚫 You don't have permission to use this command.",
-            )
-            return
-
-        if not context.args:
-            await send_text(
-                context.bot,
-                update.effective_chat.id,
-                "Usage: /unblock <user_id>",
-            )
-            return
-
-        try:
-            user_id = int(context.args[0])
-        except ValueError:
-            await send_text(
-                context.bot,
-                update.effective_chat.id,
-                "User ID must be a number.",
-            )
-            return
-
-        removed = remove_user_from_blocklist(context, user_id)
-        if removed:
-            await send_text(
-                context.bot,
-                update.effective_chat.id,
-                f"✅ User {user_id} has been unblocked.",
-            )
-        else:
-            await send_text(
-                context.bot,
-                update.effective_chat.id,
-                "User not found in blocklist.",
-            )
-    except Exception as exc:
-        logger.exception("Failed to handle /unblock: %s", exc)
-
-
-def main() -> None:
-    logging.basicConfig(
-        format="%(asctime)s %(levelname)s %(name)s %(message)s",
-        level=logging.INFO,
-    )
-    application = ApplicationBuilder().token(TOKEN).build()
-
-    # Commands
-    application.add_handler(
-        CommandHandler("start", start, filters.ChatType.PRIVATE)
-    )
-    application.add_handler(CommandHandler("help", help_command))
-    application.add_handler(CommandHandler("blocked", blocked_command))
-    application.add_handler(CommandHandler("unblock", unblock_command))
-
-    # Messages
-    application.add_handler(
-        MessageHandler(
-            filters.ChatType.PRIVATE & ~filters.COMMAND,
-            handle_private_message,
-        )
-    )
-    application.add_handler(
-        MessageHandler(filters.ChatType.GROUPS & filters.REPLY, handle_group_reply)
-    )
-
-    # Callbacks
-    application.add_handler(
-        CallbackQueryHandler(handle_block_callback, pattern=r"^block:")
-    )
-    application.add_handler(
-        CallbackQueryHandler(handle_unblock_callback, pattern=r"^unblock:")
-    )
-
-    application.run_polling()
-
-
-if __name__ == "__main__":
-    main()
+from __future__ import annotations
+
+import argparse
+import asyncio
+import bisect
+import contextlib
+import contextvars
+import functools
+import gzip
+import hashlib
+import heapq
+import hmac
+import html
+import itertools
+import json
+import logging
+import logging.handlers
+import math
+import os
+import queue
+import random
+import shutil
+import signal
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict, defaultdict, deque
+from collections.abc import MutableMapping
+from datetime import timedelta
+from http import HTTPStatus
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Deque,
+    Dict,
+    Hashable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    Union,
+)
+
+from telegram import (
+    InlineKeyboardButton,
+    InlineKeyboardMarkup,
+    InputMediaAudio,
+    InputMediaDocument,
+    InputMediaPhoto,
+    InputMediaVideo,
+    Message,
+    Update,
+)
+from telegram.constants import ChatAction, ForumTopicLimit, MessageLimit, ParseMode
+from telegram.error import (
+    BadRequest,
+    Forbidden,
+    NetworkError,
+    RetryAfter,
+    TelegramError,
+    TimedOut,
+)
+from telegram.ext import (
+    Application,
+    ApplicationBuilder,
+    BaseRateLimiter,
+    BaseUpdateProcessor,
+    CallbackQueryHandler,
+    ChatMemberHandler,
+    CommandHandler,
+    ContextTypes,
+    MessageHandler,
+    filters,
+)
+from telegram.request import BaseRequest, HTTPXRequest, RequestData
+
+# ⚠️ Replace with your real token & group id
+TOKEN = "YOUR_TELEGRAM_BOT_TOKEN"
+GROUP_CHAT_ID = -1001234567890
+
+# To spread users over several support groups, list them all here (empty means
+# GROUP_CHAT_ID alone). A new user is placed on a consistent-hash ring of the
+# groups (GROUP_HASH_REPLICAS points per group, so adding a group only takes
+# its share from the others) unless an override matches, and then stays in
+# that group for good. Overrides map a rate-limit tier name, or a Telegram
+# language code ("pt-br", or just "pt"), to a group; tiers are checked first.
+SUPPORT_GROUP_IDS: Tuple[int, ...] = ()
+GROUP_TIER_OVERRIDES: Dict[str, int] = {}
+GROUP_LANGUAGE_OVERRIDES: Dict[str, int] = {}
+GROUP_HASH_REPLICAS = 100
+
+RATE_LIMIT_MAX_MESSAGES = 5
+RATE_LIMIT_WINDOW_SECONDS = 10
+
+# Rate limit tiers: name -> (max messages, window seconds). Users not listed
+# in USER_RATE_LIMIT_TIERS get the "default" tier.
+RATE_LIMIT_TIERS: Dict[str, Tuple[int, float]] = {
+    "default": (RATE_LIMIT_MAX_MESSAGES, RATE_LIMIT_WINDOW_SECONDS),
+    "trusted": (20, 10),
+    "spammer": (1, 60),
+}
+USER_RATE_LIMIT_TIERS: Dict[int, str] = {}
+
+# Inbound limit across all users, protects the group during raids
+GLOBAL_RATE_LIMIT_MAX_MESSAGES = 60
+GLOBAL_RATE_LIMIT_WINDOW_SECONDS = 10
+
+# "polling" uses getUpdates. "webhook" serves WEBHOOK_PATH on the built-in
+# HTTP server; updates are acknowledged with 200 as soon as they are queued,
+# and a full intake queue answers 429 so Telegram backs off and retries.
+# Leave WEBHOOK_URL empty to skip set_webhook (e.g. when POSTing recorded
+# updates by hand, or when the webhook is managed elsewhere).
+RUN_MODE = "polling"
+WEBHOOK_LISTEN = "0.0.0.0"
+WEBHOOK_PORT = 8443
+WEBHOOK_PATH = "/telegram"
+WEBHOOK_URL = ""
+WEBHOOK_SECRET_TOKEN = ""
+WEBHOOK_QUEUE_SIZE = 1000
+HTTP_MAX_BODY_BYTES = 1024 * 1024
+HTTP_IDLE_TIMEOUT_SECONDS = 75
+
+# Persistent state: "sqlite" keeps blocks, reply mappings and user info across
+# restarts, "memory" keeps everything in process memory only. "sqlite-shared"
+# lets several bot processes run side by side on one database file: the
+# blocklist, reply mappings and rate limits are read and written there
+# directly, with a local copy of the blocklist that is reloaded when another
+# process changes it (checked at most every SHARED_BLOCKLIST_CACHE_SECONDS).
+STATE_BACKEND = "sqlite"
+STATE_DB_PATH = "zapata.sqlite3"
+STATE_FLUSH_INTERVAL_SECONDS = 2.0
+SHARED_BLOCKLIST_CACHE_SECONDS = 1.0
+# Broadcasts and outbox jobs belong to the process that runs them. Under
+# "sqlite-shared" the others take over (and resume) only what they claim from
+# a process that stopped: one that shut down, or whose heartbeat, renewed on
+# every flush, is older than STATE_OWNER_TIMEOUT_SECONDS.
+STATE_OWNER_TIMEOUT_SECONDS = 30.0
+SQLITE_BUSY_TIMEOUT_MS = 5000
+
+# Memory bounds. Reply mappings expire after a week and the oldest are evicted
+# first once the cap is hit; user info and limiter histories are LRU-capped.
+INFO_MESSAGE_MAP_MAX_SIZE = 100_000
+INFO_MESSAGE_MAP_TTL_SECONDS = 7 * 24 * 3600
+USER_INFO_MAX_SIZE = 50_000
+RATE_LIMITER_MAX_USERS = 50_000
+
+# Admin status of group members is cached and kept fresh from chat_member
+# updates; entries older than the TTL are re-checked with get_chat_member.
+ADMIN_STATUSES = ("administrator", "creator")
+ADMIN_CACHE_TTL_SECONDS = 10 * 60
+ADMIN_CACHE_MAX_SIZE = 10_000
+
+# /blocked lists the blocklist this many users per page. Search terms are cut
+# to fit Telegram's 64-byte callback data.
+BLOCKED_PAGE_SIZE = 20
+BLOCKED_SEARCH_MAX_BYTES = 24
+
+# Conversation archive: every delivered forward and reply is appended to its
+# own SQLite file, with an FTS5 index over text and captions, for /history
+# and `python zapata.py export`. Rows are written in batches by the state
+# flush loop. Set ARCHIVE_DB_PATH = "" to keep no archive.
+ARCHIVE_DB_PATH = "zapata-archive.sqlite3"
+ARCHIVE_EXPORT_BATCH_SIZE = 1000
+HISTORY_PAGE_SIZE = 10
+HISTORY_QUERY_MAX_BYTES = 32
+HISTORY_SNIPPET_LENGTH = 120
+
+# Concurrent update processing. Updates sharing an ordering key still run one
+# after another: "user" keys by sender (group replies by the replied-to
+# message), "chat" by chat. A callable taking the update may be used instead.
+# Set CONCURRENT_UPDATES to 1 to process updates strictly one at a time.
+CONCURRENT_UPDATES = 32
+UPDATE_ORDERING_KEY: Any = "user"
+UPDATE_MAX_PENDING = 1024
+
+# "classic" sends a header, then the payload under it, each with a chat
+# action. "compact" copies the message with the header merged into its
+# caption (or text), so most messages cost a single call and any content
+# type Telegram can copy is supported.
+FORWARDING_MODE = "classic"
+
+# How admin messages find their way back to a user. "replies" maps every
+# forwarded message to its sender and routes admin replies to them. "topics"
+# needs a forum supergroup: each user gets a topic of their own, created on
+# their first message and introduced once with the Block button; forwards are
+# plain copies into it, and anything admins post in the topic goes to the user.
+THREADING_MODE = "replies"
+
+# A message (or album) a user already sent within DEDUP_WINDOW_SECONDS isn't
+# forwarded again; they get a short notice instead. Media is recognised by
+# file_unique_id, text by its case- and whitespace-insensitive hash. Texts
+# shorter than DEDUP_MIN_TEXT_LENGTH ("ok", "yes") are always forwarded. At
+# most DEDUP_MAX_ENTRIES fingerprints are kept, per process. 0 disables.
+DEDUP_WINDOW_SECONDS = 10 * 60
+DEDUP_MIN_TEXT_LENGTH = 16
+DEDUP_MAX_ENTRIES = 100_000
+
+# Consecutive text messages from a user are merged into one forward (and one
+# ack) once they've stopped typing for TEXT_BURST_WINDOW_SECONDS, up to
+# Telegram's text length limit. 0 forwards every message on its own.
+TEXT_BURST_WINDOW_SECONDS = 0.0
+
+# Album items (updates sharing a media_group_id) are collected until no new
+# item has arrived for this long, then forwarded as a single media group.
+MEDIA_GROUP_WINDOW_SECONDS = 1.0
+
+# Outbound scheduling. Every Bot API call passes through a global token bucket
+# and, for message sends, a per-chat bucket (Telegram allows ~30 messages/s in
+# total, ~1/s per private chat and ~20/min per group). Rates are per second.
+OUTBOUND_GLOBAL_RATE = 30.0
+OUTBOUND_GLOBAL_BURST = 30
+OUTBOUND_PRIVATE_CHAT_RATE = 1.0
+OUTBOUND_PRIVATE_CHAT_BURST = 3
+OUTBOUND_GROUP_CHAT_RATE = 20 / 60
+OUTBOUND_GROUP_CHAT_BURST = 10
+OUTBOUND_MAX_RETRIES = 3
+# Chat actions are only visible for ~5 seconds; older queued ones are dropped.
+OUTBOUND_CHAT_ACTION_MAX_AGE_SECONDS = 5.0
+
+# Bot API middleware (see BotAPIPipeline). A chat action is skipped when the
+# same chat got one less than CHAT_ACTION_COALESCE_SECONDS ago: actions show
+# for ~5 seconds and ours are always followed by a message, so a repeat
+# changes nothing visible (0 sends every action). BOT_API_TRACE logs each
+# call with its latency and the handler and update that made it.
+CHAT_ACTION_COALESCE_SECONDS = 4.5
+BOT_API_TRACE = False
+
+# Traffic capture for replay.py (off unless CAPTURE_PATH is set). Each update
+# as received and each Bot API call with its result is appended as a JSON line.
+# The file is rotated at CAPTURE_MAX_BYTES and rotated files are gzipped; the
+# newest CAPTURE_BACKUPS are kept. Captures hold message contents, so keep
+# them as private as the database.
+CAPTURE_PATH = ""
+CAPTURE_MAX_BYTES = 64 * 1024 * 1024
+CAPTURE_BACKUPS = 10
+
+# Load shedding. Load is the larger of in-flight forwards over
+# LOAD_MAX_IN_FLIGHT_FORWARDS and outbound queue depth over
+# LOAD_MAX_QUEUE_DEPTH. Past each LOAD_SHED_LEVELS threshold the bot degrades
+# one more step: chat actions are dropped, then "delivered" acks are skipped,
+# then new messages are turned away with their place in line and when to
+# retry. Admin replies are never shed.
+LOAD_MAX_IN_FLIGHT_FORWARDS = 200
+LOAD_MAX_QUEUE_DEPTH = 500
+LOAD_SHED_LEVELS = (0.5, 0.75, 1.0)
+
+# Outbound priority lanes, lowest value is sent first.
+PRIORITY_REPLY = 0
+PRIORITY_FORWARD = 1
+PRIORITY_ACK = 2
+PRIORITY_BROADCAST = 3
+PRIORITY_ACTION = 4
+
+# /broadcast fan-out. Sends go through the outbound scheduler (so they share
+# the global rate limit, below interactive traffic) with at most
+# BROADCAST_CONCURRENCY in flight. Progress is checkpointed with the rest of
+# the state and unfinished broadcasts resume on startup (see
+# STATE_OWNER_TIMEOUT_SECONDS for several processes).
+# Recipients are read from the store's user_info table in pages of
+# BROADCAST_PAGE_SIZE user ids.
+BROADCAST_CONCURRENCY = 8
+BROADCAST_PAGE_SIZE = 500
+BROADCAST_PROGRESS_INTERVAL_SECONDS = 10.0
+BROADCAST_RESUME = True
+
+# Forwards and replies go through a persistent outbox: a failed delivery is
+# retried in the background with exponential backoff (base * 2^attempt, capped,
+# with +-50% jitter) and moved to a dead-letter list after OUTBOX_MAX_ATTEMPTS
+# or on a permanent error. Already-sent parts (e.g. the info header) are never
+# re-sent. Pending jobs resume on startup, like broadcasts.
+OUTBOX_WORKERS = 2
+OUTBOX_MAX_ATTEMPTS = 8
+OUTBOX_BACKOFF_BASE_SECONDS = 5.0
+OUTBOX_BACKOFF_MAX_SECONDS = 30 * 60
+OUTBOX_DEAD_LETTER_MAX_SIZE = 500
+OUTBOX_RESUME = True
+
+# Metrics via /stats for admins, and in Prometheus text format on
+# http://METRICS_LISTEN:METRICS_PORT METRICS_PATH once a port is set (e.g.
+# 9464; several processes on one host each need their own).
+METRICS_LISTEN = "127.0.0.1"
+METRICS_PORT: Optional[int] = None
+METRICS_PATH = "/metrics"
+METRICS_LATENCY_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0
+)
+
+logger = logging.getLogger(__name__)
+
+
+# Table name -> (CREATE statement, column names). The key is the first column,
+# or the first columns for tables whose journal keys are tuples.
+STATE_SCHEMA: Dict[str, Tuple[str, Tuple[str, ...]]] = {
+    "blocked_users": (
+        "CREATE TABLE IF NOT EXISTS blocked_users (user_id INTEGER PRIMARY KEY)",
+        ("user_id",),
+    ),
+    # Group message (info header or forwarded copy) -> the user it came from
+    "group_message_map": (
+        "CREATE TABLE IF NOT EXISTS group_message_map ("
+        "chat_id INTEGER NOT NULL, message_id INTEGER NOT NULL, "
+        "user_id INTEGER NOT NULL, created_at REAL NOT NULL, "
+        "PRIMARY KEY (chat_id, message_id))",
+        ("chat_id", "message_id", "user_id", "created_at"),
+    ),
+    "user_info": (
+        "CREATE TABLE IF NOT EXISTS user_info ("
+        "user_id INTEGER PRIMARY KEY, username TEXT, full_name TEXT, "
+        "updated_at REAL NOT NULL)",
+        ("user_id", "username", "full_name", "updated_at"),
+    ),
+    # Users who blocked the bot or deleted their account; broadcasts skip them
+    "unreachable_users": (
+        "CREATE TABLE IF NOT EXISTS unreachable_users ("
+        "user_id INTEGER PRIMARY KEY, reason TEXT, updated_at REAL NOT NULL)",
+        ("user_id", "reason", "updated_at"),
+    ),
+    "broadcasts": (
+        "CREATE TABLE IF NOT EXISTS broadcasts ("
+        "broadcast_id INTEGER PRIMARY KEY, payload TEXT NOT NULL, "
+        "total INTEGER NOT NULL, chat_id INTEGER NOT NULL, "
+        "status_message_id INTEGER, created_at REAL NOT NULL, owner TEXT)",
+        (
+            "broadcast_id",
+            "payload",
+            "total",
+            "chat_id",
+            "status_message_id",
+            "created_at",
+            "owner",
+        ),
+    ),
+    "outbox": (
+        "CREATE TABLE IF NOT EXISTS outbox ("
+        "job_id TEXT PRIMARY KEY, status TEXT NOT NULL, job TEXT NOT NULL, "
+        "updated_at REAL NOT NULL, owner TEXT)",
+        ("job_id", "status", "job", "updated_at", "owner"),
+    ),
+    # THREADING_MODE = "topics": the forum topic that belongs to each user
+    "user_topics": (
+        "CREATE TABLE IF NOT EXISTS user_topics ("
+        "user_id INTEGER PRIMARY KEY, chat_id INTEGER NOT NULL, "
+        "thread_id INTEGER NOT NULL, created_at REAL NOT NULL)",
+        ("user_id", "chat_id", "thread_id", "created_at"),
+    ),
+    # The support group each user was assigned to
+    "user_groups": (
+        "CREATE TABLE IF NOT EXISTS user_groups ("
+        "user_id INTEGER PRIMARY KEY, chat_id INTEGER NOT NULL, "
+        "updated_at REAL NOT NULL)",
+        ("user_id", "chat_id", "updated_at"),
+    ),
+    # Rewritten on every checkpoint. cursor: every user id up to it is done
+    "broadcast_progress": (
+        "CREATE TABLE IF NOT EXISTS broadcast_progress ("
+        "broadcast_id INTEGER PRIMARY KEY, cursor INTEGER NOT NULL, "
+        "sent INTEGER NOT NULL, skipped INTEGER NOT NULL, failed INTEGER NOT NULL)",
+        ("broadcast_id", "cursor", "sent", "skipped", "failed"),
+    ),
+    # Processes that own broadcasts or outbox jobs, and when each last flushed
+    "state_owners": (
+        "CREATE TABLE IF NOT EXISTS state_owners ("
+        "owner TEXT PRIMARY KEY, seen_at REAL NOT NULL)",
+        ("owner", "seen_at"),
+    ),
+}
+
+# Tables whose primary key spans more than the first column
+STATE_KEY_WIDTHS: Dict[str, int] = {"group_message_map": 2}
+
+
+def state_key(table: str, row: Tuple[Any, ...]) -> Any:
+    """Journal key of a row: its primary key, a tuple if it is composite."""
+    width = STATE_KEY_WIDTHS.get(table, 1)
+    return row[0] if width == 1 else tuple(row[:width])
+
+
+class BoundedTTLMap(MutableMapping):
+    """Insertion-ordered mapping with a size cap and optional per-entry TTL.
+
+    Writing a key moves it to the back, so the front always holds the entry
+    written longest ago: capacity eviction drops it (LRU on write) and
+    expiry sweeps stop at the first live entry. Reads never reorder.
+    ``on_evict(key, value)`` is called for every capacity or TTL eviction,
+    and ``evictions`` counts them by reason.
+    """
+
+    def __init__(
+        self,
+        max_size: int,
+        ttl: Optional[float] = None,
+        on_evict: Optional[Callable[[Any, Any], None]] = None,
+        clock: Callable[[], float] = time.time,
+    ) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self.clock = clock
+        self.evictions = {"capacity": 0, "expired": 0}
+        self._data: "OrderedDict[Any, Tuple[Any, float]]" = OrderedDict()
+
+    def _expired(self, stamp: float, now: float) -> bool:
+        return self.ttl is not None and now - stamp > self.ttl
+
+    def _evict(self, key: Any, reason: str) -> None:
+        value, _ = self._data.pop(key)
+        self.evictions[reason] += 1
+        if self.on_evict:
+            self.on_evict(key, value)
+
+    def set(self, key: Any, value: Any, timestamp: Optional[float] = None) -> None:
+        self._data[key] = (value, self.clock() if timestamp is None else timestamp)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._evict(next(iter(self._data)), "capacity")
+
+    def __setitem__(self, key: Any, value: Any) -> None:
+        self.set(key, value)
+
+    def __getitem__(self, key: Any) -> Any:
+        value, stamp = self._data[key]
+        if self._expired(stamp, self.clock()):
+            self._evict(key, "expired")
+            raise KeyError(key)
+        return value
+
+    def __delitem__(self, key: Any) -> None:
+        del self._data[key]
+
+    def __contains__(self, key: object) -> bool:
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def __iter__(self) -> Iterator[Any]:
+        return iter(self._data)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def purge_expired(self) -> int:
+        """Drop expired entries from the front. Returns how many were dropped."""
+        if self.ttl is None:
+            return 0
+        now = self.clock()
+        purged = 0
+        while self._data:
+            key, (_, stamp) = next(iter(self._data.items()))
+            if not self._expired(stamp, now):
+                break
+            self._evict(key, "expired")
+            purged += 1
+        return purged
+
+
+def gcra_step(
+    tat: Optional[float], max_messages: int, window: float, now: float
+) -> Tuple[float, float]:
+    """One GCRA decision: (next TAT if allowed, seconds to wait; 0 = allowed)."""
+    interval = window / max_messages
+    tat = now if tat is None else max(tat, now)
+    return tat + interval, max(tat + interval - window - now, 0.0)
+
+
+class GCRALimiter:
+    """Generic cell rate algorithm limiter on the monotonic clock.
+
+    Allows ``max_messages`` per ``window`` seconds, in bursts of up to
+    ``max_messages``, storing a single float per key: the theoretical
+    arrival time (TAT) of the next message. A key whose TAT has passed is
+    the same as a fresh one, so keys idle for ``idle_ttl`` are dropped.
+    """
+
+    def __init__(self, max_keys: int, idle_ttl: float) -> None:
+        self._tats = BoundedTTLMap(max_keys, ttl=idle_ttl, clock=time.monotonic)
+
+    def __len__(self) -> int:
+        return len(self._tats)
+
+    @property
+    def evictions(self) -> Dict[str, int]:
+        return self._tats.evictions
+
+    def peek(
+        self, key: Hashable, max_messages: int, window: float, now: float
+    ) -> Tuple[float, float]:
+        """Return (TAT to commit if allowed, seconds to wait; 0 means allowed)."""
+        return gcra_step(self._tats.get(key), max_messages, window, now)
+
+    def commit(self, key: Hashable, tat: float) -> None:
+        self._tats[key] = tat
+
+    def purge_expired(self) -> int:
+        return self._tats.purge_expired()
+
+
+# Metric name -> (Prometheus type, help text)
+METRIC_HELP: Dict[str, Tuple[str, str]] = {
+    "zapata_handler_seconds": ("histogram", "Time spent in each update handler."),
+    "zapata_bot_api_seconds": ("histogram", "Bot API request latency by method."),
+    "zapata_bot_api_errors_total": (
+        "counter", "Bot API requests that failed, by method and HTTP status."
+    ),
+    "zapata_bot_api_skipped_total": (
+        "counter", "Bot API calls answered by the middleware without a request."
+    ),
+    "zapata_handler_api_calls_total": (
+        "counter", "Bot API calls made by each handler, by method."
+    ),
+    "zapata_load_level": (
+        "gauge", "Load shedding level (0 normal, 1 busy, 2 overloaded, 3 saturated)."
+    ),
+    "zapata_forwards_in_flight": ("gauge", "Forwards being delivered right now."),
+    "zapata_load_shed_total": (
+        "counter", "Work skipped by load shedding (chat actions, acks, messages)."
+    ),
+    "zapata_rate_limited_total": (
+        "counter", "Private messages rejected by the inbound rate limits."
+    ),
+    "zapata_blocked_drops_total": (
+        "counter", "Messages dropped because the user is blocked."
+    ),
+    "zapata_duplicates_total": (
+        "counter", "Private messages not forwarded because they repeat a recent one."
+    ),
+    "zapata_archived_messages_total": (
+        "counter", "Forwards (in) and replies (out) written to the archive."
+    ),
+    "zapata_outbound_queue_depth": ("gauge", "Bot API calls waiting to be sent."),
+    "zapata_outbound_retries_total": (
+        "counter", "Bot API calls re-queued after flood control."
+    ),
+    "zapata_broadcast_messages_total": (
+        "counter", "Broadcast deliveries by result."
+    ),
+    "zapata_outbox_jobs_total": (
+        "counter", "Outbox delivery attempts by result (delivered, retried, dead)."
+    ),
+    "zapata_outbox_pending": ("gauge", "Deliveries waiting for a retry."),
+    "zapata_outbox_dead_letters": ("gauge", "Deliveries that gave up."),
+    "zapata_blocked_users": ("gauge", "Users on the blocklist."),
+    "zapata_info_message_map_size": ("gauge", "Group messages mapped to a user."),
+    "zapata_user_info_size": ("gauge", "Users with cached profile info."),
+    "zapata_user_topics": ("gauge", "Users with a forum topic of their own."),
+    "zapata_state_evictions_total": (
+        "counter", "In-memory state entries evicted, by map and reason."
+    ),
+}
+
+MetricKey = Tuple[str, Tuple[Tuple[str, str], ...]]
+# Collector output: a metric name, or (name, sorted label pairs)
+Sample = Union[str, MetricKey]
+
+
+class Metrics:
+    """In-process counters and latency histograms, rendered for Prometheus.
+
+    Gauges are read at render time from collectors: coroutine functions
+    returning {metric name: value}. A name may come with labels as a
+    MetricKey, e.g. for counters kept by the objects they count.
+    """
+
+    def __init__(self, buckets: Sequence[float] = METRICS_LATENCY_BUCKETS) -> None:
+        self.buckets = tuple(buckets)
+        self._counters: Dict[MetricKey, float] = defaultdict(float)
+        # key -> per-bucket counts (last slot is +Inf), then sum and count
+        self._histograms: Dict[MetricKey, List[float]] = {}
+        self._collectors: List[Callable[[], Awaitable[Dict[Sample, float]]]] = []
+
+    @staticmethod
+    def key(name: str, labels: Dict[str, Any]) -> MetricKey:
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name: str, amount: float = 1, **labels: Any) -> None:
+        self._counters[self.key(name, labels)] += amount
+
+    def observe(self, name: str, value: float, **labels: Any) -> None:
+        key = self.key(name, labels)
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            histogram = self._histograms[key] = [0.0] * (len(self.buckets) + 3)
+        histogram[bisect.bisect_left(self.buckets, value)] += 1
+        histogram[-2] += value
+        histogram[-1] += 1
+
+    def add_collector(
+        self, collector: Callable[[], Awaitable[Dict[Sample, float]]]
+    ) -> None:
+        self._collectors.append(collector)
+
+    async def gauges(self) -> Dict[Sample, float]:
+        values: Dict[Sample, float] = {}
+        for collector in self._collectors:
+            try:
+                values.update(await collector())
+            except Exception as exc:
+                logger.exception("Metrics collector failed: %s", exc)
+        return values
+
+    def counters(self, name: str) -> List[Tuple[Dict[str, str], float]]:
+        return [
+            (dict(labels), value)
+            for (metric, labels), value in self._counters.items()
+            if metric == name
+        ]
+
+    def quantile(self, histogram: List[float], q: float) -> float:
+        """Estimate a quantile by interpolating within its bucket."""
+        rank = q * histogram[-1]
+        seen = 0.0
+        for index, count in enumerate(histogram[:-2]):
+            if count and seen + count >= rank:
+                lower = self.buckets[index - 1] if index else 0.0
+                if index == len(self.buckets):
+                    return lower
+                return lower + (self.buckets[index] - lower) * (rank - seen) / count
+            seen += count
+        return 0.0
+
+    def summaries(
+        self, name: str
+    ) -> List[Tuple[Dict[str, str], int, float, float]]:
+        """(labels, count, mean, p95) per label set, busiest first."""
+        rows = [
+            (dict(labels), int(h[-1]), h[-2] / h[-1], self.quantile(h, 0.95))
+            for (metric, labels), h in self._histograms.items()
+            if metric == name and h[-1]
+        ]
+        return sorted(rows, key=lambda row: row[1], reverse=True)
+
+    async def render(self) -> str:
+        """All metrics in the Prometheus text exposition format."""
+        samples: Dict[str, List[str]] = defaultdict(list)
+
+        def fmt(labels: Tuple[Tuple[str, str], ...]) -> str:
+            if not labels:
+                return ""
+            pairs = ",".join(f"{k}={json.dumps(v)}" for k, v in labels)
+            return "{" + pairs + "}"
+
+        for (name, labels), value in sorted(self._counters.items()):
+            samples[name].append(f"{name}{fmt(labels)} {value:g}")
+        for (name, labels), histogram in sorted(self._histograms.items()):
+            cumulative = 0.0
+            bounds = [f"{b:g}" for b in self.buckets] + ["+Inf"]
+            for bound, count in zip(bounds, histogram):
+                cumulative += count
+                bucket_labels = labels + (("le", bound),)
+                samples[name].append(f"{name}_bucket{fmt(bucket_labels)} {cumulative:g}")
+            samples[name].append(f"{name}_sum{fmt(labels)} {histogram[-2]:.6f}")
+            samples[name].append(f"{name}_count{fmt(labels)} {histogram[-1]:g}")
+        for sample, value in (await self.gauges()).items():
+            name, labels = (sample, ()) if isinstance(sample, str) else sample
+            samples[name].append(f"{name}{fmt(labels)} {value:g}")
+
+        lines = []
+        for name in sorted(samples):
+            kind, help_text = METRIC_HELP.get(name, ("untyped", ""))
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            lines.extend(samples[name])
+        return "\n".join(lines) + "\n"
+
+
+class StateJournal:
+    """Write-behind buffer of pending state mutations.
+
+    Mutations are keyed by (table, key), so repeated writes to the same row
+    between two flushes collapse into a single statement. A value of None
+    marks the row for deletion.
+    """
+
+    def __init__(self) -> None:
+        self._pending: Dict[Tuple[str, Any], Optional[Tuple[Any, ...]]] = {}
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def put(self, table: str, row: Tuple[Any, ...]) -> None:
+        self._pending[(table, state_key(table, row))] = row
+
+    def delete(self, table: str, key: Any) -> None:
+        self._pending[(table, key)] = None
+
+    def drain(self) -> Dict[Tuple[str, Any], Optional[Tuple[Any, ...]]]:
+        pending, self._pending = self._pending, {}
+        return pending
+
+    def restore(self, ops: Dict[Tuple[str, Any], Optional[Tuple[Any, ...]]]) -> None:
+        """Put back ops from a failed flush without clobbering newer writes."""
+        ops.update(self._pending)
+        self._pending = ops
+
+
+class StateStore:
+    """In-memory state backend: nothing is loaded and nothing is written."""
+
+    def load(self) -> Dict[str, Any]:
+        return {
+            "blocked_users": set(),
+            "info_message_map": [],
+            "user_info": [],
+            "unreachable_users": set(),
+            "user_topics": [],
+            "user_groups": [],
+        }
+
+    def write(self, ops: Dict[Tuple[str, Any], Optional[Tuple[Any, ...]]]) -> None:
+        pass
+
+    def claim(
+        self, owner: str, stale_before: float, tables: Sequence[str]
+    ) -> Dict[str, list]:
+        """Take over the rows of ``tables`` whose owner has stopped.
+
+        Owners are alive while their heartbeat is newer than
+        ``stale_before``; the claim renews ``owner``'s own. Returns the rows
+        taken over, per table.
+        """
+        return {table: [] for table in tables}
+
+    def user_ids(self, after: int, limit: int) -> List[int]:
+        """Up to limit known user ids greater than after, ascending."""
+        return []
+
+    def count_users(self) -> int:
+        return 0
+
+    def group_for_user(self, user_id: int) -> Optional[int]:
+        return None
+
+    def close(self) -> None:
+        pass
+
+
+class SQLiteStateStore(StateStore):
+    """SQLite (WAL mode) state backend.
+
+    All writes of one flush go into a single transaction; with WAL and
+    synchronous=NORMAL that is one fsync per checkpoint rather than per row.
+    """
+
+    def __init__(self, path: str) -> None:
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+        with self._conn:
+            for create_sql, _ in STATE_SCHEMA.values():
+                self._conn.execute(create_sql)
+
+    def load(self) -> Dict[str, Any]:
+        """Read state in bulk, newest rows only, oldest first.
+
+        Only as many reply mappings and user records as fit the in-memory
+        bounds are read, so a large store doesn't slow startup.
+        """
+        with self._lock:
+            blocked = {
+                row[0] for row in self._conn.execute("SELECT user_id FROM blocked_users")
+            }
+            info_map = self._conn.execute(
+                "SELECT chat_id, message_id, user_id, created_at FROM group_message_map "
+                "WHERE created_at >= ? ORDER BY created_at DESC LIMIT ?",
+                (time.time() - INFO_MESSAGE_MAP_TTL_SECONDS, INFO_MESSAGE_MAP_MAX_SIZE),
+            ).fetchall()
+            user_info = self._conn.execute(
+                "SELECT user_id, username, full_name FROM user_info "
+                "ORDER BY updated_at DESC LIMIT ?",
+                (USER_INFO_MAX_SIZE,),
+            ).fetchall()
+            unreachable = {
+                row[0]
+                for row in self._conn.execute("SELECT user_id FROM unreachable_users")
+            }
+            user_topics = self._conn.execute(
+                "SELECT user_id, chat_id, thread_id FROM user_topics"
+            ).fetchall()
+            user_groups = self._conn.execute(
+                "SELECT user_id, chat_id FROM user_groups "
+                "ORDER BY updated_at DESC LIMIT ?",
+                (USER_INFO_MAX_SIZE,),
+            ).fetchall()
+        info_map.reverse()
+        user_info.reverse()
+        user_groups.reverse()
+        return {
+            "blocked_users": blocked,
+            "info_message_map": info_map,
+            "user_info": user_info,
+            "unreachable_users": unreachable,
+            "user_topics": user_topics,
+            "user_groups": user_groups,
+        }
+
+    def write(self, ops: Dict[Tuple[str, Any], Optional[Tuple[Any, ...]]]) -> None:
+        upserts: Dict[str, list] = defaultdict(list)
+        deletes: Dict[str, list] = defaultdict(list)
+        for (table, key), row in ops.items():
+            if row is None:
+                deletes[table].append(key if isinstance(key, tuple) else (key,))
+            else:
+                upserts[table].append(row)
+
+        with self._lock, self._conn:
+            for table, rows in upserts.items():
+                columns = STATE_SCHEMA[table][1]
+                placeholders = ", ".join("?" for _ in columns)
+                self._conn.executemany(
+                    f"INSERT OR REPLACE INTO {table} ({', '.join(columns)}) "
+                    f"VALUES ({placeholders})",
+                    rows,
+                )
+            for table, keys in deletes.items():
+                key_columns = STATE_SCHEMA[table][1][: len(keys[0])]
+                where = " AND ".join(f"{column} = ?" for column in key_columns)
+                self._conn.executemany(f"DELETE FROM {table} WHERE {where}", keys)
+
+    # Table -> (query for its orphaned rows, key column)
+    CLAIMS = {
+        "broadcasts": (
+            "SELECT b.broadcast_id, b.payload, b.total, b.chat_id, "
+            "b.status_message_id, p.cursor, p.sent, p.skipped, p.failed "
+            "FROM broadcasts b LEFT JOIN broadcast_progress p USING (broadcast_id) "
+            "WHERE {orphaned} ORDER BY b.broadcast_id",
+            "broadcast_id",
+        ),
+        "outbox": (
+            "SELECT job_id, job FROM outbox WHERE {orphaned} ORDER BY updated_at",
+            "job_id",
+        ),
+    }
+
+    def claim(
+        self, owner: str, stale_before: float, tables: Sequence[str]
+    ) -> Dict[str, list]:
+        orphaned = (
+            "owner IS NOT ? AND (owner IS NULL OR owner NOT IN "
+            "(SELECT owner FROM state_owners WHERE seen_at >= ?))"
+        )
+        claimed: Dict[str, list] = {}
+        with self._lock, self._conn:
+            # Take the write lock up front, so no two processes claim a row
+            self._conn.execute("BEGIN IMMEDIATE")
+            self._conn.execute(
+                "INSERT OR REPLACE INTO state_owners (owner, seen_at) VALUES (?, ?)",
+                (owner, time.time()),
+            )
+            for table in tables:
+                query, key = self.CLAIMS[table]
+                rows = self._conn.execute(
+                    query.format(orphaned=orphaned), (owner, stale_before)
+                ).fetchall()
+                self._conn.executemany(
+                    f"UPDATE {table} SET owner = ? WHERE {key} = ?",
+                    [(owner, row[0]) for row in rows],
+                )
+                claimed[table] = rows
+        return claimed
+
+    def user_ids(self, after: int, limit: int) -> List[int]:
+        with self._lock:
+            return [
+                row[0]
+                for row in self._conn.execute(
+                    "SELECT user_id FROM user_info WHERE user_id > ? "
+                    "ORDER BY user_id LIMIT ?",
+                    (after, limit),
+                )
+            ]
+
+    def count_users(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM user_info").fetchone()[0]
+
+    def group_for_user(self, user_id: int) -> Optional[int]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT chat_id FROM user_groups WHERE user_id = ?", (user_id,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+def create_state_store() -> StateStore:
+    if STATE_BACKEND in ("sqlite", "sqlite-shared"):
+        return SQLiteStateStore(STATE_DB_PATH)
+    if STATE_BACKEND == "memory":
+        return StateStore()
+    raise ValueError(f"Unknown state backend: {STATE_BACKEND!r}")
+
+
+class LocalState:
+    """Blocklist, reply map and rate limits held in this process's bot_data.
+
+    Reads and writes are in-memory; changes reach the StateStore through
+    the write-behind journal. Only correct while a single bot process runs.
+    """
+
+    def __init__(self, bot_data: Dict[str, Any]) -> None:
+        self.bot_data = bot_data
+
+    async def is_blocked(self, user_id: int) -> bool:
+        return user_id in self.bot_data["blocked_users"]
+
+    async def block(self, user_id: int) -> None:
+        if user_id not in self.bot_data["blocked_users"]:
+            self.bot_data["blocked_users"].add(user_id)
+            bisect.insort(self.bot_data["blocked_index"], user_id)
+        self.bot_data["state_journal"].put("blocked_users", (user_id,))
+
+    async def unblock(self, user_id: int) -> bool:
+        blocked_users = self.bot_data["blocked_users"]
+        if user_id not in blocked_users:
+            return False
+        blocked_users.remove(user_id)
+        index = self.bot_data["blocked_index"]
+        del index[bisect.bisect_left(index, user_id)]
+        self.bot_data["state_journal"].delete("blocked_users", user_id)
+        return True
+
+    async def blocked_users(self) -> Set[int]:
+        return set(self.bot_data["blocked_users"])
+
+    async def blocked_index(self) -> List[int]:
+        """Blocked user ids in ascending order; treat as read-only."""
+        return self.bot_data["blocked_index"]
+
+    async def rate_limit(
+        self, checks: Sequence[Tuple[str, int, float]]
+    ) -> Tuple[float, int]:
+        """Charge every (key, max messages, window) check, or none of them.
+
+        Returns (0, -1) if all passed, else (seconds to wait, failing index).
+        """
+        rate_limiter: GCRALimiter = self.bot_data["rate_limiter"]
+        now = time.monotonic()
+        tats = []
+        for index, (key, max_messages, window) in enumerate(checks):
+            tat, wait = rate_limiter.peek(key, max_messages, window, now)
+            if wait:
+                return wait, index
+            tats.append((key, tat))
+        for key, tat in tats:
+            rate_limiter.commit(key, tat)
+        return 0.0, -1
+
+    async def map_message(self, chat_id: int, message_id: int, user_id: int) -> None:
+        now = time.time()
+        key = (chat_id, message_id)
+        self.bot_data["info_message_map"].set(key, user_id, timestamp=now)
+        self.bot_data["state_journal"].put(
+            "group_message_map", (chat_id, message_id, user_id, now)
+        )
+
+    async def lookup_message(self, chat_id: int, message_id: int) -> Optional[int]:
+        return self.bot_data["info_message_map"].get((chat_id, message_id))
+
+    async def forget_message(self, chat_id: int, message_id: int) -> None:
+        key = (chat_id, message_id)
+        if self.bot_data["info_message_map"].pop(key, None) is not None:
+            self.bot_data["state_journal"].delete("group_message_map", key)
+
+    async def topic_for_user(self, user_id: int, chat_id: int) -> Optional[int]:
+        topic = self.bot_data["user_topics"].get(user_id)
+        return topic[1] if topic and topic[0] == chat_id else None
+
+    async def user_for_topic(self, chat_id: int, thread_id: int) -> Optional[int]:
+        return self.bot_data["topic_users"].get((chat_id, thread_id))
+
+    async def map_topic(self, user_id: int, chat_id: int, thread_id: int) -> int:
+        """Give the user this topic unless they have one in that group; returns theirs.
+
+        A topic in another group (the user was moved) is replaced.
+        """
+        current = self.bot_data["user_topics"].get(user_id)
+        if current and current[0] == chat_id:
+            return current[1]
+        if current:
+            self.bot_data["topic_users"].pop(current, None)
+        self.bot_data["user_topics"][user_id] = (chat_id, thread_id)
+        self.bot_data["topic_users"][(chat_id, thread_id)] = user_id
+        self.bot_data["state_journal"].put(
+            "user_topics", (user_id, chat_id, thread_id, time.time())
+        )
+        return thread_id
+
+    async def forget_topic(self, user_id: int, chat_id: int, thread_id: int) -> None:
+        if self.bot_data["user_topics"].get(user_id) != (chat_id, thread_id):
+            return
+        del self.bot_data["user_topics"][user_id]
+        self.bot_data["topic_users"].pop((chat_id, thread_id), None)
+        self.bot_data["state_journal"].delete("user_topics", user_id)
+
+    async def group_for_user(self, user_id: int) -> Optional[int]:
+        groups: BoundedTTLMap = self.bot_data["user_groups"]
+        group = groups.get(user_id)
+        store: Optional[StateStore] = self.bot_data.get("state_store")
+        if group is None and store is not None:
+            # Memory holds the recent assignments only, the store all of them
+            group = await asyncio.to_thread(store.group_for_user, user_id)
+            if group is not None:
+                groups[user_id] = group
+        return group
+
+    async def assign_group(self, user_id: int, chat_id: int) -> None:
+        self.bot_data["user_groups"][user_id] = chat_id
+        self.bot_data["state_journal"].put(
+            "user_groups", (user_id, chat_id, time.time())
+        )
+
+    async def maintenance(self) -> None:
+        self.bot_data["info_message_map"].purge_expired()
+        self.bot_data["rate_limiter"].purge_expired()
+
+    async def stats(self) -> Dict[str, int]:
+        return {
+            "blocked_users": len(self.bot_data["blocked_users"]),
+            "info_message_map": len(self.bot_data["info_message_map"]),
+            "user_topics": len(self.bot_data["user_topics"]),
+        }
+
+    def close(self) -> None:
+        pass
+
+
+class SQLiteSharedState(LocalState):
+    """Blocklist, reply map and rate limits shared through one SQLite file.
+
+    Safe for several bot processes: every operation is its own short
+    transaction, and rate limits are checked and charged under BEGIN
+    IMMEDIATE so two processes can't both take the last slot. Rate limits
+    use wall-clock time here, since monotonic clocks aren't comparable
+    across processes. Blocked-user checks are answered from a local copy
+    that is reloaded whenever the stored blocklist version moves.
+    """
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS rate_limits (key TEXT PRIMARY KEY, tat REAL NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS user_topics_chat_thread "
+        "ON user_topics (chat_id, thread_id)",
+    )
+
+    def __init__(self, path: str) -> None:
+        self._conn = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None
+        )
+        self._lock = threading.Lock()
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+        for table in ("blocked_users", "group_message_map", "user_topics", "user_groups"):
+            self._conn.execute(STATE_SCHEMA[table][0])
+        for create_sql in self.SCHEMA:
+            self._conn.execute(create_sql)
+        self._blocked: Set[int] = set()
+        self._blocked_index: List[int] = []
+        self._blocked_version = -1
+        self._blocked_checked_at = float("-inf")
+
+    async def _call(self, func: Callable[..., Any], *args: Any) -> Any:
+        def locked() -> Any:
+            with self._lock:
+                return func(*args)
+
+        return await asyncio.to_thread(locked)
+
+    def _refresh_blocklist(self) -> None:
+        row = self._conn.execute(
+            "SELECT value FROM meta WHERE key = 'blocklist_version'"
+        ).fetchone()
+        version = row[0] if row else 0
+        if version != self._blocked_version:
+            self._blocked_index = [
+                user_id
+                for (user_id,) in self._conn.execute(
+                    "SELECT user_id FROM blocked_users ORDER BY user_id"
+                )
+            ]
+            self._blocked = set(self._blocked_index)
+            self._blocked_version = version
+        self._blocked_checked_at = time.monotonic()
+
+    def _set_blocked(self, user_id: int, blocked: bool) -> bool:
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            if blocked:
+                cursor = self._conn.execute(
+                    "INSERT OR IGNORE INTO blocked_users (user_id) VALUES (?)",
+                    (user_id,),
+                )
+            else:
+                cursor = self._conn.execute(
+                    "DELETE FROM blocked_users WHERE user_id = ?", (user_id,)
+                )
+            changed = cursor.rowcount > 0
+            if changed:
+                self._conn.execute(
+                    "INSERT INTO meta (key, value) VALUES ('blocklist_version', 1) "
+                    "ON CONFLICT(key) DO UPDATE SET value = value + 1"
+                )
+            self._conn.execute("COMMIT")
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        self._refresh_blocklist()
+        return changed
+
+    async def is_blocked(self, user_id: int) -> bool:
+        elapsed = time.monotonic() - self._blocked_checked_at
+        if elapsed >= SHARED_BLOCKLIST_CACHE_SECONDS:
+            await self._call(self._refresh_blocklist)
+        return user_id in self._blocked
+
+    async def block(self, user_id: int) -> None:
+        await self._call(self._set_blocked, user_id, True)
+
+    async def unblock(self, user_id: int) -> bool:
+        return await self._call(self._set_blocked, user_id, False)
+
+    async def blocked_users(self) -> Set[int]:
+        await self._call(self._refresh_blocklist)
+        return set(self._blocked)
+
+    async def blocked_index(self) -> List[int]:
+        await self._call(self._refresh_blocklist)
+        return self._blocked_index
+
+    def _rate_limit(
+        self, checks: Sequence[Tuple[str, int, float]], now: float
+    ) -> Tuple[float, int]:
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            tats = []
+            for index, (key, max_messages, window) in enumerate(checks):
+                row = self._conn.execute(
+                    "SELECT tat FROM rate_limits WHERE key = ?", (key,)
+                ).fetchone()
+                tat, wait = gcra_step(row and row[0], max_messages, window, now)
+                if wait:
+                    self._conn.execute("ROLLBACK")
+                    return wait, index
+                tats.append((key, tat))
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO rate_limits (key, tat) VALUES (?, ?)", tats
+            )
+            self._conn.execute("COMMIT")
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        return 0.0, -1
+
+    async def rate_limit(
+        self, checks: Sequence[Tuple[str, int, float]]
+    ) -> Tuple[float, int]:
+        return await self._call(self._rate_limit, checks, time.time())
+
+    async def map_message(self, chat_id: int, message_id: int, user_id: int) -> None:
+        await self._call(
+            self._conn.execute,
+            "INSERT OR REPLACE INTO group_message_map "
+            "(chat_id, message_id, user_id, created_at) VALUES (?, ?, ?, ?)",
+            (chat_id, message_id, user_id, time.time()),
+        )
+
+    def _lookup_message(self, chat_id: int, message_id: int) -> Optional[int]:
+        row = self._conn.execute(
+            "SELECT user_id FROM group_message_map "
+            "WHERE chat_id = ? AND message_id = ? AND created_at >= ?",
+            (chat_id, message_id, time.time() - INFO_MESSAGE_MAP_TTL_SECONDS),
+        ).fetchone()
+        return row[0] if row else None
+
+    async def lookup_message(self, chat_id: int, message_id: int) -> Optional[int]:
+        return await self._call(self._lookup_message, chat_id, message_id)
+
+    async def forget_message(self, chat_id: int, message_id: int) -> None:
+        await self._call(
+            self._conn.execute,
+            "DELETE FROM group_message_map WHERE chat_id = ? AND message_id = ?",
+            (chat_id, message_id),
+        )
+
+    def _fetch_one(self, sql: str, params: Tuple[Any, ...]) -> Optional[int]:
+        row = self._conn.execute(sql, params).fetchone()
+        return row[0] if row else None
+
+    async def topic_for_user(self, user_id: int, chat_id: int) -> Optional[int]:
+        return await self._call(
+            self._fetch_one,
+            "SELECT thread_id FROM user_topics WHERE user_id = ? AND chat_id = ?",
+            (user_id, chat_id),
+        )
+
+    async def user_for_topic(self, chat_id: int, thread_id: int) -> Optional[int]:
+        return await self._call(
+            self._fetch_one,
+            "SELECT user_id FROM user_topics WHERE chat_id = ? AND thread_id = ?",
+            (chat_id, thread_id),
+        )
+
+    def _map_topic(self, user_id: int, chat_id: int, thread_id: int) -> int:
+        # Autocommit: the upsert and the read-back are each atomic, and a row
+        # only changes through forget_topic or a move to another group
+        self._conn.execute(
+            "INSERT INTO user_topics (user_id, chat_id, thread_id, created_at) "
+            "VALUES (?, ?, ?, ?) ON CONFLICT (user_id) DO UPDATE SET "
+            "chat_id = excluded.chat_id, thread_id = excluded.thread_id, "
+            "created_at = excluded.created_at "
+            "WHERE user_topics.chat_id IS NOT excluded.chat_id",
+            (user_id, chat_id, thread_id, time.time()),
+        )
+        return self._fetch_one(
+            "SELECT thread_id FROM user_topics WHERE user_id = ? AND chat_id = ?",
+            (user_id, chat_id),
+        )
+
+    async def map_topic(self, user_id: int, chat_id: int, thread_id: int) -> int:
+        return await self._call(self._map_topic, user_id, chat_id, thread_id)
+
+    async def forget_topic(self, user_id: int, chat_id: int, thread_id: int) -> None:
+        await self._call(
+            self._conn.execute,
+            "DELETE FROM user_topics WHERE user_id = ? AND chat_id = ? AND thread_id = ?",
+            (user_id, chat_id, thread_id),
+        )
+
+    async def group_for_user(self, user_id: int) -> Optional[int]:
+        return await self._call(
+            self._fetch_one,
+            "SELECT chat_id FROM user_groups WHERE user_id = ?",
+            (user_id,),
+        )
+
+    async def assign_group(self, user_id: int, chat_id: int) -> None:
+        await self._call(
+            self._conn.execute,
+            "INSERT OR REPLACE INTO user_groups (user_id, chat_id, updated_at) "
+            "VALUES (?, ?, ?)",
+            (user_id, chat_id, time.time()),
+        )
+
+    def _prune(self) -> None:
+        now = time.time()
+        self._conn.execute(
+            "DELETE FROM group_message_map WHERE created_at < ?",
+            (now - INFO_MESSAGE_MAP_TTL_SECONDS,),
+        )
+        # A key whose TAT has passed behaves exactly like a missing one
+        self._conn.execute("DELETE FROM rate_limits WHERE tat < ?", (now,))
+
+    async def maintenance(self) -> None:
+        await self._call(self._prune)
+
+    def _count_mappings(self) -> int:
+        return self._conn.execute(
+            "SELECT COUNT(*) FROM group_message_map WHERE created_at >= ?",
+            (time.time() - INFO_MESSAGE_MAP_TTL_SECONDS,),
+        ).fetchone()[0]
+
+    async def stats(self) -> Dict[str, int]:
+        return {
+            "blocked_users": len(self._blocked),
+            "info_message_map": await self._call(self._count_mappings),
+            "user_topics": await self._call(
+                self._fetch_one, "SELECT COUNT(*) FROM user_topics", ()
+            ),
+        }
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class ConversationArchive:
+    """Append-only record of delivered messages with a full-text index.
+
+    Rows are never updated or deleted, so the FTS5 index is an
+    external-content table filled by an insert trigger and each text is
+    stored once. /history pages through one user's rows via the
+    (user_id, id) index; exports walk the table in id order, a batch at a
+    time, so neither reads the whole archive.
+    """
+
+    COLUMNS = (
+        "user_id",
+        "direction",
+        "kind",
+        "file_id",
+        "text",
+        "chat_id",
+        "message_id",
+        "sender_id",
+        "group_id",
+        "sent_at",
+        "archived_at",
+    )
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS messages ("
+        "id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL, direction TEXT NOT NULL, "
+        "kind TEXT NOT NULL, file_id TEXT, text TEXT, chat_id INTEGER NOT NULL, "
+        "message_id INTEGER NOT NULL, sender_id INTEGER, group_id INTEGER, "
+        "sent_at REAL NOT NULL, archived_at REAL NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS messages_user ON messages (user_id, id)",
+        "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts "
+        "USING fts5(text, content='messages', content_rowid='id')",
+        "CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages "
+        "WHEN new.text IS NOT NULL BEGIN "
+        "INSERT INTO messages_fts (rowid, text) VALUES (new.id, new.text); END",
+    )
+
+    def __init__(self, path: str) -> None:
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+        with self._conn:
+            for statement in self.SCHEMA:
+                self._conn.execute(statement)
+
+    def append(self, rows: List[Tuple[Any, ...]]) -> None:
+        placeholders = ", ".join("?" for _ in self.COLUMNS)
+        with self._lock, self._conn:
+            self._conn.executemany(
+                f"INSERT INTO messages ({', '.join(self.COLUMNS)}) "
+                f"VALUES ({placeholders})",
+                rows,
+            )
+
+    @staticmethod
+    def match_expression(query: str) -> str:
+        """FTS5 query matching every word of ``query`` (as a prefix).
+
+        Words are quoted, so operators and punctuation typed by admins are
+        searched for rather than parsed.
+        """
+        return " ".join(
+            '"' + word.replace('"', '""') + '"*' for word in query.split()
+        )
+
+    def history(
+        self, user_id: int, query: Optional[str], offset: int, limit: int
+    ) -> Tuple[int, List[sqlite3.Row]]:
+        """One page of a user's messages, newest first, and the total count."""
+        if query and query.split():
+            source = (
+                "FROM messages_fts JOIN messages ON messages.id = messages_fts.rowid "
+                "WHERE messages_fts MATCH ? AND messages.user_id = ?"
+            )
+            params: Tuple[Any, ...] = (self.match_expression(query), user_id)
+        else:
+            source = "FROM messages WHERE user_id = ?"
+            params = (user_id,)
+        with self._lock:
+            total = self._conn.execute(f"SELECT COUNT(*) {source}", params).fetchone()[0]
+            rows = self._conn.execute(
+                f"SELECT messages.* {source} ORDER BY messages.id DESC LIMIT ? OFFSET ?",
+                params + (limit, offset),
+            ).fetchall()
+        return total, rows
+
+    def iter_rows(
+        self, user_id: Optional[int] = None, batch_size: int = ARCHIVE_EXPORT_BATCH_SIZE
+    ) -> Iterator[Dict[str, Any]]:
+        """Yield rows oldest first, reading ``batch_size`` at a time.
+
+        Each batch resumes after the last id seen, so rows archived while
+        the export runs are included and the lock is never held for long.
+        """
+        where = "id > ?" if user_id is None else "user_id = ? AND id > ?"
+        last_id = 0
+        while True:
+            params = (last_id,) if user_id is None else (user_id, last_id)
+            with self._lock:
+                rows = self._conn.execute(
+                    f"SELECT * FROM messages WHERE {where} ORDER BY id LIMIT ?",
+                    params + (batch_size,),
+                ).fetchall()
+            if not rows:
+                return
+            for row in rows:
+                yield dict(row)
+            last_id = rows[-1]["id"]
+
+    def export_jsonl(self, stream, user_id: Optional[int] = None) -> int:
+        """Write the archive (or one user's part) to ``stream``, a row per line."""
+        count = 0
+        for row in self.iter_rows(user_id):
+            stream.write(json.dumps(row, ensure_ascii=False) + "\n")
+            count += 1
+        return count
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+def provision_bot_data(bot_data: Dict[str, Any]) -> Dict[str, Any]:
+    if "state_journal" not in bot_data:
+        journal = bot_data["state_journal"] = StateJournal()
+        bot_data["state_owner"] = uuid.uuid4().hex
+        bot_data["blocked_users"] = set()
+        bot_data["blocked_index"] = []
+        bot_data["rate_limiter"] = GCRALimiter(
+            RATE_LIMITER_MAX_USERS,
+            idle_ttl=max(
+                GLOBAL_RATE_LIMIT_WINDOW_SECONDS,
+                *(window for _, window in RATE_LIMIT_TIERS.values()),
+            ),
+        )
+        # Evicted reply mappings are deleted from the store as well. User info
+        # rows stay: the store keeps every known user, memory only the recent.
+        bot_data["info_message_map"] = BoundedTTLMap(
+            INFO_MESSAGE_MAP_MAX_SIZE,
+            ttl=INFO_MESSAGE_MAP_TTL_SECONDS,
+            on_evict=lambda key, _: journal.delete("group_message_map", key),
+        )
+        bot_data["user_info"] = BoundedTTLMap(USER_INFO_MAX_SIZE)
+        bot_data["admin_cache"] = BoundedTTLMap(
+            ADMIN_CACHE_MAX_SIZE, ttl=ADMIN_CACHE_TTL_SECONDS, clock=time.monotonic
+        )
+        bot_data["album_batcher"] = MessageBatcher(
+            MEDIA_GROUP_WINDOW_SECONDS, flush_album
+        )
+        bot_data["text_batcher"] = MessageBatcher(
+            TEXT_BURST_WINDOW_SECONDS, flush_text_burst
+        )
+        bot_data["state"] = LocalState(bot_data)
+        bot_data.setdefault("metrics", Metrics())
+        bot_data.setdefault("load", LoadController())
+        bot_data["unreachable_users"] = set()
+        bot_data["broadcasts"] = {}
+        bot_data["outbox"] = Outbox(bot_data)
+        bot_data["user_topics"] = {}
+        bot_data["topic_users"] = {}
+        # Like user_info: the store keeps every assignment, memory the recent
+        bot_data["user_groups"] = BoundedTTLMap(USER_INFO_MAX_SIZE)
+        bot_data["recent_content"] = BoundedTTLMap(
+            DEDUP_MAX_ENTRIES, ttl=DEDUP_WINDOW_SECONDS, clock=time.monotonic
+        )
+        bot_data["archive"] = None
+        bot_data["archive_pending"] = []
+    return bot_data
+
+
+def ensure_bot_data(context: ContextTypes.DEFAULT_TYPE) -> Dict[str, Any]:
+    """Provision shared bot data containers."""
+    return provision_bot_data(context.application.bot_data)
+
+
+def get_state(context: ContextTypes.DEFAULT_TYPE) -> LocalState:
+    return ensure_bot_data(context)["state"]
+
+
+async def is_user_blocked(context: ContextTypes.DEFAULT_TYPE, user_id: int) -> bool:
+    return await get_state(context).is_blocked(user_id)
+
+
+async def add_user_to_blocklist(
+    context: ContextTypes.DEFAULT_TYPE, user_id: int
+) -> None:
+    await get_state(context).block(user_id)
+
+
+async def remove_user_from_blocklist(
+    context: ContextTypes.DEFAULT_TYPE, user_id: int
+) -> bool:
+    """Remove a user from the blocklist. Returns True if removed."""
+    return await get_state(context).unblock(user_id)
+
+
+class MessageBatcher:
+    """Collect related messages per key and hand them over as one batch.
+
+    A batch is flushed once its key has been idle for ``window`` seconds,
+    when an item with a different batch id arrives for the same key, or on
+    demand via flush(). Flushing a key also waits for a flush of that key
+    that is already running, so callers can use it to keep messages that
+    follow a batch behind it.
+    """
+
+    def __init__(
+        self,
+        window: float,
+        on_flush: Callable[[Hashable, List[Any]], Awaitable[None]],
+    ) -> None:
+        self.window = window
+        self.on_flush = on_flush
+        # key -> [batch id, items, idle timer task]
+        self._batches: Dict[Hashable, List[Any]] = {}
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+
+    def __len__(self) -> int:
+        return len(self._batches)
+
+    def pending(self, key: Hashable) -> List[Any]:
+        """Items collected for key so far; treat as read-only."""
+        batch = self._batches.get(key)
+        return batch[1] if batch else []
+
+    async def add(self, key: Hashable, item: Any, batch_id: Hashable = None) -> None:
+        batch = self._batches.get(key)
+        if batch is not None and batch[0] != batch_id:
+            await self.flush(key)
+            batch = None
+        if batch is None:
+            batch = self._batches[key] = [batch_id, [], None]
+        batch[1].append(item)
+        if batch[2]:
+            batch[2].cancel()
+        batch[2] = asyncio.create_task(self._flush_when_idle(key))
+
+    async def _flush_when_idle(self, key: Hashable) -> None:
+        await asyncio.sleep(self.window)
+        await self.flush(key)
+
+    async def flush(self, key: Hashable) -> None:
+        batch = self._batches.pop(key, None)
+        if batch is None:
+            inflight = self._inflight.get(key)
+            if inflight:
+                await asyncio.shield(inflight)
+            return
+
+        timer = batch[2]
+        if timer and timer is not asyncio.current_task():
+            timer.cancel()
+        done = self._inflight[key] = asyncio.get_running_loop().create_future()
+        try:
+            await self.on_flush(key, batch[1])
+        except Exception as exc:
+            logger.exception("Failed to flush batch %s: %s", key, exc)
+        finally:
+            done.set_result(None)
+            if self._inflight.get(key) is done:
+                del self._inflight[key]
+
+    async def flush_all(self) -> None:
+        for key in list(self._batches):
+            await self.flush(key)
+
+
+async def is_group_admin(context: ContextTypes.DEFAULT_TYPE, user_id: int) -> bool:
+    """Return True if the user administers any support group.
+
+    Each group's answer is cached; Telegram is asked on a miss.
+    """
+    admin_cache: BoundedTTLMap = ensure_bot_data(context)["admin_cache"]
+    for chat_id in support_groups():
+        is_admin = admin_cache.get((chat_id, user_id))
+        if is_admin is None:
+            member = await context.bot.get_chat_member(chat_id=chat_id, user_id=user_id)
+            is_admin = admin_cache[(chat_id, user_id)] = (
+                member.status in ADMIN_STATUSES
+            )
+        if is_admin:
+            return True
+    return False
+
+
+async def seed_admin_cache(application: Application) -> None:
+    """Bulk-load each group's administrators with a single API call per group."""
+    admin_cache: BoundedTTLMap = application.bot_data["admin_cache"]
+    for chat_id in support_groups():
+        try:
+            admins = await application.bot.get_chat_administrators(chat_id=chat_id)
+        except Exception as exc:
+            logger.warning("Could not seed admin cache for %s: %s", chat_id, exc)
+            continue
+        for member in admins:
+            admin_cache[(chat_id, member.user.id)] = True
+        logger.info(
+            "Seeded admin cache with %d administrators of %s", len(admins), chat_id
+        )
+
+
+async def remember_info_message(
+    bot_data: Dict[str, Any], chat_id: int, message_id: int, user_id: int
+) -> None:
+    """Map a group message (info header or forwarded payload) to its sender."""
+    await bot_data["state"].map_message(chat_id, message_id, user_id)
+
+
+async def lookup_info_message(
+    bot_data: Dict[str, Any], chat_id: int, message_id: int
+) -> Optional[int]:
+    return await bot_data["state"].lookup_message(chat_id, message_id)
+
+
+async def forget_info_message(
+    bot_data: Dict[str, Any], chat_id: int, message_id: int
+) -> None:
+    await bot_data["state"].forget_message(chat_id, message_id)
+
+
+def support_groups() -> Tuple[int, ...]:
+    return SUPPORT_GROUP_IDS or (GROUP_CHAT_ID,)
+
+
+def stable_hash(value: str) -> int:
+    """64-bit hash that, unlike hash(), is the same in every process."""
+    digest = hashlib.blake2b(value.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big")
+
+
+@functools.lru_cache(maxsize=4)
+def group_ring(groups: Tuple[int, ...], replicas: int) -> Tuple[List[int], List[int]]:
+    """Consistent-hash ring: sorted point hashes and the group owning each."""
+    points = sorted(
+        (stable_hash(f"{group}:{replica}"), group)
+        for group in groups
+        for replica in range(replicas)
+    )
+    return [point for point, _ in points], [group for _, group in points]
+
+
+def preferred_group(user) -> int:
+    """Where a new user goes: a tier or language override, else the hash ring."""
+    groups = support_groups()
+    tier = USER_RATE_LIMIT_TIERS.get(user.id)
+    override = GROUP_TIER_OVERRIDES.get(tier) if tier else None
+    language = (user.language_code or "").lower()
+    if override is None and language:
+        override = GROUP_LANGUAGE_OVERRIDES.get(
+            language, GROUP_LANGUAGE_OVERRIDES.get(language.split("-")[0])
+        )
+    if override in groups:
+        return override
+    points, owners = group_ring(groups, GROUP_HASH_REPLICAS)
+    index = bisect.bisect(points, stable_hash(str(user.id))) % len(points)
+    return owners[index]
+
+
+async def route_user(bot_data: Dict[str, Any], user) -> int:
+    """The support group a user's messages go to, fixed on first contact.
+
+    Users only move if their group is removed from SUPPORT_GROUP_IDS.
+    """
+    state: LocalState = bot_data["state"]
+    group = await state.group_for_user(user.id)
+    if group not in support_groups():
+        group = preferred_group(user)
+        await state.assign_group(user.id, group)
+    return group
+
+
+def remember_user_info(bot_data: Dict[str, Any], user) -> None:
+    # Writing to us means they can be reached again
+    if user.id in bot_data["unreachable_users"]:
+        bot_data["unreachable_users"].discard(user.id)
+        bot_data["state_journal"].delete("unreachable_users", user.id)
+    info = {"username": user.username, "full_name": user.full_name}
+    if bot_data["user_info"].get(user.id) == info:
+        return
+    bot_data["user_info"][user.id] = info
+    bot_data["state_journal"].put(
+        "user_info", (user.id, user.username, user.full_name, time.time())
+    )
+
+
+async def flush_state(bot_data: Dict[str, Any]) -> None:
+    """Write pending mutations to the store off the event loop."""
+    journal: StateJournal = bot_data["state_journal"]
+    if not len(journal):
+        return
+    ops = journal.drain()
+    try:
+        await asyncio.to_thread(bot_data["state_store"].write, ops)
+    except Exception as exc:
+        logger.exception("Failed to flush %d state changes: %s", len(ops), exc)
+        journal.restore(ops)
+
+
+# Message fields archived as the message's kind, checked in this order
+# (animations carry a document too, venues a location).
+ARCHIVED_KINDS = (
+    "photo",
+    "video",
+    "animation",
+    "document",
+    "voice",
+    "audio",
+    "sticker",
+    "video_note",
+    "venue",
+    "location",
+    "contact",
+    "poll",
+    "dice",
+)
+
+
+def archive_row(job: Dict[str, Any], data: Dict[str, Any]) -> Tuple[Any, ...]:
+    """A ConversationArchive row for one message of a delivered job."""
+    kind = next((key for key in ARCHIVED_KINDS if key in data), None)
+    attachment = data.get(kind) if kind else None
+    if isinstance(attachment, list):
+        # Photos come as a list of sizes; the last is the largest
+        attachment = attachment[-1] if attachment else None
+    file_id = attachment.get("file_id") if isinstance(attachment, dict) else None
+    return (
+        job["user_id"],
+        "in" if job["kind"] == "forward" else "out",
+        kind or ("text" if "text" in data else "other"),
+        file_id,
+        data.get("text") or data.get("caption"),
+        data["chat"]["id"],
+        data["message_id"],
+        (data.get("from") or {}).get("id"),
+        job.get("group_id"),
+        data["date"],
+        time.time(),
+    )
+
+
+def archive_job(bot_data: Dict[str, Any], job: Dict[str, Any]) -> None:
+    """Queue a delivered forward or reply for the archive's next flush."""
+    if bot_data["archive"] is None:
+        return
+    bot_data["archive_pending"].extend(
+        archive_row(job, data) for data in job["messages"]
+    )
+    bot_data["metrics"].inc(
+        "zapata_archived_messages_total",
+        len(job["messages"]),
+        direction="in" if job["kind"] == "forward" else "out",
+    )
+
+
+async def flush_archive(bot_data: Dict[str, Any]) -> None:
+    archive: Optional[ConversationArchive] = bot_data["archive"]
+    rows = bot_data["archive_pending"]
+    if archive is None or not rows:
+        return
+    bot_data["archive_pending"] = []
+    try:
+        await asyncio.to_thread(archive.append, rows)
+    except Exception as exc:
+        logger.exception("Failed to archive %d messages: %s", len(rows), exc)
+        bot_data["archive_pending"] = rows + bot_data["archive_pending"]
+
+
+async def state_flush_loop(bot, bot_data: Dict[str, Any]) -> None:
+    while True:
+        await asyncio.sleep(STATE_FLUSH_INTERVAL_SECONDS)
+        try:
+            await bot_data["state"].maintenance()
+            bot_data["recent_content"].purge_expired()
+        except Exception as exc:
+            logger.exception("State maintenance failed: %s", exc)
+        await flush_state(bot_data)
+        await flush_archive(bot_data)
+        if STATE_BACKEND == "sqlite-shared":
+            # Also the heartbeat that keeps other processes off our work
+            try:
+                await resume_orphaned_work(
+                    bot, bot_data, time.time() - STATE_OWNER_TIMEOUT_SECONDS
+                )
+            except Exception as exc:
+                logger.exception("Claiming orphaned work failed: %s", exc)
+
+
+class RateLimitDecision(NamedTuple):
+    allowed: bool
+    retry_after: float = 0.0
+    scope: str = "user"
+
+
+async def track_rate_limit(
+    context: ContextTypes.DEFAULT_TYPE, user_id: int
+) -> RateLimitDecision:
+    """Charge one message to the user's tier and to the global limit.
+
+    Nothing is charged unless both limits allow the message.
+    """
+    tier = USER_RATE_LIMIT_TIERS.get(user_id, "default")
+    max_messages, window = RATE_LIMIT_TIERS[tier]
+    wait, failed = await get_state(context).rate_limit(
+        [
+            (f"user:{user_id}", max_messages, window),
+            ("global", GLOBAL_RATE_LIMIT_MAX_MESSAGES, GLOBAL_RATE_LIMIT_WINDOW_SECONDS),
+        ]
+    )
+    if failed < 0:
+        return RateLimitDecision(True)
+    return RateLimitDecision(False, wait, "user" if failed == 0 else "global")
+
+
+def update_ordering_key(update: object) -> Optional[Hashable]:
+    """Return the key whose updates must be handled in arrival order."""
+    if callable(UPDATE_ORDERING_KEY):
+        return UPDATE_ORDERING_KEY(update)
+    if not isinstance(update, Update):
+        return None
+    if UPDATE_ORDERING_KEY == "chat":
+        chat = update.effective_chat
+        return ("chat", chat.id) if chat else None
+    if UPDATE_ORDERING_KEY != "user":
+        raise ValueError(f"Unknown update ordering key: {UPDATE_ORDERING_KEY!r}")
+
+    message = update.effective_message
+    if message and message.is_topic_message and THREADING_MODE == "topics":
+        return ("topic", message.chat.id, message.message_thread_id)
+    if message and message.chat.type != "private" and message.reply_to_message:
+        return ("thread", message.chat.id, message.reply_to_message.message_id)
+    user = update.effective_user
+    return ("user", user.id) if user else None
+
+
+class OrderedUpdateProcessor(BaseUpdateProcessor):
+    """Run up to ``max_concurrent_updates`` handlers at once, in order per key.
+
+    Updates first queue on a per-key lock (asyncio locks wake waiters in FIFO
+    order) and only then take one of the processing slots, so a burst from
+    one user waits its turn without holding slots other users could use.
+    The base class semaphore only caps how many updates may be pending.
+    """
+
+    def __init__(
+        self,
+        max_concurrent_updates: int,
+        key_func: Callable[[object], Optional[Hashable]] = update_ordering_key,
+        on_update: Optional[Callable[[object], None]] = None,
+    ) -> None:
+        super().__init__(max(UPDATE_MAX_PENDING, max_concurrent_updates))
+        self._key_func = key_func
+        self._on_update = on_update
+        self._slots = asyncio.Semaphore(max_concurrent_updates)
+        self._locks: Dict[Hashable, List[Any]] = {}
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        # Called as updates arrive, before they wait for their key or a slot
+        if self._on_update is not None:
+            self._on_update(update)
+        key = self._key_func(update)
+        if key is None:
+            async with self._slots:
+                await coroutine
+            return
+
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                async with self._slots:
+                    await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+
+def retry_after_seconds(exc: RetryAfter) -> float:
+    retry_after = exc.retry_after
+    if isinstance(retry_after, timedelta):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+
+class TokenBucket:
+    """Classic token bucket on the monotonic clock."""
+
+    __slots__ = ("rate", "capacity", "tokens", "stamp", "paused_until")
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.stamp = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def delay(self, now: float) -> float:
+        """Seconds until a token is available (0 if one is available now)."""
+        self._refill(now)
+        wait = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        return max(wait, self.paused_until - now)
+
+    def consume(self, now: float) -> None:
+        self._refill(now)
+        self.tokens -= 1
+
+    def pause(self, until: float) -> None:
+        self.paused_until = max(self.paused_until, until)
+
+
+class _OutboundJob:
+    __slots__ = (
+        "priority",
+        "seq",
+        "chat_key",
+        "callback",
+        "args",
+        "kwargs",
+        "endpoint",
+        "future",
+        "attempts",
+        "created",
+        "target_chat",
+    )
+
+    def __init__(self, priority, seq, chat_key, callback, args, kwargs, endpoint):
+        self.priority = priority
+        self.seq = seq
+        self.chat_key = chat_key
+        self.callback = callback
+        self.args = args
+        self.kwargs = kwargs
+        self.endpoint = endpoint
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.attempts = 0
+        self.created = time.monotonic()
+        self.target_chat: Any = None
+
+
+class OutboundScheduler(BaseRateLimiter):
+    """Central send scheduler plugged in as the bot's rate limiter.
+
+    Requests are queued per chat in priority order (see the PRIORITY_*
+    constants, passed as ``rate_limit_args={"priority": ...}``). A dispatcher
+    picks the best request among chats whose bucket has a token, subject to
+    the global bucket, so one flooded group never holds up private replies.
+    On RetryAfter the chat (or everything, for chat-less calls) is paused for
+    the requested time and the request is re-queued in its original place.
+
+    Chat actions are fire-and-forget: the caller returns at once and the
+    action is sent immediately when the scheduler is idle. Otherwise it
+    waits in the lowest lane and is dropped if it goes stale or a message
+    to the same chat is sent first.
+    """
+
+    def __init__(self) -> None:
+        self._global = TokenBucket(OUTBOUND_GLOBAL_RATE, OUTBOUND_GLOBAL_BURST)
+        self._buckets = BoundedTTLMap(100_000, ttl=600, clock=time.monotonic)
+        self._queues: Dict[Hashable, List[Tuple[int, int, _OutboundJob]]] = {}
+        self._ready: List[Tuple[int, int, Hashable]] = []
+        self._timers: List[Tuple[float, int, Hashable]] = []
+        # chat key -> seq of the queue head that has a ready/timer entry
+        self._scheduled: Dict[Hashable, int] = {}
+        self._seq = itertools.count()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._dispatcher: Optional[asyncio.Task] = None
+        # Calls in flight; the event loop only keeps weak references to tasks
+        self._tasks: Set[asyncio.Task] = set()
+        self.queue_depth = 0
+        self.retries = 0
+        # chat id -> when a message to it was last dispatched
+        self._last_message_at = BoundedTTLMap(
+            100_000, ttl=OUTBOUND_CHAT_ACTION_MAX_AGE_SECONDS, clock=time.monotonic
+        )
+
+    async def initialize(self) -> None:
+        # The bot may be initialized more than once (application and updater)
+        if self._dispatcher:
+            return
+        self._wakeup = asyncio.Event()
+        self._dispatcher = asyncio.create_task(self._dispatch_loop())
+
+    async def shutdown(self) -> None:
+        if self._dispatcher:
+            self._dispatcher.cancel()
+            try:
+                await self._dispatcher
+            except asyncio.CancelledError:
+                pass
+            self._dispatcher = None
+        for pending in self._queues.values():
+            for _, _, job in pending:
+                if not job.future.done():
+                    job.future.cancel()
+        self._queues.clear()
+        self.queue_depth = 0
+
+    def chat_queue_depth(self, chat_id: int) -> int:
+        return len(self._queues.get(chat_id, ()))
+
+    @staticmethod
+    def _chat_id(data: Dict[str, Any]) -> Optional[int]:
+        try:
+            return int(data.get("chat_id"))
+        except (TypeError, ValueError):
+            return None
+
+    @classmethod
+    def _chat_key(cls, endpoint: str, data: Dict[str, Any]) -> Optional[int]:
+        """Per-chat limits apply to messages only, not actions or queries."""
+        if endpoint == "sendChatAction" or not endpoint.startswith(
+            ("send", "copy", "forward")
+        ):
+            return None
+        return cls._chat_id(data)
+
+    def _spawn(self, coro: Awaitable[Any]) -> asyncio.Task:
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    def _bucket(self, chat_key: Optional[int]) -> Optional[TokenBucket]:
+        if chat_key is None:
+            return None
+        bucket = self._buckets.get(chat_key)
+        if bucket is None:
+            if chat_key < 0:
+                bucket = TokenBucket(OUTBOUND_GROUP_CHAT_RATE, OUTBOUND_GROUP_CHAT_BURST)
+            else:
+                bucket = TokenBucket(
+                    OUTBOUND_PRIVATE_CHAT_RATE, OUTBOUND_PRIVATE_CHAT_BURST
+                )
+        # Re-inserting keeps buckets of active chats from idling out
+        self._buckets[chat_key] = bucket
+        return bucket
+
+    def _schedule(self, chat_key: Optional[int]) -> None:
+        pending = self._queues.get(chat_key)
+        if not pending:
+            return
+        priority, seq, _ = pending[0]
+        if self._scheduled.get(chat_key) == seq:
+            return
+        self._scheduled[chat_key] = seq
+        bucket = self._bucket(chat_key)
+        now = time.monotonic()
+        wait = bucket.delay(now) if bucket else 0.0
+        if wait > 0:
+            heapq.heappush(self._timers, (now + wait, seq, chat_key))
+        else:
+            heapq.heappush(self._ready, (priority, seq, chat_key))
+        self._wakeup.set()
+
+    def _unschedule(self, chat_key: Optional[int], seq: int) -> None:
+        if self._scheduled.get(chat_key) == seq:
+            del self._scheduled[chat_key]
+
+    def _enqueue(self, job: _OutboundJob) -> None:
+        heapq.heappush(
+            self._queues.setdefault(job.chat_key, []), (job.priority, job.seq, job)
+        )
+        self.queue_depth += 1
+        self._schedule(job.chat_key)
+
+    async def _dispatch_loop(self) -> None:
+        while True:
+            now = time.monotonic()
+            while self._timers and self._timers[0][0] <= now:
+                _, seq, chat_key = heapq.heappop(self._timers)
+                self._unschedule(chat_key, seq)
+                self._schedule(chat_key)
+
+            if not self._ready:
+                timeout = self._timers[0][0] - now if self._timers else None
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            wait = self._global.delay(now)
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+
+            priority, seq, chat_key = heapq.heappop(self._ready)
+            self._unschedule(chat_key, seq)
+            pending = self._queues.get(chat_key)
+            if not pending or pending[0][1] != seq:
+                continue  # stale entry, the head was already sent or replaced
+            bucket = self._bucket(chat_key)
+            if bucket and bucket.delay(now) > 0:
+                self._schedule(chat_key)
+                continue
+
+            _, _, job = heapq.heappop(pending)
+            self.queue_depth -= 1
+            if not pending:
+                del self._queues[chat_key]
+            else:
+                self._schedule(chat_key)
+
+            if job.future.done():
+                continue
+            if job.priority == PRIORITY_ACTION and self._action_is_stale(job, now):
+                job.future.set_result(True)
+                continue
+            self._global.consume(now)
+            if bucket:
+                bucket.consume(now)
+                self._last_message_at[chat_key] = now
+            self._spawn(self._run(job))
+
+    def _action_is_stale(self, job: _OutboundJob, now: float) -> bool:
+        """True if a queued chat action expired or a message overtook it."""
+        if now - job.created > OUTBOUND_CHAT_ACTION_MAX_AGE_SECONDS:
+            return True
+        last_message_at = self._last_message_at.get(job.target_chat)
+        return last_message_at is not None and last_message_at >= job.created
+
+    async def _run(self, job: _OutboundJob) -> None:
+        try:
+            result = await job.callback(*job.args, **job.kwargs)
+        except RetryAfter as exc:
+            delay = retry_after_seconds(exc) + 0.1
+            if job.attempts >= OUTBOUND_MAX_RETRIES:
+                logger.warning(
+                    "Giving up on %s after %d retries", job.endpoint, job.attempts
+                )
+                if not job.future.done():
+                    job.future.set_exception(exc)
+                return
+            job.attempts += 1
+            self.retries += 1
+            logger.info("Flood control on %s, retrying in %.1fs", job.endpoint, delay)
+            paused = self._bucket(job.chat_key) or self._global
+            paused.pause(time.monotonic() + delay)
+            self._enqueue(job)
+        except Exception as exc:
+            if not job.future.done():
+                job.future.set_exception(exc)
+        else:
+            if not job.future.done():
+                job.future.set_result(result)
+
+    async def process_request(
+        self,
+        callback: Callable[..., Awaitable[Any]],
+        args: Any,
+        kwargs: Dict[str, Any],
+        endpoint: str,
+        data: Dict[str, Any],
+        rate_limit_args: Optional[Dict[str, Any]],
+    ) -> Any:
+        if endpoint == "sendChatAction":
+            # Sent right away when nothing else is waiting, otherwise queued
+            # in the lowest lane; the caller never waits for it.
+            now = time.monotonic()
+            if not self.queue_depth and not self._global.delay(now):
+                self._global.consume(now)
+                task = self._spawn(callback(*args, **kwargs))
+                task.add_done_callback(_log_failed_chat_action)
+                return True
+            priority = PRIORITY_ACTION
+        elif rate_limit_args and "priority" in rate_limit_args:
+            priority = rate_limit_args["priority"]
+        elif endpoint.startswith(("answer", "get", "edit")):
+            # Interactive and cheap: callback answers, lookups, markup edits
+            priority = PRIORITY_REPLY
+        else:
+            priority = PRIORITY_ACK
+
+        job = _OutboundJob(
+            priority,
+            next(self._seq),
+            self._chat_key(endpoint, data),
+            callback,
+            args,
+            kwargs,
+            endpoint,
+        )
+        # Same key type as _last_message_at; chat_id may arrive as a string
+        job.target_chat = self._chat_id(data)
+        self._enqueue(job)
+        if priority == PRIORITY_ACTION:
+            job.future.add_done_callback(_log_failed_chat_action)
+            return True
+        return await job.future
+
+
+class InstrumentedRequest(BaseRequest):
+    """Wraps the bot's HTTP layer to time every Bot API call by method."""
+
+    def __init__(self, request: BaseRequest, metrics: Metrics) -> None:
+        self.request = request
+        self.metrics = metrics
+
+    @property
+    def read_timeout(self) -> Optional[float]:
+        return self.request.read_timeout
+
+    async def initialize(self) -> None:
+        await self.request.initialize()
+
+    async def shutdown(self) -> None:
+        await self.request.shutdown()
+
+    async def do_request(
+        self,
+        url: str,
+        method: str,
+        request_data: Optional[RequestData] = None,
+        read_timeout: Any = BaseRequest.DEFAULT_NONE,
+        write_timeout: Any = BaseRequest.DEFAULT_NONE,
+        connect_timeout: Any = BaseRequest.DEFAULT_NONE,
+        pool_timeout: Any = BaseRequest.DEFAULT_NONE,
+    ) -> Tuple[int, bytes]:
+        api_method = url.rsplit("/", 1)[-1]
+        started = time.perf_counter()
+        try:
+            code, payload = await self.request.do_request(
+                url,
+                method,
+                request_data=request_data,
+                read_timeout=read_timeout,
+                write_timeout=write_timeout,
+                connect_timeout=connect_timeout,
+                pool_timeout=pool_timeout,
+            )
+        except Exception:
+            self.metrics.inc(
+                "zapata_bot_api_errors_total", method=api_method, code="network"
+            )
+            raise
+        finally:
+            self.metrics.observe(
+                "zapata_bot_api_seconds", time.perf_counter() - started, method=api_method
+            )
+        if code >= 300:
+            self.metrics.inc("zapata_bot_api_errors_total", method=api_method, code=code)
+        return code, payload
+
+
+class LoadController:
+    """Tracks how saturated the forward pipeline is; see LOAD_SHED_LEVELS.
+
+    The level is recomputed on every read from the number of forwards in
+    flight and the outbound queue depth, so it drops as soon as the backlog
+    clears.
+    """
+
+    LEVELS = ("normal", "busy", "overloaded", "saturated")
+    SHED_CHAT_ACTIONS, SHED_ACKS, SHED_MESSAGES = 1, 2, 3
+
+    def __init__(self, scheduler: Optional[OutboundScheduler] = None) -> None:
+        self.scheduler = scheduler
+        self.in_flight = 0
+        self._level = 0
+
+    @property
+    def queue_depth(self) -> int:
+        return self.scheduler.queue_depth if self.scheduler else 0
+
+    def load(self) -> float:
+        return max(
+            self.in_flight / LOAD_MAX_IN_FLIGHT_FORWARDS,
+            self.queue_depth / LOAD_MAX_QUEUE_DEPTH,
+        )
+
+    def level(self) -> int:
+        level = bisect.bisect_right(LOAD_SHED_LEVELS, self.load())
+        if level != self._level:
+            log = logger.warning if level > self._level else logger.info
+            log(
+                "Load %s -> %s (%d forwards in flight, %d calls queued)",
+                self.LEVELS[self._level],
+                self.LEVELS[level],
+                self.in_flight,
+                self.queue_depth,
+            )
+            self._level = level
+        return level
+
+    def retry_after(self) -> float:
+        """Rough time for the busiest group's send queue to drain, in seconds."""
+        depth = 0
+        if self.scheduler:
+            depth = max(map(self.scheduler.chat_queue_depth, support_groups()))
+        return max(depth / OUTBOUND_GROUP_CHAT_RATE, 5.0)
+
+    @contextlib.contextmanager
+    def forwarding(self) -> Iterator[None]:
+        self.in_flight += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+
+
+class APICallAccount:
+    """The Bot API calls made while handling one update (or flushing a batch)."""
+
+    def __init__(self, handler: str, update_id: Optional[int] = None) -> None:
+        self.handler = handler
+        self.update_id = update_id
+        self.calls: Counter = Counter()
+
+
+# Set by handler_accounting for the duration of a handler run
+CURRENT_API_ACCOUNT: contextvars.ContextVar[Optional[APICallAccount]] = (
+    contextvars.ContextVar("zapata_api_account", default=None)
+)
+
+
+class BotAPIStage:
+    """One step of the BotAPIPipeline.
+
+    ``handle`` sees every call before it is scheduled, and either passes it
+    on with ``await call_next()`` or answers it itself.
+    """
+
+    async def handle(
+        self,
+        endpoint: str,
+        data: Dict[str, Any],
+        call_next: Callable[[], Awaitable[Any]],
+    ) -> Any:
+        return await call_next()
+
+
+class ChatActionCoalescer(BotAPIStage):
+    """Skip chat actions to a chat (or topic) that just got one."""
+
+    def __init__(self, metrics: Metrics, window: float) -> None:
+        self.metrics = metrics
+        self._sent = BoundedTTLMap(100_000, ttl=window, clock=time.monotonic)
+
+    async def handle(self, endpoint, data, call_next):
+        if endpoint != "sendChatAction":
+            return await call_next()
+        key = (str(data.get("chat_id")), data.get("message_thread_id"))
+        if key in self._sent:
+            self.metrics.inc("zapata_bot_api_skipped_total", method=endpoint)
+            return True
+        self._sent[key] = True
+        return await call_next()
+
+
+class LoadShedding(BotAPIStage):
+    """Drop chat actions while the bot is past the first load level."""
+
+    def __init__(self, load: LoadController, metrics: Metrics) -> None:
+        self.load = load
+        self.metrics = metrics
+
+    async def handle(self, endpoint, data, call_next):
+        if (
+            endpoint == "sendChatAction"
+            and self.load.level() >= LoadController.SHED_CHAT_ACTIONS
+        ):
+            self.metrics.inc("zapata_load_shed_total", step="chat_action")
+            return True
+        return await call_next()
+
+
+class UpdateAccounting(BotAPIStage):
+    """Count each call against the handler run that made it."""
+
+    async def handle(self, endpoint, data, call_next):
+        account = CURRENT_API_ACCOUNT.get()
+        if account is not None:
+            account.calls[endpoint] += 1
+        return await call_next()
+
+
+class APITracer(BotAPIStage):
+    """Report every call to hooks once it completes.
+
+    Hooks are called as ``hook(endpoint, data, result, error, seconds)``;
+    ``seconds`` includes time spent waiting in the outbound scheduler.
+    A failing hook is logged and doesn't affect the call.
+    """
+
+    def __init__(self) -> None:
+        self.hooks: List[Callable[..., None]] = []
+
+    def add_hook(self, hook: Callable[..., None]) -> None:
+        self.hooks.append(hook)
+
+    async def handle(self, endpoint, data, call_next):
+        if not self.hooks:
+            return await call_next()
+        started = time.perf_counter()
+        result: Any = None
+        error: Optional[BaseException] = None
+        try:
+            result = await call_next()
+            return result
+        except Exception as exc:
+            error = exc
+            raise
+        finally:
+            seconds = time.perf_counter() - started
+            for hook in self.hooks:
+                try:
+                    hook(endpoint, data, result, error, seconds)
+                except Exception as exc:
+                    logger.exception("Bot API trace hook failed: %s", exc)
+
+
+def log_api_call(
+    endpoint: str,
+    data: Dict[str, Any],
+    result: Any,
+    error: Optional[BaseException],
+    seconds: float,
+) -> None:
+    """APITracer hook for BOT_API_TRACE."""
+    account = CURRENT_API_ACCOUNT.get()
+    logger.info(
+        "Bot API %s chat=%s %.1fms handler=%s update=%s%s",
+        endpoint,
+        data.get("chat_id"),
+        seconds * 1000,
+        account.handler if account else "-",
+        account.update_id if account else "-",
+        f" error={error!r}" if error else "",
+    )
+
+
+def gzip_rotate(source: str, dest: str) -> None:
+    """RotatingFileHandler rotator that compresses the file it rotates out."""
+    with open(source, "rb") as src, gzip.open(dest, "wb") as dst:
+        shutil.copyfileobj(src, dst)
+    os.remove(source)
+
+
+def capture_default(value: Any) -> Any:
+    """json.dumps fallback for call parameters (markup, media, enums...)."""
+    to_dict = getattr(value, "to_dict", None)
+    return to_dict() if callable(to_dict) else str(value)
+
+
+class CaptureFileHandler(logging.handlers.RotatingFileHandler):
+    """Rotating handler that starts every new file with ``header``.
+
+    Older files are deleted as they age out, so each one has to carry the
+    settings a replay needs on its own.
+    """
+
+    def __init__(self, path: str, max_bytes: int, backups: int, header: str) -> None:
+        super().__init__(path, maxBytes=max_bytes, backupCount=backups, encoding="utf-8")
+        self.namer = lambda name: name + ".gz"
+        self.rotator = gzip_rotate
+        self.header = header
+
+    def doRollover(self) -> None:
+        super().doRollover()
+        self.stream.write(self.header + self.terminator)
+
+
+class TrafficRecorder:
+    """Write incoming updates and Bot API calls to a rotating capture file.
+
+    Each record is a JSON line ``{"t": unix time, "type": ...}``: a "start"
+    record with the settings a replay needs, then "update" records (the
+    raw update) and "call" records (endpoint, parameters, result or
+    error, seconds, and the handler and update that made the call).
+    Lines are handed to logging's QueueListener thread, so writing and
+    compressing never block the event loop.
+    """
+
+    def __init__(self, path: str, max_bytes: int, backups: int) -> None:
+        header = self._line(
+            "start",
+            support_groups=list(support_groups()),
+            forwarding_mode=FORWARDING_MODE,
+            threading_mode=THREADING_MODE,
+        )
+        self._handler = CaptureFileHandler(path, max_bytes, backups, header)
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._listener = logging.handlers.QueueListener(self._queue, self._handler)
+        self._listener.start()
+        self._queue.put_nowait(logging.makeLogRecord({"msg": header}))
+
+    @staticmethod
+    def _line(kind: str, **fields: Any) -> str:
+        return json.dumps(
+            {"t": time.time(), "type": kind, **fields},
+            ensure_ascii=False,
+            default=capture_default,
+        )
+
+    def _write(self, kind: str, **fields: Any) -> None:
+        line = self._line(kind, **fields)
+        self._queue.put_nowait(logging.makeLogRecord({"msg": line}))
+
+    def record_update(self, update: object) -> None:
+        """OrderedUpdateProcessor hook."""
+        if isinstance(update, Update):
+            self._write("update", update=update.to_dict())
+
+    def record_call(
+        self,
+        endpoint: str,
+        data: Dict[str, Any],
+        result: Any,
+        error: Optional[BaseException],
+        seconds: float,
+    ) -> None:
+        """APITracer hook."""
+        account = CURRENT_API_ACCOUNT.get()
+        self._write(
+            "call",
+            endpoint=endpoint,
+            data=data,
+            result=result,
+            error=f"{type(error).__name__}: {error}" if error else None,
+            seconds=round(seconds, 6),
+            handler=account.handler if account else None,
+            update_id=account.update_id if account else None,
+        )
+
+    def close(self) -> None:
+        self._listener.stop()
+        self._handler.close()
+
+
+class BotAPIPipeline(BaseRateLimiter):
+    """Middleware for every Bot API call, plugged in as the bot's rate limiter.
+
+    PTB hands each call made through the bot (context.bot included) to the
+    rate limiter, so it passes through ``stages`` in order and then on to
+    ``limiter``, or straight to the network if there is none.
+    """
+
+    def __init__(
+        self, limiter: Optional[BaseRateLimiter], stages: Sequence[BotAPIStage]
+    ) -> None:
+        self.limiter = limiter
+        self.stages = list(stages)
+
+    async def initialize(self) -> None:
+        if self.limiter:
+            await self.limiter.initialize()
+
+    async def shutdown(self) -> None:
+        if self.limiter:
+            await self.limiter.shutdown()
+
+    async def process_request(
+        self,
+        callback: Callable[..., Awaitable[Any]],
+        args: Any,
+        kwargs: Dict[str, Any],
+        endpoint: str,
+        data: Dict[str, Any],
+        rate_limit_args: Optional[Dict[str, Any]],
+    ) -> Any:
+        async def call(index: int) -> Any:
+            if index < len(self.stages):
+                return await self.stages[index].handle(
+                    endpoint, data, lambda: call(index + 1)
+                )
+            if self.limiter:
+                return await self.limiter.process_request(
+                    callback, args, kwargs, endpoint, data, rate_limit_args
+                )
+            return await callback(*args, **kwargs)
+
+        return await call(0)
+
+
+def _log_failed_chat_action(future: asyncio.Future) -> None:
+    if not future.cancelled() and future.exception():
+        logger.debug("Chat action failed: %s", future.exception())
+
+
+async def send_text(
+    bot,
+    chat_id: int,
+    text: str,
+    priority: int = PRIORITY_ACK,
+    chat_action: bool = True,
+    thread_id: Optional[int] = None,
+) -> None:
+    if chat_action:
+        await bot.send_chat_action(
+            chat_id=chat_id, action=ChatAction.TYPING, message_thread_id=thread_id
+        )
+    await bot.send_message(
+        chat_id=chat_id,
+        text=text,
+        message_thread_id=thread_id,
+        rate_limit_args={"priority": priority},
+    )
+
+
+def resolve_message_payload(update_message) -> Optional[Dict[str, Any]]:
+    msg = update_message
+    if msg.text:
+        return {
+            "type": "text",
+            "action": ChatAction.TYPING,
+            "label": "📨 Message",
+            "data": {"text": msg.text_html, "parse_mode": ParseMode.HTML},
+        }
+    if msg.photo:
+        return {
+            "type": "photo",
+            "action": ChatAction.UPLOAD_PHOTO,
+            "label": "📸 Photo",
+            "data": {
+                "photo": msg.photo[-1].file_id,
+                "caption": msg.caption_html,
+                "parse_mode": ParseMode.HTML,
+            },
+        }
+    if msg.video:
+        return {
+            "type": "video",
+            "action": ChatAction.UPLOAD_VIDEO,
+            "label": "🎥 Video",
+            "data": {
+                "video": msg.video.file_id,
+                "caption": msg.caption_html,
+                "parse_mode": ParseMode.HTML,
+            },
+        }
+    if msg.animation:
+        return {
+            "type": "animation",
+            "action": ChatAction.UPLOAD_VIDEO,
+            "label": "🎞 GIF",
+            "data": {
+                "animation": msg.animation.file_id,
+                "caption": msg.caption_html,
+                "parse_mode": ParseMode.HTML,
+            },
+        }
+    if msg.document:
+        return {
+            "type": "document",
+            "action": ChatAction.UPLOAD_DOCUMENT,
+            "label": "📁 Document",
+            "data": {
+                "document": msg.document.file_id,
+                "caption": msg.caption_html,
+                "parse_mode": ParseMode.HTML,
+            },
+        }
+    if msg.voice:
+        return {
+            "type": "voice",
+            "action": ChatAction.RECORD_VOICE,
+            "label": "🎙 Voice",
+            "data": {
+                "voice": msg.voice.file_id,
+                "caption": msg.caption_html,
+                "parse_mode": ParseMode.HTML,
+            },
+        }
+    return None
+
+
+# Labels for content types only compact mode can forward. Venue comes before
+# location because venue messages carry a location too.
+EXTRA_MESSAGE_LABELS = (
+    ("audio", "🎧 Audio"),
+    ("sticker", "🖼 Sticker"),
+    ("video_note", "📹 Video note"),
+    ("venue", "📍 Venue"),
+    ("location", "📍 Location"),
+    ("contact", "👤 Contact"),
+    ("poll", "📊 Poll"),
+    ("dice", "🎲 Dice"),
+)
+
+
+def describe_message(message) -> str:
+    payload = resolve_message_payload(message)
+    if payload:
+        return payload["label"]
+    for attribute, label in EXTRA_MESSAGE_LABELS:
+        if getattr(message, attribute, None):
+            return label
+    return "📦 Message"
+
+
+def utf16_length(text: str) -> int:
+    """Length as Telegram counts it (entity offsets are in UTF-16 code units)."""
+    return len(text.encode("utf-16-le")) // 2
+
+
+def merge_text_burst(messages: List[Any]):
+    """Join text messages into one, one line each, keeping their formatting.
+
+    The result is the first message with the combined text and entities, so
+    ids, sender and chat still point at the original conversation.
+    """
+    first = messages[0]
+    if len(messages) == 1:
+        return first
+    entities = []
+    offset = 0
+    for message in messages:
+        for entity in message.entities:
+            data = entity.to_dict()
+            data["offset"] += offset
+            entities.append(data)
+        offset += utf16_length(message.text) + 1
+    data = first.to_dict()
+    data["text"] = "\n".join(message.text for message in messages)
+    data["entities"] = entities
+    return Message.de_json(data, first.get_bot())
+
+
+def content_fingerprint(messages: List[Any]) -> Optional[str]:
+    """Hash of what a message (or album) shows, or None if it isn't deduplicated.
+
+    Media is identified by file_unique_id, which is stable across resends
+    and forwards of the same file; text and captions are normalized first.
+    """
+    parts = []
+    for message in messages:
+        attachment = message.effective_attachment
+        if isinstance(attachment, tuple):
+            attachment = attachment[-1] if attachment else None
+        unique_id = getattr(attachment, "file_unique_id", None)
+        text = " ".join((message.text or message.caption or "").casefold().split())
+        if unique_id is None and len(text) < max(DEDUP_MIN_TEXT_LENGTH, 1):
+            return None
+        parts.append(f"{unique_id or ''}:{text}")
+    return hashlib.blake2b("\n".join(parts).encode(), digest_size=16).hexdigest()
+
+
+def supports_caption(message) -> bool:
+    return bool(
+        message.photo
+        or message.video
+        or message.animation
+        or message.document
+        or message.audio
+        or message.voice
+    )
+
+
+async def send_payload(
+    bot,
+    chat_id: int,
+    payload: Dict[str, Any],
+    reply_to: Optional[int] = None,
+    priority: int = PRIORITY_FORWARD,
+    chat_action: bool = True,
+):
+    if chat_action:
+        await bot.send_chat_action(chat_id=chat_id, action=payload["action"])
+    data = payload["data"].copy()
+
+    # Clean empty captions
+    if "caption" in data and data["caption"] is None:
+        data.pop("caption", None)
+        data.pop("parse_mode", None)
+
+    if reply_to:
+        data["reply_to_message_id"] = reply_to
+    data["rate_limit_args"] = {"priority": priority}
+
+    payload_type = payload["type"]
+    if payload_type == "text":
+        return await bot.send_message(chat_id=chat_id, **data)
+    if payload_type == "photo":
+        return await bot.send_photo(chat_id=chat_id, **data)
+    if payload_type == "video":
+        return await bot.send_video(chat_id=chat_id, **data)
+    if payload_type == "animation":
+        return await bot.send_animation(chat_id=chat_id, **data)
+    if payload_type == "document":
+        return await bot.send_document(chat_id=chat_id, **data)
+    if payload_type == "voice":
+        return await bot.send_voice(chat_id=chat_id, **data)
+    raise ValueError("Unsupported payload type")
+
+
+def build_info_text(message, label: str, include_body: bool = True) -> str:
+    user = message.from_user
+    raw_username = f"@{user.username}" if user.username else "No username"
+    username = html.escape(raw_username)
+    full_name = html.escape(user.full_name)
+
+    lines = [
+        f"{label} from <b>{full_name}</b> ({username})",
+        f"🆔 <code>{user.id}</code>",
+    ]
+
+    if include_body and message.caption_html:
+        lines.append(f"💬 {message.caption_html}")
+    elif include_body and message.text_html:
+        lines.append(f"💬 {message.text_html}")
+
+    return "\n".join(lines)
+
+
+def block_keyboard(user_id: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(
+        [[InlineKeyboardButton("🚫 Block User", callback_data=f"block:{user_id}")]]
+    )
+
+
+class DeliverySteps:
+    """Results of the Bot API calls a delivery has already made.
+
+    Each call that creates a message runs through ``once`` under a name
+    unique within the delivery. A retried delivery reuses the recorded
+    message ids instead of sending again, so e.g. an info header that went
+    out before the payload failed is never duplicated. ``on_record`` is
+    called after each new step, for persisting progress.
+    """
+
+    def __init__(
+        self,
+        done: Optional[Dict[str, Any]] = None,
+        on_record: Optional[Callable[[], None]] = None,
+    ) -> None:
+        self.done = {} if done is None else done
+        self.on_record = on_record
+
+    async def once(self, name: str, send: Callable[[], Awaitable[Any]]) -> Any:
+        """Run ``send`` unless it already succeeded; returns the message id(s)."""
+        if name in self.done:
+            return self.done[name]
+        result = await send()
+        if isinstance(result, (list, tuple)):
+            value: Any = [message.message_id for message in result]
+        else:
+            value = getattr(result, "message_id", True)
+        self.record(name, value)
+        return value
+
+    def record(self, name: str, value: Any) -> None:
+        self.done[name] = value
+        if self.on_record:
+            self.on_record()
+
+
+async def forward_classic(
+    bot,
+    bot_data: Dict[str, Any],
+    group_id: int,
+    message,
+    payload: Dict[str, Any],
+    steps: Optional[DeliverySteps] = None,
+) -> None:
+    """Send the info header, then the payload as a reply to it.
+
+    The header quotes the text or caption, unless that would make it too
+    long (a merged burst can fill a whole message); the payload has it anyway.
+    """
+    steps = steps or DeliverySteps()
+    user_id = message.from_user.id
+    info_text = build_info_text(message, payload["label"])
+    if len(info_text) > MessageLimit.MAX_TEXT_LENGTH:
+        info_text = build_info_text(message, payload["label"], include_body=False)
+    await bot.send_chat_action(chat_id=group_id, action=ChatAction.TYPING)
+    info_message_id = await steps.once(
+        "info",
+        lambda: bot.send_message(
+            chat_id=group_id,
+            text=info_text,
+            parse_mode=ParseMode.HTML,
+            reply_markup=block_keyboard(user_id),
+            rate_limit_args={"priority": PRIORITY_FORWARD},
+        ),
+    )
+    await remember_info_message(bot_data, group_id, info_message_id, user_id)
+
+    payload_message_id = await steps.once(
+        "payload",
+        lambda: send_payload(bot, group_id, payload, reply_to=info_message_id),
+    )
+    # Admins may reply to the media itself rather than the header above it
+    await remember_info_message(bot_data, group_id, payload_message_id, user_id)
+
+
+async def copy_to_group(
+    bot, group_id: int, message, priority: int = PRIORITY_FORWARD, **kwargs: Any
+):
+    """Copy a message to the group; text is re-sent so merged bursts go whole."""
+    rate_limit_args = {"priority": priority}
+    if message.text:
+        return await bot.send_message(
+            chat_id=group_id,
+            text=message.text_html,
+            parse_mode=ParseMode.HTML,
+            rate_limit_args=rate_limit_args,
+            **kwargs,
+        )
+    return await bot.copy_message(
+        chat_id=group_id,
+        from_chat_id=message.chat_id,
+        message_id=message.message_id,
+        rate_limit_args=rate_limit_args,
+        **kwargs,
+    )
+
+
+async def forward_compact(
+    bot,
+    bot_data: Dict[str, Any],
+    group_id: int,
+    message,
+    steps: Optional[DeliverySteps] = None,
+) -> None:
+    """Forward in one call where possible, by merging the header into the message.
+
+    Falls back to a bare header plus a copy under it when the merged text is
+    too long or the content type has no caption (stickers, locations...).
+    """
+    steps = steps or DeliverySteps()
+    user_id = message.from_user.id
+    label = describe_message(message)
+    info_text = build_info_text(message, label)
+    keyboard = block_keyboard(user_id)
+    rate_limit_args = {"priority": PRIORITY_FORWARD}
+
+    if message.text and len(info_text) <= MessageLimit.MAX_TEXT_LENGTH:
+        sent_id = await steps.once(
+            "message",
+            lambda: bot.send_message(
+                chat_id=group_id,
+                text=info_text,
+                parse_mode=ParseMode.HTML,
+                reply_markup=keyboard,
+                rate_limit_args=rate_limit_args,
+            ),
+        )
+        await remember_info_message(bot_data, group_id, sent_id, user_id)
+        return
+    if supports_caption(message) and len(info_text) <= MessageLimit.CAPTION_LENGTH:
+        copied_id = await steps.once(
+            "message",
+            lambda: bot.copy_message(
+                chat_id=group_id,
+                from_chat_id=message.chat_id,
+                message_id=message.message_id,
+                caption=info_text,
+                parse_mode=ParseMode.HTML,
+                reply_markup=keyboard,
+                rate_limit_args=rate_limit_args,
+            ),
+        )
+        await remember_info_message(bot_data, group_id, copied_id, user_id)
+        return
+
+    info_message_id = await steps.once(
+        "info",
+        lambda: bot.send_message(
+            chat_id=group_id,
+            text=build_info_text(message, label, include_body=False),
+            parse_mode=ParseMode.HTML,
+            reply_markup=keyboard,
+            rate_limit_args=rate_limit_args,
+        ),
+    )
+    await remember_info_message(bot_data, group_id, info_message_id, user_id)
+    copied_id = await steps.once(
+        "copy",
+        lambda: copy_to_group(
+            bot, group_id, message, reply_to_message_id=info_message_id
+        ),
+    )
+    await remember_info_message(bot_data, group_id, copied_id, user_id)
+
+
+def build_input_media(message):
+    """Turn an album item back into InputMedia for send_media_group."""
+    options = {"caption": message.caption_html, "parse_mode": ParseMode.HTML}
+    if message.photo:
+        return InputMediaPhoto(message.photo[-1].file_id, **options)
+    if message.video:
+        return InputMediaVideo(message.video.file_id, **options)
+    if message.document:
+        return InputMediaDocument(message.document.file_id, **options)
+    if message.audio:
+        return InputMediaAudio(message.audio.file_id, **options)
+    return None
+
+
+async def forward_album(
+    bot,
+    bot_data: Dict[str, Any],
+    group_id: int,
+    messages: List[Any],
+    steps: Optional[DeliverySteps] = None,
+) -> None:
+    """Send one info header and the whole album as a media group under it."""
+    steps = steps or DeliverySteps()
+    first = messages[0]
+    user_id = first.from_user.id
+    label = f"🖼 Album ({len(messages)} items)"
+    info_message_id = await steps.once(
+        "info",
+        lambda: bot.send_message(
+            chat_id=group_id,
+            text=build_info_text(first, label, include_body=False),
+            parse_mode=ParseMode.HTML,
+            reply_markup=block_keyboard(user_id),
+            rate_limit_args={"priority": PRIORITY_FORWARD},
+        ),
+    )
+    await remember_info_message(bot_data, group_id, info_message_id, user_id)
+
+    album_message_ids = await steps.once(
+        "album",
+        lambda: bot.send_media_group(
+            chat_id=group_id,
+            media=[media for media in map(build_input_media, messages) if media],
+            reply_to_message_id=info_message_id,
+            rate_limit_args={"priority": PRIORITY_FORWARD},
+        ),
+    )
+    # Replies to any item of the album route back to the sender
+    for album_message_id in album_message_ids:
+        await remember_info_message(bot_data, group_id, album_message_id, user_id)
+
+
+def topic_name(user) -> str:
+    return f"{user.full_name} · {user.id}"[: ForumTopicLimit.MAX_NAME_LENGTH]
+
+
+async def ensure_user_topic(
+    bot, bot_data: Dict[str, Any], group_id: int, message, steps: DeliverySteps
+) -> int:
+    """Return the sender's topic, creating and introducing it on first contact.
+
+    The intro (user details and the Block button) is a step of the delivery
+    that created the topic, so a retry sends it if it didn't go out yet.
+    """
+    state: LocalState = bot_data["state"]
+    user = message.from_user
+    thread_id = await state.topic_for_user(user.id, group_id)
+    if thread_id is None:
+        topic = await bot.create_forum_topic(
+            chat_id=group_id,
+            name=topic_name(user),
+            rate_limit_args={"priority": PRIORITY_FORWARD},
+        )
+        thread_id = await state.map_topic(
+            user.id, group_id, topic.message_thread_id
+        )
+        if thread_id == topic.message_thread_id:
+            steps.record("topic", thread_id)
+        else:
+            # Another process created one for this user at the same time
+            try:
+                await bot.delete_forum_topic(
+                    chat_id=group_id, message_thread_id=topic.message_thread_id
+                )
+            except TelegramError as exc:
+                logger.warning("Could not delete duplicate topic: %s", exc)
+
+    if steps.done.get("topic") == thread_id:
+        await steps.once(
+            "intro",
+            lambda: bot.send_message(
+                chat_id=group_id,
+                message_thread_id=thread_id,
+                text=build_info_text(message, "💬 Conversation", include_body=False),
+                parse_mode=ParseMode.HTML,
+                reply_markup=block_keyboard(user.id),
+                rate_limit_args={"priority": PRIORITY_FORWARD},
+            ),
+        )
+    return thread_id
+
+
+async def forward_topic(
+    bot,
+    bot_data: Dict[str, Any],
+    group_id: int,
+    messages: List[Any],
+    steps: Optional[DeliverySteps] = None,
+) -> None:
+    """Copy a message, or an album, into the sender's forum topic.
+
+    No header and no per-message mapping: the topic identifies the user.
+    If admins deleted the topic, a new one is created and introduced.
+    """
+    steps = steps or DeliverySteps()
+    first = messages[0]
+    user_id = first.from_user.id
+    rate_limit_args = {"priority": PRIORITY_FORWARD}
+
+    for attempt in range(2):
+        thread_id = await ensure_user_topic(bot, bot_data, group_id, first, steps)
+        try:
+            if len(messages) > 1:
+                await steps.once(
+                    "album",
+                    lambda: bot.send_media_group(
+                        chat_id=group_id,
+                        message_thread_id=thread_id,
+                        media=[m for m in map(build_input_media, messages) if m],
+                        rate_limit_args=rate_limit_args,
+                    ),
+                )
+            else:
+                await steps.once(
+                    "message",
+                    lambda: copy_to_group(
+                        bot, group_id, first, message_thread_id=thread_id
+                    ),
+                )
+            return
+        except BadRequest as exc:
+            if attempt or "thread not found" not in str(exc).lower():
+                raise
+            logger.info(
+                "Topic %d of user %d is gone, starting a new one", thread_id, user_id
+            )
+            await bot_data["state"].forget_topic(user_id, group_id, thread_id)
+            steps.done.pop("topic", None)
+            steps.done.pop("intro", None)
+
+
+REPLY_HEADER = "📩 Reply from the group chat:"
+
+
+async def reply_classic(
+    bot,
+    payload: Dict[str, Any],
+    user_id: int,
+    steps: Optional[DeliverySteps] = None,
+) -> None:
+    steps = steps or DeliverySteps()
+    await steps.once(
+        "header", lambda: send_text(bot, user_id, REPLY_HEADER, PRIORITY_REPLY)
+    )
+    await steps.once(
+        "payload",
+        lambda: send_payload(bot, user_id, payload, priority=PRIORITY_REPLY),
+    )
+
+
+async def reply_album(
+    bot, messages: List[Any], user_id: int, steps: Optional[DeliverySteps] = None
+) -> None:
+    steps = steps or DeliverySteps()
+    rate_limit_args = {"priority": PRIORITY_REPLY}
+    await steps.once(
+        "header",
+        lambda: bot.send_message(
+            chat_id=user_id,
+            text=REPLY_HEADER,
+            rate_limit_args=rate_limit_args,
+        ),
+    )
+    await steps.once(
+        "album",
+        lambda: bot.send_media_group(
+            chat_id=user_id,
+            media=[media for media in map(build_input_media, messages) if media],
+            rate_limit_args=rate_limit_args,
+        ),
+    )
+
+
+async def reply_compact(
+    bot, message, user_id: int, steps: Optional[DeliverySteps] = None
+) -> None:
+    """Deliver an admin reply by copying it, header merged where possible."""
+    steps = steps or DeliverySteps()
+    header = REPLY_HEADER
+    rate_limit_args = {"priority": PRIORITY_REPLY}
+
+    if message.text:
+        text = f"{header}\n{message.text_html}"
+        if len(text) <= MessageLimit.MAX_TEXT_LENGTH:
+            await steps.once(
+                "message",
+                lambda: bot.send_message(
+                    chat_id=user_id,
+                    text=text,
+                    parse_mode=ParseMode.HTML,
+                    rate_limit_args=rate_limit_args,
+                ),
+            )
+            return
+    elif supports_caption(message):
+        caption = f"{header}\n{message.caption_html}" if message.caption else header
+        if len(caption) <= MessageLimit.CAPTION_LENGTH:
+            await steps.once(
+                "message",
+                lambda: bot.copy_message(
+                    chat_id=user_id,
+                    from_chat_id=message.chat_id,
+                    message_id=message.message_id,
+                    caption=caption,
+                    parse_mode=ParseMode.HTML,
+                    rate_limit_args=rate_limit_args,
+                ),
+            )
+            return
+
+    await steps.once(
+        "header",
+        lambda: bot.send_message(
+            chat_id=user_id, text=header, rate_limit_args=rate_limit_args
+        ),
+    )
+    await steps.once(
+        "copy",
+        lambda: bot.copy_message(
+            chat_id=user_id,
+            from_chat_id=message.chat_id,
+            message_id=message.message_id,
+            rate_limit_args=rate_limit_args,
+        ),
+    )
+
+
+def new_outbox_job(
+    kind: str,
+    messages: List[Any],
+    user_id: int,
+    notify: Dict[str, Any],
+    group_id: int,
+    reply_to: Optional[int] = None,
+) -> Dict[str, Any]:
+    """A forward ("forward") or admin reply ("reply") as a persistable job.
+
+    The job id doubles as idempotency key: it is derived from the source
+    message, so a redelivered update can't queue the same delivery twice.
+    ``notify`` holds the chat to tell about the outcome of deferred
+    retries, and the texts for success and failure. ``group_id`` is the
+    support group the user is routed to (or the reply came from).
+    """
+    first = messages[0]
+    now = time.time()
+    return {
+        "job_id": f"{kind}:{first.chat_id}:{first.message_id}",
+        "kind": kind,
+        "compact": FORWARDING_MODE == "compact",
+        "topics": THREADING_MODE == "topics",
+        "user_id": user_id,
+        "group_id": group_id,
+        "reply_to": reply_to,
+        "messages": [message.to_dict() for message in messages],
+        "notify": notify,
+        "steps": {},
+        "status": "pending",
+        "attempts": 0,
+        "next_attempt_at": now,
+        "last_error": None,
+        "created_at": now,
+    }
+
+
+async def run_outbox_job(
+    bot, bot_data: Dict[str, Any], job: Dict[str, Any], steps: DeliverySteps
+) -> None:
+    messages = [Message.de_json(data, bot) for data in job["messages"]]
+    message = messages[0]
+    group_id = job["group_id"]
+    if job["kind"] == "forward":
+        if job["topics"]:
+            await forward_topic(bot, bot_data, group_id, messages, steps)
+        elif len(messages) > 1:
+            await forward_album(bot, bot_data, group_id, messages, steps)
+        elif job["compact"]:
+            await forward_compact(bot, bot_data, group_id, message, steps)
+        else:
+            payload = resolve_message_payload(message)
+            await forward_classic(bot, bot_data, group_id, message, payload, steps)
+        return
+
+    user_id = job["user_id"]
+    if len(messages) > 1:
+        await reply_album(bot, messages, user_id, steps)
+    elif job["compact"]:
+        await reply_compact(bot, message, user_id, steps)
+    else:
+        await reply_classic(bot, resolve_message_payload(message), user_id, steps)
+    # 🧹 Clean up mapping once the reply has been successfully delivered
+    if job["reply_to"] is not None:
+        await forget_info_message(bot_data, group_id, job["reply_to"])
+
+
+class Outbox:
+    """Persistent queue of forwards and replies, retried until delivered.
+
+    Handlers submit a job and it is attempted right away; only failures are
+    left to the background workers, which retry with exponential backoff
+    and jitter. Only network errors and flood control are retried; any
+    other error (a rejection by Telegram, or a bug) and jobs out of attempts
+    are moved to the dead-letter list, where admins can retry or drop them
+    with /outbox. Jobs are written through the state journal, so pending
+    ones survive a restart.
+    """
+
+    # BadRequest subclasses NetworkError but is never transient
+    TRANSIENT_ERRORS = (NetworkError, TimedOut, RetryAfter)
+
+    @classmethod
+    def is_transient(cls, exc: Exception) -> bool:
+        return isinstance(exc, cls.TRANSIENT_ERRORS) and not isinstance(exc, BadRequest)
+
+    def __init__(self, bot_data: Dict[str, Any]) -> None:
+        self.bot_data = bot_data
+        self.jobs: Dict[str, Dict[str, Any]] = {}
+        self._due: List[Tuple[float, str]] = []
+        self._running: Set[str] = set()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._workers: List[asyncio.Task] = []
+        self._bot = None
+
+    def __len__(self) -> int:
+        return len(self.jobs)
+
+    def pending(self) -> int:
+        return sum(job["status"] == "pending" for job in self.jobs.values())
+
+    def dead_letters(self) -> List[Dict[str, Any]]:
+        """Dead jobs, most recently failed first."""
+        dead = [job for job in self.jobs.values() if job["status"] == "dead"]
+        return sorted(dead, key=lambda job: job["next_attempt_at"], reverse=True)
+
+    def load(self, rows: List[Tuple[str, str]]) -> None:
+        """Take over persisted jobs, at startup or from a stopped process."""
+        for _, data in rows:
+            job = json.loads(data)
+            self.jobs[job["job_id"]] = job
+            if job["status"] == "pending":
+                heapq.heappush(self._due, (job["next_attempt_at"], job["job_id"]))
+        if rows and self._wakeup:
+            self._wakeup.set()
+
+    def _save(self, job: Dict[str, Any]) -> None:
+        self.bot_data["state_journal"].put(
+            "outbox",
+            (
+                job["job_id"],
+                job["status"],
+                json.dumps(job),
+                time.time(),
+                self.bot_data["state_owner"],
+            ),
+        )
+
+    def _remove(self, job: Dict[str, Any]) -> None:
+        self.jobs.pop(job["job_id"], None)
+        self.bot_data["state_journal"].delete("outbox", job["job_id"])
+
+    def _schedule(self, job: Dict[str, Any], at: float) -> None:
+        job["status"] = "pending"
+        job["next_attempt_at"] = at
+        self._save(job)
+        heapq.heappush(self._due, (at, job["job_id"]))
+        if self._wakeup:
+            self._wakeup.set()
+
+    def _bury(self, job: Dict[str, Any]) -> None:
+        job["status"] = "dead"
+        job["next_attempt_at"] = time.time()
+        self._save(job)
+        dead = self.dead_letters()
+        for oldest in dead[OUTBOX_DEAD_LETTER_MAX_SIZE:]:
+            self._remove(oldest)
+
+    @staticmethod
+    def backoff(attempts: int) -> float:
+        delay = OUTBOX_BACKOFF_BASE_SECONDS * 2 ** (attempts - 1)
+        return min(delay, OUTBOX_BACKOFF_MAX_SECONDS) * random.uniform(0.5, 1.5)
+
+    async def submit(self, bot, job: Dict[str, Any]) -> str:
+        """Queue a job and attempt it once; "delivered", "queued" or "failed"."""
+        if job["job_id"] in self.jobs:
+            return "queued"
+        self.jobs[job["job_id"]] = job
+        self._running.add(job["job_id"])
+        self._save(job)
+        return await self._attempt(bot, job)
+
+    async def _attempt(self, bot, job: Dict[str, Any]) -> str:
+        metrics: Metrics = self.bot_data["metrics"]
+        steps = DeliverySteps(job["steps"], on_record=lambda: self._save(job))
+        job["attempts"] += 1
+        try:
+            await run_outbox_job(bot, self.bot_data, job, steps)
+        except asyncio.CancelledError:
+            self._save(job)
+            raise
+        except Exception as exc:
+            job["last_error"] = f"{type(exc).__name__}: {exc}"
+            transient = self.is_transient(exc)
+            if not transient or job["attempts"] >= OUTBOX_MAX_ATTEMPTS:
+                if transient:
+                    logger.error(
+                        "Outbox job %s gave up after %d attempts: %s",
+                        job["job_id"],
+                        job["attempts"],
+                        exc,
+                    )
+                else:
+                    logger.exception("Outbox job %s failed: %s", job["job_id"], exc)
+                self._bury(job)
+                metrics.inc("zapata_outbox_jobs_total", result="dead")
+                outcome = "failed"
+            else:
+                delay = self.backoff(job["attempts"])
+                if isinstance(exc, RetryAfter):
+                    delay = max(delay, retry_after_seconds(exc))
+                logger.warning(
+                    "Outbox job %s failed (attempt %d), retrying in %.0fs: %s",
+                    job["job_id"],
+                    job["attempts"],
+                    delay,
+                    exc,
+                )
+                self._running.discard(job["job_id"])
+                self._schedule(job, time.time() + delay)
+                metrics.inc("zapata_outbox_jobs_total", result="retried")
+                outcome = "queued"
+        else:
+            self._remove(job)
+            archive_job(self.bot_data, job)
+            metrics.inc("zapata_outbox_jobs_total", result="delivered")
+            outcome = "delivered"
+        finally:
+            self._running.discard(job["job_id"])
+
+        if job["attempts"] > 1 and outcome != "queued":
+            await self._notify(bot, job, outcome)
+        return outcome
+
+    async def _notify(self, bot, job: Dict[str, Any], outcome: str) -> None:
+        """Tell the sender how a delivery that had to be retried ended."""
+        notify = job["notify"]
+        try:
+            await bot.send_message(
+                chat_id=notify["chat_id"],
+                text=notify[outcome],
+                message_thread_id=notify.get("thread_id"),
+                reply_to_message_id=notify.get("reply_to"),
+                allow_sending_without_reply=True,
+                rate_limit_args={"priority": PRIORITY_ACK},
+            )
+        except Exception as exc:
+            logger.warning("Could not report outbox job %s: %s", job["job_id"], exc)
+
+    def retry(self, job_id: Optional[str] = None) -> int:
+        """Move one dead job (or all of them) back to the queue."""
+        jobs = [self.jobs[job_id]] if job_id in self.jobs else []
+        if job_id is None:
+            jobs = self.dead_letters()
+        retried = 0
+        for job in jobs:
+            if job["status"] == "dead":
+                job["attempts"] = 0
+                self._schedule(job, time.time())
+                retried += 1
+        return retried
+
+    def drop(self, job_id: str) -> bool:
+        job = self.jobs.get(job_id)
+        if not job or job["status"] != "dead":
+            return False
+        self._remove(job)
+        return True
+
+    async def _next_due(self) -> Dict[str, Any]:
+        while True:
+            now = time.time()
+            while self._due and self._due[0][0] <= now:
+                at, job_id = heapq.heappop(self._due)
+                job = self.jobs.get(job_id)
+                # Skip entries superseded by a later reschedule, retry or drop
+                if (
+                    job
+                    and job["status"] == "pending"
+                    and job["next_attempt_at"] == at
+                    and job_id not in self._running
+                ):
+                    self._running.add(job_id)
+                    return job
+            timeout = self._due[0][0] - now if self._due else None
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _work(self, bot) -> None:
+        while True:
+            job = await self._next_due()
+            try:
+                await self._attempt(bot, job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                logger.exception("Outbox worker failed: %s", exc)
+
+    def start(self, bot) -> None:
+        self._wakeup = asyncio.Event()
+        self._workers = [
+            asyncio.create_task(self._work(bot)) for _ in range(OUTBOX_WORKERS)
+        ]
+
+    async def stop(self) -> None:
+        for worker in self._workers:
+            worker.cancel()
+        for worker in self._workers:
+            try:
+                await worker
+            except asyncio.CancelledError:
+                pass
+        self._workers = []
+
+
+@contextlib.contextmanager
+def handler_accounting(
+    metrics: Metrics, handler: str, update_id: Optional[int] = None
+) -> Iterator[APICallAccount]:
+    """Time a handler run and attribute the Bot API calls made in it.
+
+    Records zapata_handler_seconds and zapata_handler_api_calls_total.
+    """
+    account = APICallAccount(handler, update_id)
+    token = CURRENT_API_ACCOUNT.set(account)
+    started = time.perf_counter()
+    try:
+        yield account
+    finally:
+        CURRENT_API_ACCOUNT.reset(token)
+        metrics.observe(
+            "zapata_handler_seconds", time.perf_counter() - started, handler=handler
+        )
+        for method, count in account.calls.items():
+            metrics.inc(
+                "zapata_handler_api_calls_total", count, handler=handler, method=method
+            )
+
+
+def instrument_handler(callback):
+    """Record the handler's run time and Bot API calls (handler_accounting)."""
+
+    @functools.wraps(callback)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        with handler_accounting(
+            ensure_bot_data(context)["metrics"],
+            callback.__name__,
+            getattr(update, "update_id", None),
+        ):
+            return await callback(update, context)
+
+    return wrapper
+
+
+@instrument_handler
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        if update.effective_chat.type != "private":
+            return
+        await send_text(
+            context.bot,
+            update.effective_chat.id,
+            "Welcome! Send any message and I'll forward it to the admins.",
+        )
+    except Exception as exc:
+        logger.exception("Failed to handle /start: %s", exc)
+
+
+@instrument_handler
+async def handle_private_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    message = update.effective_message
+    user = update.effective_user
+    bot_data = ensure_bot_data(context)
+
+    # Cache basic user info for admin views (/blocked)
+    if user:
+        remember_user_info(bot_data, user)
+
+    # Album items arrive as separate updates; collect them and forward once
+    albums: MessageBatcher = bot_data["album_batcher"]
+    bursts: MessageBatcher = bot_data["text_batcher"]
+    album_key = ("private", message.chat.id)
+    if message.media_group_id:
+        await bursts.flush(album_key)
+        await albums.add(album_key, (context, message), message.media_group_id)
+        return
+    await albums.flush(album_key)
+
+    # Likewise a run of short texts, sent one line at a time
+    if message.text and TEXT_BURST_WINDOW_SECONDS:
+        pending = bursts.pending(album_key)
+        merged_length = sum(utf16_length(m.text) + 1 for _, m in pending)
+        if merged_length + utf16_length(message.text) > MessageLimit.MAX_TEXT_LENGTH:
+            await bursts.flush(album_key)
+        await bursts.add(album_key, (context, message))
+        return
+    await bursts.flush(album_key)
+
+    await relay_private_messages(context, [message])
+
+
+async def relay_private_messages(
+    context: ContextTypes.DEFAULT_TYPE, messages: List[Any]
+) -> None:
+    """Forward one message, or one album, from a user to the group.
+
+    A batch of one (an album split by the batching window) is forwarded like
+    any single message, so it needs a payload unless it is copied.
+    """
+    message = messages[0]
+    user = message.from_user
+    bot_data = ensure_bot_data(context)
+    compact = FORWARDING_MODE == "compact"
+
+    copied = compact or THREADING_MODE == "topics"
+    if len(messages) == 1 and not copied and not resolve_message_payload(message):
+        await send_text(context.bot, message.chat.id, "⚠️ Unsupported content type.")
+        return
+
+    if await is_user_blocked(context, user.id):
+        bot_data["metrics"].inc("zapata_blocked_drops_total", direction="private")
+        await send_text(
+            context.bot,
+            message.chat.id,
+            "🚫 You have been blocked and cannot send messages.",
+        )
+        return
+
+    # Resends are answered before they cost a rate-limit slot
+    recent_content: BoundedTTLMap = bot_data["recent_content"]
+    fingerprint = content_fingerprint(messages) if DEDUP_WINDOW_SECONDS else None
+    if fingerprint and (user.id, fingerprint) in recent_content:
+        bot_data["metrics"].inc("zapata_duplicates_total")
+        # Keep suppressing for as long as the resends continue
+        recent_content[(user.id, fingerprint)] = True
+        await send_text(
+            context.bot,
+            message.chat.id,
+            "☑️ You already sent this, no need to send it again. "
+            "Please wait for the group's reply here.",
+            chat_action=False,
+        )
+        return
+
+    # Past the last load level new messages are turned away, not queued
+    load: LoadController = bot_data["load"]
+    if load.level() >= LoadController.SHED_MESSAGES:
+        bot_data["metrics"].inc("zapata_load_shed_total", step="message")
+        await send_text(
+            context.bot,
+            message.chat.id,
+            "⏳ The support team is receiving a lot of messages right now "
+            f"({load.in_flight} ahead of yours). Please send your message again "
+            f"in about {math.ceil(load.retry_after())}s.",
+            chat_action=False,
+        )
+        return
+
+    # An album counts as a single message
+    decision = await track_rate_limit(context, user.id)
+    if not decision.allowed:
+        bot_data["metrics"].inc("zapata_rate_limited_total", scope=decision.scope)
+        seconds = math.ceil(decision.retry_after)
+        if decision.scope == "global":
+            text = (
+                "⏳ The support team is receiving a lot of messages right now. "
+                f"Please try again in {seconds}s."
+            )
+        else:
+            text = (
+                "⚠️ You are sending messages too quickly. "
+                f"Please slow down and try again in {seconds}s."
+            )
+        await send_text(context.bot, message.chat.id, text)
+        return
+
+    delivered_text = "✅ Delivered to the group. Await their reply here."
+    failed_text = "❌ Failed to send your message."
+    try:
+        group_id = await route_user(bot_data, user)
+        job = new_outbox_job(
+            "forward",
+            messages,
+            user.id,
+            notify={
+                "chat_id": message.chat.id,
+                "delivered": delivered_text,
+                "failed": failed_text,
+            },
+            group_id=group_id,
+        )
+        with load.forwarding():
+            outcome = await bot_data["outbox"].submit(context.bot, job)
+        if fingerprint and outcome != "failed":
+            recent_content[(user.id, fingerprint)] = True
+        if outcome == "delivered":
+            if load.level() >= LoadController.SHED_ACKS:
+                bot_data["metrics"].inc("zapata_load_shed_total", step="ack")
+            else:
+                await send_text(
+                    context.bot,
+                    message.chat.id,
+                    delivered_text,
+                    chat_action=not compact,
+                )
+        elif outcome == "queued":
+            await send_text(
+                context.bot,
+                message.chat.id,
+                "⏳ Delivery is delayed. Your message is queued and will be "
+                "forwarded automatically.",
+            )
+        else:
+            await send_text(context.bot, message.chat.id, failed_text)
+    except Exception as exc:
+        logger.exception("Failed to forward private message: %s", exc)
+        await send_text(context.bot, message.chat.id, failed_text)
+
+
+def user_topic_thread(message) -> Optional[int]:
+    """The forum topic a group message was posted in, when routing by topic."""
+    if THREADING_MODE == "topics" and message.is_topic_message:
+        return message.message_thread_id
+    return None
+
+
+@instrument_handler
+async def handle_group_reply(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    message = update.effective_message
+    bot_data = ensure_bot_data(context)
+    reply_to = message.reply_to_message
+    thread_id = user_topic_thread(message)
+
+    if thread_id is not None:
+        album_key = ("topic", message.chat.id, thread_id)
+    elif reply_to:
+        album_key = ("reply", message.chat.id, reply_to.message_id)
+    else:
+        return
+
+    albums: MessageBatcher = bot_data["album_batcher"]
+    if message.media_group_id:
+        await albums.add(album_key, (context, message), message.media_group_id)
+        return
+    await albums.flush(album_key)
+
+    await relay_group_reply(context, [message])
+
+
+async def relay_group_reply(
+    context: ContextTypes.DEFAULT_TYPE, messages: List[Any]
+) -> None:
+    """Deliver one admin reply, or one album sent as a reply, to the user.
+
+    In a user's forum topic every message counts as a reply to them.
+    """
+    message = messages[0]
+    bot_data = ensure_bot_data(context)
+    reply_to = message.reply_to_message
+    thread_id = user_topic_thread(message)
+
+    if thread_id is not None:
+        user_id = await bot_data["state"].user_for_topic(message.chat.id, thread_id)
+        # Not a user's topic; admins are just talking
+        if not user_id:
+            return
+        reply_to_id = None
+    else:
+        reply_to_id = reply_to.message_id
+        user_id = await lookup_info_message(bot_data, message.chat.id, reply_to_id)
+        if not user_id:
+            await send_text(
+                context.bot,
+                message.chat.id,
+                "⚠️ Please reply directly to the bot's info message.",
+            )
+            return
+
+    if await is_user_blocked(context, user_id):
+        bot_data["metrics"].inc("zapata_blocked_drops_total", direction="reply")
+        await send_text(
+            context.bot,
+            message.chat.id,
+            "ℹ️ That user is currently blocked.",
+            thread_id=thread_id,
+        )
+        return
+
+    compact = FORWARDING_MODE == "compact"
+    payload = resolve_message_payload(message)
+    if not payload and not compact and len(messages) == 1:
+        await send_text(
+            context.bot,
+            message.chat.id,
+            "⚠️ Unsupported reply type.",
+            thread_id=thread_id,
+        )
+        return
+
+    failed_text = "❌ Could not deliver the reply."
+    try:
+        job = new_outbox_job(
+            "reply",
+            messages,
+            user_id,
+            notify={
+                "chat_id": message.chat.id,
+                "thread_id": thread_id,
+                "reply_to": message.message_id,
+                "delivered": "✅ Reply delivered.",
+                "failed": failed_text,
+            },
+            group_id=message.chat.id,
+            reply_to=reply_to_id,
+        )
+        outcome = await bot_data["outbox"].submit(context.bot, job)
+        if outcome == "delivered":
+            if bot_data["load"].level() >= LoadController.SHED_ACKS:
+                bot_data["metrics"].inc("zapata_load_shed_total", step="ack")
+            else:
+                await send_text(
+                    context.bot,
+                    message.chat.id,
+                    "✅ Reply delivered.",
+                    chat_action=not compact,
+                    thread_id=thread_id,
+                )
+        elif outcome == "queued":
+            await send_text(
+                context.bot,
+                message.chat.id,
+                "⏳ Couldn't reach the user yet. The reply is queued and will be "
+                "retried automatically.",
+                thread_id=thread_id,
+            )
+        else:
+            await send_text(
+                context.bot, message.chat.id, failed_text, thread_id=thread_id
+            )
+    except Exception as exc:
+        logger.exception("Failed to deliver reply: %s", exc)
+        await send_text(context.bot, message.chat.id, failed_text, thread_id=thread_id)
+
+
+async def flush_album(key: Tuple[Any, ...], items: List[Tuple[Any, Any]]) -> None:
+    """MessageBatcher callback: relay a collected album in one go."""
+    context = items[-1][0]
+    messages = [message for _, message in items]
+    with handler_accounting(ensure_bot_data(context)["metrics"], "flush_album"):
+        if key[0] == "private":
+            await relay_private_messages(context, messages)
+        else:
+            await relay_group_reply(context, messages)
+
+
+async def flush_text_burst(key: Tuple[Any, ...], items: List[Tuple[Any, Any]]) -> None:
+    """MessageBatcher callback: forward a run of texts as one message."""
+    context = items[-1][0]
+    message = merge_text_burst([message for _, message in items])
+    with handler_accounting(ensure_bot_data(context)["metrics"], "flush_text_burst"):
+        await relay_private_messages(context, [message])
+
+
+@instrument_handler
+async def handle_block_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """You said everyone in the group is admin, so no admin-check here."""
+    query = update.callback_query
+    if not query or not query.data or not query.data.startswith("block:"):
+        return
+
+    try:
+        await query.answer()
+        user_id = int(query.data.split(":", maxsplit=1)[1])
+        await add_user_to_blocklist(context, user_id)
+        await query.edit_message_reply_markup(reply_markup=None)
+        await query.message.reply_text(f"🚫 User {user_id} has been blocked.")
+    except Exception as exc:
+        logger.exception("Failed to block user: %s", exc)
+        await query.answer("Failed to block user.", show_alert=True)
+
+
+@instrument_handler
+async def handle_unblock_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle inline 'Unblock' button presses."""
+    query = update.callback_query
+    if not query or not query.data or not query.data.startswith("unblock:"):
+        return
+
+    try:
+        admin_id = query.from_user.id
+        if not await is_group_admin(context, admin_id):
+            await query.answer("Permission denied.", show_alert=True)
+            return
+
+        # unblock:<id>, or unblock:<id>:<page>[:<search>] from a /blocked page
+        _, user_id, *listing = query.data.split(":", 3)
+        user_id = int(user_id)
+        removed = await remove_user_from_blocklist(context, user_id)
+        if listing:
+            await query.answer(
+                f"✅ User {user_id} has been unblocked."
+                if removed
+                else "User not found in blocklist."
+            )
+            search = listing[1] if len(listing) > 1 else None
+            await show_blocked_page(query, context, int(listing[0]), search)
+        elif removed:
+            await query.answer()
+            await query.message.reply_text(f"✅ User {user_id} has been unblocked.")
+        else:
+            await query.answer("User not found in blocklist.", show_alert=True)
+    except Exception as exc:
+        logger.exception("Failed to unblock user via callback: %s", exc)
+        await query.answer("Failed to unblock user.", show_alert=True)
+
+
+@instrument_handler
+async def track_admin_membership(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Keep the admin cache in sync with promotions, demotions and departures."""
+    change = update.chat_member
+    if not change or change.chat.id not in support_groups():
+        return
+    member = change.new_chat_member
+    ensure_bot_data(context)["admin_cache"][(change.chat.id, member.user.id)] = (
+        member.status in ADMIN_STATUSES
+    )
+
+
+@instrument_handler
+async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Explain how the bot works and its limitations."""
+    try:
+        chat = update.effective_chat
+        user = update.effective_user
+
+        # Base text for everyone
+        base_text = (
+            "ℹ️ <b>Zapata Support Bot</b>\n\n"
+            "• <b>What I do</b>\n"
+            "  - I forward your private messages (text, photos, videos, GIFs, documents, voice notes) "
+            "to a support group.\n"
+            "  - Replies from the group are delivered back to you here.\n\n"
+            "• <b>Supported content</b>\n"
+            "  - Text messages\n"
+            "  - Photos (with captions)\n"
+            "  - Videos (with captions)\n"
+            "  - GIFs / animations\n"
+            "  - Documents and files\n"
+            "  - Voice messages\n\n"
+            "• <b>Limitations & safety</b>\n"
+            "  - Anti-spam: sending too many messages too quickly will temporarily stop forwarding.\n"
+            "  - Blocked users: the support team can block abusive users.\n"
+            "    Blocks are saved and survive bot restarts.\n\n"
+        )
+
+        extra = ""
+
+        if chat.type == "private":
+            extra = (
+                "• <b>How to use (you)</b>\n"
+                "  - Just send me a message here in private.\n"
+                "  - Wait for the group’s reply, which will appear in this chat.\n"
+            )
+        elif chat.type in ("group", "supergroup"):
+            # If this user is an admin, show admin help too
+            try:
+                if await is_group_admin(context, user.id):
+                    if THREADING_MODE == "topics":
+                        answering = (
+                            "  - Every user has a topic; write in it to answer them.\n"
+                            "  - Press \"🚫 Block User\" on the topic's first message "
+                            "to block them.\n"
+                        )
+                    else:
+                        answering = (
+                            "  - Reply to the bot's info message to answer a user.\n"
+                            "  - Press \"🚫 Block User\" under an info message "
+                            "to block them.\n"
+                        )
+                    extra = (
+                        "• <b>Admin tools</b>\n"
+                        + answering
+                        + "  - Use /blocked to see the current blocklist and unblock via buttons "
+                        "(/blocked &lt;id or name&gt; to search).\n"
+                        "  - Use /unblock &lt;user_id&gt; to unblock manually.\n"
+                        "  - Use /history &lt;user_id&gt; [words] to look through a "
+                        "user's past messages and replies.\n"
+                        "  - Use /stats to see latency, API and queue statistics.\n"
+                        "  - Reply to a message with /broadcast to send it to every "
+                        "user (/broadcast cancel stops it).\n"
+                        "  - Use /outbox to see deliveries waiting for a retry and "
+                        "ones that failed.\n"
+                    )
+            except Exception:
+                # If we can't resolve admin status, just show base text
+                pass
+
+        text = base_text + extra
+
+        await context.bot.send_chat_action(
+            chat_id=chat.id, action=ChatAction.TYPING
+        )
+        await chat.send_message(text=text, parse_mode=ParseMode.HTML)
+    except Exception as exc:
+        logger.exception("Failed to send /help: %s", exc)
+
+
+def blocked_user_label(user_info: MutableMapping, uid: int) -> str:
+    info = user_info.get(uid, {})
+    username = info.get("username")
+    full_name = info.get("full_name")
+
+    label_parts = [str(uid)]
+    if full_name or username:
+        pretty = []
+        if full_name:
+            pretty.append(html.escape(full_name))
+        if username:
+            pretty.append(html.escape(f"@{username}"))
+        label_parts.append(f"({', '.join(pretty)})")
+    return " ".join(label_parts)
+
+
+async def find_blocked_users(
+    context: ContextTypes.DEFAULT_TYPE, search: Optional[str] = None
+) -> List[int]:
+    """Blocked ids in ascending order, optionally filtered by id or name.
+
+    Without a search this is the state's sorted index itself, so paging
+    is a slice. A search scans the blocklist once.
+    """
+    index = await get_state(context).blocked_index()
+    if not search:
+        return index
+    needle = search.lower().lstrip("@")
+    user_info = ensure_bot_data(context)["user_info"]
+    matches = []
+    for uid in index:
+        if str(uid).startswith(needle):
+            matches.append(uid)
+            continue
+        info = user_info.get(uid)
+        if info and (
+            (info.get("username") or "").lower().startswith(needle)
+            or needle in (info.get("full_name") or "").lower()
+        ):
+            matches.append(uid)
+    return matches
+
+
+def blocked_page_data(action: str, page: int, search: Optional[str]) -> str:
+    return f"{action}:{page}:{search}" if search else f"{action}:{page}"
+
+
+async def render_blocked_page(
+    context: ContextTypes.DEFAULT_TYPE, page: int, search: Optional[str] = None
+) -> Tuple[str, Optional[InlineKeyboardMarkup]]:
+    """Text and keyboard for one page of the blocklist (clamped to range)."""
+    blocked_users = await find_blocked_users(context, search)
+    if not blocked_users:
+        if search:
+            return f"No blocked users match <code>{html.escape(search)}</code>.", None
+        return "✅ No users are currently blocked.", None
+
+    pages = math.ceil(len(blocked_users) / BLOCKED_PAGE_SIZE)
+    page = min(max(page, 0), pages - 1)
+    offset = page * BLOCKED_PAGE_SIZE
+    user_info = ensure_bot_data(context)["user_info"]
+
+    title = f"🚫 <b>Blocked users</b> ({len(blocked_users)})"
+    if search:
+        title += f" matching <code>{html.escape(search)}</code>"
+    lines = [f"{title}, page {page + 1}/{pages}:"]
+    keyboard_rows = []
+    for uid in blocked_users[offset : offset + BLOCKED_PAGE_SIZE]:
+        lines.append(f"• <code>{blocked_user_label(user_info, uid)}</code>")
+        keyboard_rows.append(
+            [
+                InlineKeyboardButton(
+                    text=f"Unblock {uid}",
+                    callback_data=blocked_page_data(f"unblock:{uid}", page, search),
+                )
+            ]
+        )
+
+    navigation = []
+    if page > 0:
+        navigation.append(
+            InlineKeyboardButton(
+                "◀️ Prev", callback_data=blocked_page_data("blocked", page - 1, search)
+            )
+        )
+    if page < pages - 1:
+        navigation.append(
+            InlineKeyboardButton(
+                "Next ▶️", callback_data=blocked_page_data("blocked", page + 1, search)
+            )
+        )
+    if navigation:
+        keyboard_rows.append(navigation)
+    return "\n".join(lines), InlineKeyboardMarkup(keyboard_rows)
+
+
+async def show_blocked_page(
+    query, context: ContextTypes.DEFAULT_TYPE, page: int, search: Optional[str]
+) -> None:
+    """Re-render a /blocked page in place."""
+    text, keyboard = await render_blocked_page(context, page, search)
+    try:
+        await query.edit_message_text(
+            text=text, parse_mode=ParseMode.HTML, reply_markup=keyboard
+        )
+    except BadRequest as exc:
+        if "not modified" not in exc.message.lower():
+            raise
+
+
+@instrument_handler
+async def blocked_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Admin-only: page through blocked users with inline Unblock buttons.
+
+    /blocked <id or name> shows only matching users.
+    """
+    try:
+        requester = update.effective_user
+
+        if not await is_group_admin(context, requester.id):
+            await send_text(
+                context.bot,
+                update.effective_chat.id,
+                "🚫 You don't have permission to use this command.",
+            )
+            return
+
+        search = None
+        if context.args:
+            search = " ".join(context.args).encode()[:BLOCKED_SEARCH_MAX_BYTES]
+            search = search.decode(errors="ignore").replace(":", "").strip() or None
+        text, keyboard = await render_blocked_page(context, 0, search)
+
+        await context.bot.send_chat_action(
+            chat_id=update.effective_chat.id, action=ChatAction.TYPING
+        )
+        await update.effective_chat.send_message(
+            text=text, parse_mode=ParseMode.HTML, reply_markup=keyboard
+        )
+    except Exception as exc:
+        logger.exception("Failed to handle /blocked: %s", exc)
+
+
+@instrument_handler
+async def handle_blocked_page_callback(
+    update: Update, context: ContextTypes.DEFAULT_TYPE
+):
+    """Handle Prev/Next presses under a /blocked listing."""
+    query = update.callback_query
+    try:
+        if not await is_group_admin(context, query.from_user.id):
+            await query.answer("Permission denied.", show_alert=True)
+            return
+        _, page, *search = query.data.split(":", 2)
+        await query.answer()
+        await show_blocked_page(query, context, int(page), search[0] if search else None)
+    except Exception as exc:
+        logger.exception("Failed to show blocked page: %s", exc)
+
+
+@instrument_handler
+async def unblock_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Admin-only: /unblock <user_id> to remove from blocklist."""
+    try:
+        requester = update.effective_user
+        if not await is_group_admin(context, requester.id):
+            await send_text(
+                context.bot,
+                update.effective_chat.id,
+                "🚫 You don't have permission to use this command.",
+            )
+            return
+
+        if not context.args:
+            await send_text(
+                context.bot,
+                update.effective_chat.id,
+                "Usage: /unblock <user_id>",
+            )
+            return
+
+        try:
+            user_id = int(context.args[0])
+        except ValueError:
+            await send_text(
+                context.bot,
+                update.effective_chat.id,
+                "User ID must be a number.",
+            )
+            return
+
+        removed = await remove_user_from_blocklist(context, user_id)
+        if removed:
+            await send_text(
+                context.bot,
+                update.effective_chat.id,
+                f"✅ User {user_id} has been unblocked.",
+            )
+        else:
+            await send_text(
+                context.bot,
+                update.effective_chat.id,
+                "User not found in blocklist.",
+            )
+    except Exception as exc:
+        logger.exception("Failed to handle /unblock: %s", exc)
+
+
+def history_snippet(row) -> str:
+    text = " ".join((row["text"] or "").split())
+    if len(text) > HISTORY_SNIPPET_LENGTH:
+        text = text[: HISTORY_SNIPPET_LENGTH - 1] + "…"
+    if row["kind"] != "text":
+        text = f"[{row['kind']}] {text}".rstrip()
+    return html.escape(text)
+
+
+async def render_history_page(
+    context: ContextTypes.DEFAULT_TYPE,
+    user_id: int,
+    page: int,
+    query: Optional[str] = None,
+) -> Tuple[str, Optional[InlineKeyboardMarkup]]:
+    """Text and keyboard for one page of a user's archive, newest first."""
+    bot_data = ensure_bot_data(context)
+    archive: Optional[ConversationArchive] = bot_data["archive"]
+    if archive is None:
+        return "ℹ️ The conversation archive is turned off.", None
+
+    label = blocked_user_label(bot_data["user_info"], user_id)
+    page = max(page, 0)
+    total, rows = await asyncio.to_thread(
+        archive.history, user_id, query, page * HISTORY_PAGE_SIZE, HISTORY_PAGE_SIZE
+    )
+    if not total:
+        if query:
+            return (
+                f"No archived messages of <code>{label}</code> match "
+                f"<code>{html.escape(query)}</code>.",
+                None,
+            )
+        return f"No archived messages of <code>{label}</code>.", None
+
+    pages = math.ceil(total / HISTORY_PAGE_SIZE)
+    if page >= pages:
+        page = pages - 1
+        total, rows = await asyncio.to_thread(
+            archive.history, user_id, query, page * HISTORY_PAGE_SIZE, HISTORY_PAGE_SIZE
+        )
+
+    title = f"🗂 <b>History of</b> <code>{label}</code> ({total})"
+    if query:
+        title += f" matching <code>{html.escape(query)}</code>"
+    lines = [f"{title}, page {page + 1}/{pages} (UTC):"]
+    for row in rows:
+        arrow = "📥" if row["direction"] == "in" else "📤"
+        sent = time.strftime("%Y-%m-%d %H:%M", time.gmtime(row["sent_at"]))
+        lines.append(f"{arrow} <i>{sent}</i> {history_snippet(row)}")
+
+    action = f"history:{user_id}"
+    navigation = []
+    if page > 0:
+        navigation.append(
+            InlineKeyboardButton(
+                "◀️ Newer", callback_data=blocked_page_data(action, page - 1, query)
+            )
+        )
+    if page < pages - 1:
+        navigation.append(
+            InlineKeyboardButton(
+                "Older ▶️", callback_data=blocked_page_data(action, page + 1, query)
+            )
+        )
+    keyboard = InlineKeyboardMarkup([navigation]) if navigation else None
+    return "\n".join(lines), keyboard
+
+
+@instrument_handler
+async def history_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Admin-only: /history <user_id> [words] pages through a user's archive."""
+    try:
+        requester = update.effective_user
+        if not await is_group_admin(context, requester.id):
+            await send_text(
+                context.bot,
+                update.effective_chat.id,
+                "🚫 You don't have permission to use this command.",
+            )
+            return
+
+        if not context.args:
+            await send_text(
+                context.bot,
+                update.effective_chat.id,
+                "Usage: /history <user_id> [search words]",
+            )
+            return
+
+        try:
+            user_id = int(context.args[0])
+        except ValueError:
+            await send_text(
+                context.bot,
+                update.effective_chat.id,
+                "User ID must be a number.",
+            )
+            return
+
+        query = None
+        if len(context.args) > 1:
+            query = " ".join(context.args[1:]).encode()[:HISTORY_QUERY_MAX_BYTES]
+            query = query.decode(errors="ignore").replace(":", "").strip() or None
+        text, keyboard = await render_history_page(context, user_id, 0, query)
+
+        await context.bot.send_chat_action(
+            chat_id=update.effective_chat.id, action=ChatAction.TYPING
+        )
+        await update.effective_chat.send_message(
+            text=text, parse_mode=ParseMode.HTML, reply_markup=keyboard
+        )
+    except Exception as exc:
+        logger.exception("Failed to handle /history: %s", exc)
+
+
+@instrument_handler
+async def handle_history_page_callback(
+    update: Update, context: ContextTypes.DEFAULT_TYPE
+):
+    """Handle Newer/Older presses under a /history listing."""
+    query = update.callback_query
+    try:
+        if not await is_group_admin(context, query.from_user.id):
+            await query.answer("Permission denied.", show_alert=True)
+            return
+        _, user_id, page, *search = query.data.split(":", 3)
+        await query.answer()
+        text, keyboard = await render_history_page(
+            context, int(user_id), int(page), search[0] if search else None
+        )
+        try:
+            await query.edit_message_text(
+                text=text, parse_mode=ParseMode.HTML, reply_markup=keyboard
+            )
+        except BadRequest as exc:
+            if "not modified" not in exc.message.lower():
+                raise
+    except Exception as exc:
+        logger.exception("Failed to show history page: %s", exc)
+
+
+def format_latency(seconds: float) -> str:
+    return f"{seconds * 1000:.0f} ms" if seconds < 10 else f"{seconds:.1f} s"
+
+
+@instrument_handler
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Admin-only: /stats shows handler latency, API calls and drop counters."""
+    try:
+        requester = update.effective_user
+        if not await is_group_admin(context, requester.id):
+            await send_text(
+                context.bot,
+                update.effective_chat.id,
+                "🚫 You don't have permission to use this command.",
+            )
+            return
+
+        metrics: Metrics = ensure_bot_data(context)["metrics"]
+        gauges = await metrics.gauges()
+        lines = [
+            "📊 <b>Bot stats</b>",
+            "",
+            f"Blocked users: {gauges.get('zapata_blocked_users', 0):g}",
+            f"Reply mappings: {gauges.get('zapata_info_message_map_size', 0):g}",
+            f"Known users: {gauges.get('zapata_user_info_size', 0):g}",
+            f"User topics: {gauges.get('zapata_user_topics', 0):g}",
+            f"Load: {LoadController.LEVELS[int(gauges.get('zapata_load_level', 0))]} "
+            f"({gauges.get('zapata_forwards_in_flight', 0):g} forwards in flight)",
+            f"Outbound queue: {gauges.get('zapata_outbound_queue_depth', 0):g}",
+            f"Flood-control retries: {gauges.get('zapata_outbound_retries_total', 0):g}",
+            "Chat actions skipped: "
+            f"{sum(v for _, v in metrics.counters('zapata_bot_api_skipped_total')):g}",
+            "",
+            "<b>Handlers</b> (runs · avg · p95 · API calls per run)",
+        ]
+        api_calls: Dict[str, float] = defaultdict(float)
+        for labels, value in metrics.counters("zapata_handler_api_calls_total"):
+            api_calls[labels["handler"]] += value
+        for labels, count, mean, p95 in metrics.summaries("zapata_handler_seconds"):
+            handler = labels["handler"]
+            lines.append(
+                f"• {handler}: {count} · {format_latency(mean)} · "
+                f"{format_latency(p95)} · {api_calls[handler] / count:.1f}"
+            )
+
+        errors: Dict[str, float] = defaultdict(float)
+        for labels, value in metrics.counters("zapata_bot_api_errors_total"):
+            errors[labels["method"]] += value
+        lines += ["", "<b>Bot API</b> (calls · avg · p95 · errors)"]
+        for labels, count, mean, p95 in metrics.summaries("zapata_bot_api_seconds")[:10]:
+            method = labels["method"]
+            lines.append(
+                f"• {method}: {count} · {format_latency(mean)} · "
+                f"{format_latency(p95)} · {errors.get(method, 0):g}"
+            )
+
+        lines += ["", "<b>Dropped messages</b>"]
+        for name, title, label in (
+            ("zapata_rate_limited_total", "Rate limited", "scope"),
+            ("zapata_blocked_drops_total", "Blocked", "direction"),
+            ("zapata_load_shed_total", "Load shedding", "step"),
+        ):
+            counts = ", ".join(
+                f"{labels[label]} {value:g}"
+                for labels, value in sorted(metrics.counters(name), key=str)
+            )
+            lines.append(f"• {title}: {counts or 0}")
+        duplicates = sum(value for _, value in metrics.counters("zapata_duplicates_total"))
+        lines.append(f"• Duplicates: {duplicates:g}")
+
+        lines += ["", "<b>Evictions</b> (capacity · expired)"]
+        evictions: Dict[str, Dict[str, float]] = defaultdict(dict)
+        for sample, value in gauges.items():
+            if not isinstance(sample, str) and sample[0] == "zapata_state_evictions_total":
+                labels = dict(sample[1])
+                evictions[labels["map"]][labels["reason"]] = value
+        for name, counts in evictions.items():
+            lines.append(
+                f"• {name}: {counts.get('capacity', 0):g} · {counts.get('expired', 0):g}"
+            )
+
+        await update.effective_chat.send_message(
+            text="\n".join(lines), parse_mode=ParseMode.HTML
+        )
+    except Exception as exc:
+        logger.exception("Failed to handle /stats: %s", exc)
+
+
+def format_duration(seconds: float) -> str:
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}h {seconds % 3600 // 60}m"
+    if seconds >= 60:
+        return f"{seconds // 60}m {seconds % 60}s"
+    return f"{seconds}s"
+
+
+class Broadcast:
+    """One announcement being fanned out to every known user.
+
+    Recipients are read in user id order, a page at a time, and processed
+    with bounded concurrency, so completions can arrive out of order;
+    ``cursor`` is the highest user id up to which every recipient is done,
+    and is what gets checkpointed. A resumed broadcast restarts after it,
+    so the few sends in flight at a crash (plus whatever finished since the
+    last state flush) may be repeated. ``total`` is the number of known
+    users when the broadcast started and only drives the progress report.
+    """
+
+    def __init__(
+        self,
+        broadcast_id: int,
+        payload: Dict[str, Any],
+        total: int,
+        chat_id: int,
+        status_message_id: Optional[int] = None,
+        cursor: int = 0,
+        sent: int = 0,
+        skipped: int = 0,
+        failed: int = 0,
+    ) -> None:
+        self.broadcast_id = broadcast_id
+        self.payload = payload
+        self.total = total
+        self.chat_id = chat_id
+        self.status_message_id = status_message_id
+        self.cursor = cursor
+        self.sent = sent
+        self.skipped = skipped
+        self.failed = failed
+        self._in_flight: Deque[int] = deque()
+        self._done: Set[int] = set()
+        self._resumed_at = self.processed
+        self._started = time.monotonic()
+
+    @classmethod
+    def from_row(cls, row: Tuple[Any, ...]) -> "Broadcast":
+        broadcast_id, payload, total, chat_id, status_message_id = row[:5]
+        progress = [value or 0 for value in row[5:]]
+        return cls(
+            broadcast_id,
+            json.loads(payload),
+            total,
+            chat_id,
+            status_message_id,
+            *progress,
+        )
+
+    @property
+    def processed(self) -> int:
+        return self.sent + self.skipped + self.failed
+
+    def save(self, journal: StateJournal, owner: str) -> None:
+        journal.put(
+            "broadcasts",
+            (
+                self.broadcast_id,
+                json.dumps(self.payload),
+                self.total,
+                self.chat_id,
+                self.status_message_id,
+                time.time(),
+                owner,
+            ),
+        )
+        self.checkpoint(journal)
+
+    def checkpoint(self, journal: StateJournal) -> None:
+        journal.put(
+            "broadcast_progress",
+            (self.broadcast_id, self.cursor, self.sent, self.skipped, self.failed),
+        )
+
+    def forget(self, journal: StateJournal) -> None:
+        journal.delete("broadcasts", self.broadcast_id)
+        journal.delete("broadcast_progress", self.broadcast_id)
+
+    def start(self, user_id: int) -> None:
+        self._in_flight.append(user_id)
+
+    def complete(self, user_id: int) -> None:
+        self._done.add(user_id)
+        while self._in_flight and self._in_flight[0] in self._done:
+            self.cursor = self._in_flight.popleft()
+            self._done.remove(self.cursor)
+
+    def status_text(self, finished: bool = False) -> str:
+        processed = self.processed
+        # Users who arrive mid-broadcast are included too
+        total = max(self.total, processed)
+        elapsed = max(time.monotonic() - self._started, 1e-6)
+        rate = (processed - self._resumed_at) / elapsed
+        lines = [
+            f"📣 <b>Broadcast #{self.broadcast_id}</b>"
+            + (" finished" if finished else ""),
+            f"Progress: {processed}/{total}",
+            f"Sent {self.sent} · skipped {self.skipped} · failed {self.failed}",
+        ]
+        if not finished:
+            eta = (total - processed) / rate if rate > 0 else None
+            lines.append(
+                f"Speed: {rate:.1f} msg/s · ETA "
+                + (format_duration(eta) if eta is not None else "unknown")
+            )
+        else:
+            lines.append(f"Took {format_duration(elapsed)} at {rate:.1f} msg/s")
+        return "\n".join(lines)
+
+
+async def known_user_ids(bot_data: Dict[str, Any], after: int, limit: int) -> List[int]:
+    """Known user ids greater than after, ascending, about limit at a time.
+
+    The store's user_info table has every user ever seen, where memory only
+    keeps the most recent (and, under "sqlite-shared", only this process's).
+    Users not flushed yet are merged in from memory.
+    """
+    stored = await asyncio.to_thread(bot_data["state_store"].user_ids, after, limit)
+    upper = stored[-1] if len(stored) == limit else None
+    recent = {
+        user_id
+        for user_id in bot_data["user_info"]
+        if user_id > after and (upper is None or user_id <= upper)
+    }
+    return sorted(recent.union(stored))
+
+
+async def count_known_users(bot_data: Dict[str, Any]) -> int:
+    stored = await asyncio.to_thread(bot_data["state_store"].count_users)
+    return max(stored, len(bot_data["user_info"]))
+
+
+async def deliver_broadcast(
+    bot, bot_data: Dict[str, Any], broadcast: Broadcast, user_id: int
+) -> None:
+    metrics: Metrics = bot_data["metrics"]
+    if user_id in bot_data["unreachable_users"] or await bot_data["state"].is_blocked(
+        user_id
+    ):
+        broadcast.skipped += 1
+        metrics.inc("zapata_broadcast_messages_total", result="skipped")
+        return
+    try:
+        await send_payload(
+            bot,
+            user_id,
+            broadcast.payload,
+            priority=PRIORITY_BROADCAST,
+            chat_action=False,
+        )
+    except (Forbidden, BadRequest) as exc:
+        # Blocked the bot, deactivated, or never started a chat with it
+        if isinstance(exc, BadRequest) and "chat not found" not in exc.message.lower():
+            raise
+        bot_data["unreachable_users"].add(user_id)
+        bot_data["state_journal"].put(
+            "unreachable_users", (user_id, exc.message, time.time())
+        )
+        broadcast.skipped += 1
+        metrics.inc("zapata_broadcast_messages_total", result="unreachable")
+    else:
+        broadcast.sent += 1
+        metrics.inc("zapata_broadcast_messages_total", result="sent")
+
+
+async def update_broadcast_status(
+    bot, broadcast: Broadcast, finished: bool = False
+) -> None:
+    try:
+        text = broadcast.status_text(finished)
+        if broadcast.status_message_id is None:
+            message = await bot.send_message(
+                chat_id=broadcast.chat_id, text=text, parse_mode=ParseMode.HTML
+            )
+            broadcast.status_message_id = message.message_id
+        else:
+            await bot.edit_message_text(
+                chat_id=broadcast.chat_id,
+                message_id=broadcast.status_message_id,
+                text=text,
+                parse_mode=ParseMode.HTML,
+            )
+    except Exception as exc:
+        logger.warning("Could not update broadcast status: %s", exc)
+
+
+async def run_broadcast(bot, bot_data: Dict[str, Any], broadcast: Broadcast) -> None:
+    """Fan a broadcast out from its checkpoint, reporting progress as it goes."""
+    journal: StateJournal = bot_data["state_journal"]
+    page: Deque[int] = deque()
+    page_lock = asyncio.Lock()
+    after = broadcast.cursor
+
+    async def next_recipient() -> Optional[int]:
+        nonlocal after
+        async with page_lock:
+            if not page:
+                page.extend(
+                    await known_user_ids(bot_data, after, BROADCAST_PAGE_SIZE)
+                )
+                if not page:
+                    return None
+                after = page[-1]
+            user_id = page.popleft()
+            broadcast.start(user_id)
+            return user_id
+
+    async def worker() -> None:
+        while (user_id := await next_recipient()) is not None:
+            try:
+                await deliver_broadcast(bot, bot_data, broadcast, user_id)
+            except Exception as exc:
+                broadcast.failed += 1
+                bot_data["metrics"].inc(
+                    "zapata_broadcast_messages_total", result="failed"
+                )
+                logger.warning(
+                    "Broadcast %d to %s failed: %s",
+                    broadcast.broadcast_id,
+                    user_id,
+                    exc,
+                )
+            broadcast.complete(user_id)
+            broadcast.checkpoint(journal)
+
+    async def report() -> None:
+        while True:
+            await asyncio.sleep(BROADCAST_PROGRESS_INTERVAL_SECONDS)
+            await update_broadcast_status(bot, broadcast)
+
+    await update_broadcast_status(bot, broadcast)
+    broadcast.save(journal, bot_data["state_owner"])
+    reporter = asyncio.create_task(report())
+    try:
+        await asyncio.gather(*(worker() for _ in range(BROADCAST_CONCURRENCY)))
+    finally:
+        reporter.cancel()
+    broadcast.forget(journal)
+    await update_broadcast_status(bot, broadcast, finished=True)
+    logger.info("%s", broadcast.status_text(finished=True).replace("\n", " | "))
+
+
+def start_broadcast(bot, bot_data: Dict[str, Any], broadcast: Broadcast) -> None:
+    broadcasts: Dict[int, asyncio.Task] = bot_data["broadcasts"]
+    task = asyncio.create_task(run_broadcast(bot, bot_data, broadcast))
+    broadcasts[broadcast.broadcast_id] = task
+
+    def finished(task: asyncio.Task) -> None:
+        broadcasts.pop(broadcast.broadcast_id, None)
+        if not task.cancelled() and task.exception():
+            logger.error(
+                "Broadcast %d crashed: %s", broadcast.broadcast_id, task.exception()
+            )
+
+    task.add_done_callback(finished)
+
+
+async def resume_orphaned_work(
+    bot, bot_data: Dict[str, Any], stale_before: float
+) -> None:
+    """Claim and resume the outbox jobs and broadcasts of stopped processes.
+
+    With a single process, pass stale_before=inf at startup to take over
+    everything left unfinished.
+    """
+    tables = [
+        table
+        for table, resume in (("outbox", OUTBOX_RESUME), ("broadcasts", BROADCAST_RESUME))
+        if resume
+    ]
+    claimed = await asyncio.to_thread(
+        bot_data["state_store"].claim, bot_data["state_owner"], stale_before, tables
+    )
+    if claimed.get("outbox"):
+        logger.info("Resuming %d outbox jobs", len(claimed["outbox"]))
+        bot_data["outbox"].load(claimed["outbox"])
+    for row in claimed.get("broadcasts", ()):
+        broadcast = Broadcast.from_row(row)
+        logger.info(
+            "Resuming broadcast %d after user %d (%d/%d)",
+            broadcast.broadcast_id,
+            broadcast.cursor,
+            broadcast.processed,
+            broadcast.total,
+        )
+        start_broadcast(bot, bot_data, broadcast)
+
+
+@instrument_handler
+async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Admin-only: reply to a message with /broadcast to send it to all users.
+
+    /broadcast cancel stops the running broadcast.
+    """
+    try:
+        chat_id = update.effective_chat.id
+        if not await is_group_admin(context, update.effective_user.id):
+            await send_text(
+                context.bot,
+                chat_id,
+                "🚫 You don't have permission to use this command.",
+            )
+            return
+
+        bot_data = ensure_bot_data(context)
+        running: Dict[int, asyncio.Task] = bot_data["broadcasts"]
+        if context.args and context.args[0].lower() == "cancel":
+            if not running:
+                await send_text(context.bot, chat_id, "No broadcast is running.")
+                return
+            for broadcast_id, task in list(running.items()):
+                task.cancel()
+                bot_data["state_journal"].delete("broadcasts", broadcast_id)
+                bot_data["state_journal"].delete("broadcast_progress", broadcast_id)
+            await send_text(context.bot, chat_id, "🛑 Broadcast cancelled.")
+            return
+
+        if running:
+            await send_text(
+                context.bot,
+                chat_id,
+                "⏳ A broadcast is already running. Use /broadcast cancel to stop it.",
+            )
+            return
+
+        source = update.effective_message.reply_to_message
+        if not source:
+            await send_text(
+                context.bot,
+                chat_id,
+                "Usage: reply to the message to announce with /broadcast",
+            )
+            return
+        payload = resolve_message_payload(source)
+        if not payload:
+            await send_text(
+                context.bot, chat_id, "⚠️ This message type can't be broadcast."
+            )
+            return
+
+        total = await count_known_users(bot_data)
+        if not total:
+            await send_text(context.bot, chat_id, "No known users to broadcast to.")
+            return
+        broadcast = Broadcast(int(time.time()), payload, total, chat_id)
+        start_broadcast(context.bot, bot_data, broadcast)
+    except Exception as exc:
+        logger.exception("Failed to handle /broadcast: %s", exc)
+
+
+OUTBOX_LISTING_SIZE = 10
+
+
+def render_outbox(outbox: Outbox) -> Tuple[str, Optional[InlineKeyboardMarkup]]:
+    dead = outbox.dead_letters()
+    lines = [
+        f"📮 <b>Outbox</b>: {outbox.pending()} pending, {len(dead)} dead letters",
+    ]
+    keyboard_rows = []
+    for job in dead[:OUTBOX_LISTING_SIZE]:
+        failed_at = time.strftime(
+            "%Y-%m-%d %H:%M", time.localtime(job["next_attempt_at"])
+        )
+        lines.append(
+            f"• <code>{html.escape(job['job_id'])}</code> ({job['kind']} for "
+            f"<code>{job['user_id']}</code>, {job['attempts']} attempts, {failed_at})\n"
+            f"  {html.escape(job['last_error'] or '')[:200]}"
+        )
+        keyboard_rows.append(
+            [
+                InlineKeyboardButton(
+                    "🔁 Retry", callback_data=f"outbox:retry:{job['job_id']}"
+                ),
+                InlineKeyboardButton(
+                    "🗑 Drop", callback_data=f"outbox:drop:{job['job_id']}"
+                ),
+            ]
+        )
+    if len(dead) > OUTBOX_LISTING_SIZE:
+        lines.append(f"… and {len(dead) - OUTBOX_LISTING_SIZE} more")
+    if dead:
+        keyboard_rows.append(
+            [InlineKeyboardButton("🔁 Retry all", callback_data="outbox:retry-all")]
+        )
+    keyboard = InlineKeyboardMarkup(keyboard_rows) if keyboard_rows else None
+    return "\n".join(lines), keyboard
+
+
+@instrument_handler
+async def outbox_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Admin-only: /outbox shows queued deliveries and the dead-letter list."""
+    try:
+        if not await is_group_admin(context, update.effective_user.id):
+            await send_text(
+                context.bot,
+                update.effective_chat.id,
+                "🚫 You don't have permission to use this command.",
+            )
+            return
+        text, keyboard = render_outbox(ensure_bot_data(context)["outbox"])
+        await update.effective_chat.send_message(
+            text=text, parse_mode=ParseMode.HTML, reply_markup=keyboard
+        )
+    except Exception as exc:
+        logger.exception("Failed to handle /outbox: %s", exc)
+
+
+@instrument_handler
+async def handle_outbox_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle Retry / Drop presses under an /outbox listing."""
+    query = update.callback_query
+    try:
+        if not await is_group_admin(context, query.from_user.id):
+            await query.answer("Permission denied.", show_alert=True)
+            return
+        outbox: Outbox = ensure_bot_data(context)["outbox"]
+        _, action, *job_id = query.data.split(":", 2)
+        if action == "retry-all":
+            await query.answer(f"🔁 Retrying {outbox.retry()} deliveries.")
+        elif action == "retry":
+            retried = outbox.retry(job_id[0])
+            await query.answer("🔁 Retrying." if retried else "Job not found.")
+        elif action == "drop":
+            dropped = outbox.drop(job_id[0])
+            await query.answer("🗑 Dropped." if dropped else "Job not found.")
+        text, keyboard = render_outbox(outbox)
+        try:
+            await query.edit_message_text(
+                text=text, parse_mode=ParseMode.HTML, reply_markup=keyboard
+            )
+        except BadRequest as exc:
+            if "not modified" not in exc.message.lower():
+                raise
+    except Exception as exc:
+        logger.exception("Failed to handle outbox action: %s", exc)
+
+
+HTTPRoute = Callable[[Dict[str, str], bytes], Awaitable[Tuple[int, str, bytes]]]
+
+
+class HTTPServer:
+    """Minimal HTTP/1.1 server with keep-alive, for the bot's own endpoints.
+
+    ``routes`` maps (method, path) to a coroutine function taking the
+    lower-cased request headers and the body, returning
+    (status, content type, body).
+    """
+
+    def __init__(
+        self, host: str, port: int, routes: Dict[Tuple[str, str], HTTPRoute]
+    ) -> None:
+        self.host = host
+        self.port = port
+        self.routes = routes
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(self._serve, self.host, self.port)
+        logger.info("HTTP server listening on %s:%d", self.host, self.port)
+
+    async def stop(self) -> None:
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _serve(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        try:
+            while True:
+                request_line = await asyncio.wait_for(
+                    reader.readline(), HTTP_IDLE_TIMEOUT_SECONDS
+                )
+                if not request_line:
+                    break
+                try:
+                    method, target, version = request_line.decode("latin-1").split()
+                except ValueError:
+                    await self._respond(writer, 400, b"", keep_alive=False)
+                    break
+
+                headers: Dict[str, str] = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                length = int(headers.get("content-length") or 0)
+                if length > HTTP_MAX_BODY_BYTES:
+                    await self._respond(writer, 413, b"", keep_alive=False)
+                    break
+                body = await reader.readexactly(length) if length else b""
+
+                route = self.routes.get((method, target.split("?", 1)[0]))
+                if route is None:
+                    status, content_type, payload = 404, "text/plain", b""
+                else:
+                    status, content_type, payload = await route(headers, body)
+
+                keep_alive = (
+                    version == "HTTP/1.1"
+                    and headers.get("connection", "").lower() != "close"
+                )
+                await self._respond(writer, status, payload, content_type, keep_alive)
+                if not keep_alive:
+                    break
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception as exc:
+            logger.exception("HTTP connection failed: %s", exc)
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def _respond(
+        writer: asyncio.StreamWriter,
+        status: int,
+        payload: bytes,
+        content_type: str = "text/plain",
+        keep_alive: bool = True,
+    ) -> None:
+        head = (
+            f"HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(payload)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+        )
+        writer.write(head.encode("latin-1") + payload)
+        await writer.drain()
+
+
+class WebhookIntake:
+    """Bounded queue between the webhook endpoint and the update processor.
+
+    At most UPDATE_MAX_PENDING updates are handed to the application's
+    update processor at once; beyond that the intake queue fills up and
+    the endpoint starts answering 429.
+    """
+
+    def __init__(self, application: Application) -> None:
+        self.application = application
+        self.queue: asyncio.Queue = asyncio.Queue(WEBHOOK_QUEUE_SIZE)
+        self.rejected = 0
+        self._in_flight = asyncio.Semaphore(UPDATE_MAX_PENDING)
+        self._consumer: Optional[asyncio.Task] = None
+
+    async def handle(
+        self, headers: Dict[str, str], body: bytes
+    ) -> Tuple[int, str, bytes]:
+        if WEBHOOK_SECRET_TOKEN and not hmac.compare_digest(
+            headers.get("x-telegram-bot-api-secret-token", ""), WEBHOOK_SECRET_TOKEN
+        ):
+            return 403, "text/plain", b""
+        try:
+            data = json.loads(body)
+        except ValueError:
+            return 400, "text/plain", b""
+        try:
+            self.queue.put_nowait(data)
+        except asyncio.QueueFull:
+            self.rejected += 1
+            return 429, "text/plain", b""
+        return 200, "text/plain", b""
+
+    def start(self) -> None:
+        self._consumer = asyncio.create_task(self._consume())
+
+    async def stop(self) -> None:
+        if self._consumer:
+            self._consumer.cancel()
+            try:
+                await self._consumer
+            except asyncio.CancelledError:
+                pass
+            self._consumer = None
+
+    async def _consume(self) -> None:
+        application = self.application
+        while True:
+            data = await self.queue.get()
+            try:
+                update = Update.de_json(data, application.bot)
+            except Exception as exc:
+                logger.warning("Dropping malformed update: %s", exc)
+                continue
+            await self._in_flight.acquire()
+            task = application.create_task(
+                application.update_processor.process_update(
+                    update, application.process_update(update)
+                ),
+                update=update,
+            )
+            task.add_done_callback(lambda _: self._in_flight.release())
+
+
+async def serve_webhook(application: Application) -> None:
+    """Run the application on the built-in webhook server until SIGINT/SIGTERM."""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass
+
+    intake = WebhookIntake(application)
+    server = HTTPServer(
+        WEBHOOK_LISTEN, WEBHOOK_PORT, {("POST", WEBHOOK_PATH): intake.handle}
+    )
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+    try:
+        intake.start()
+        await server.start()
+        if WEBHOOK_URL:
+            await application.bot.set_webhook(
+                url=WEBHOOK_URL,
+                secret_token=WEBHOOK_SECRET_TOKEN or None,
+                allowed_updates=Update.ALL_TYPES,
+            )
+        await stop.wait()
+    finally:
+        await server.stop()
+        await intake.stop()
+        await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+
+async def post_init(application: Application) -> None:
+    """Load persisted state in bulk and start the write-behind flusher."""
+    bot_data = provision_bot_data(application.bot_data)
+    store = await asyncio.to_thread(create_state_store)
+    state = await asyncio.to_thread(store.load)
+    bot_data["state_store"] = store
+    if ARCHIVE_DB_PATH:
+        bot_data["archive"] = await asyncio.to_thread(
+            ConversationArchive, ARCHIVE_DB_PATH
+        )
+    if STATE_BACKEND == "sqlite-shared":
+        bot_data["state"] = await asyncio.to_thread(SQLiteSharedState, STATE_DB_PATH)
+    else:
+        bot_data["blocked_users"] = state["blocked_users"]
+        bot_data["blocked_index"] = sorted(state["blocked_users"])
+        info_message_map: BoundedTTLMap = bot_data["info_message_map"]
+        for chat_id, message_id, user_id, created_at in state["info_message_map"]:
+            info_message_map.set((chat_id, message_id), user_id, timestamp=created_at)
+        for user_id, chat_id, thread_id in state["user_topics"]:
+            bot_data["user_topics"][user_id] = (chat_id, thread_id)
+            bot_data["topic_users"][(chat_id, thread_id)] = user_id
+        for user_id, chat_id in state["user_groups"]:
+            bot_data["user_groups"][user_id] = chat_id
+    user_info: BoundedTTLMap = bot_data["user_info"]
+    for user_id, username, full_name in state["user_info"]:
+        user_info[user_id] = {"username": username, "full_name": full_name}
+    bot_data["unreachable_users"] = state["unreachable_users"]
+    outbox: Outbox = bot_data["outbox"]
+    logger.info(
+        "Loaded state (%s): %d blocked users, %d reply mappings, %d known users",
+        STATE_BACKEND,
+        len(state["blocked_users"]),
+        len(state["info_message_map"]),
+        len(bot_data["user_info"]),
+    )
+    await seed_admin_cache(application)
+    outbox.start(application.bot)
+    shared = STATE_BACKEND == "sqlite-shared"
+    await resume_orphaned_work(
+        application.bot,
+        bot_data,
+        time.time() - STATE_OWNER_TIMEOUT_SECONDS if shared else float("inf"),
+    )
+    bot_data["state_flush_task"] = asyncio.create_task(
+        state_flush_loop(application.bot, bot_data)
+    )
+
+    metrics: Metrics = bot_data["metrics"]
+
+    async def collect_state() -> Dict[Sample, float]:
+        sizes = await bot_data["state"].stats()
+        values: Dict[Sample, float] = {
+            "zapata_blocked_users": sizes["blocked_users"],
+            "zapata_info_message_map_size": sizes["info_message_map"],
+            "zapata_user_info_size": len(bot_data["user_info"]),
+            "zapata_user_topics": sizes["user_topics"],
+            "zapata_outbox_pending": outbox.pending(),
+            "zapata_outbox_dead_letters": len(outbox) - outbox.pending(),
+        }
+        # Size-capped maps in bot_data (BoundedTTLMap, GCRALimiter)
+        for name, value in bot_data.items():
+            for reason, count in getattr(value, "evictions", {}).items():
+                labels = {"map": name, "reason": reason}
+                values[Metrics.key("zapata_state_evictions_total", labels)] = count
+        return values
+
+    metrics.add_collector(collect_state)
+    if METRICS_PORT:
+
+        async def metrics_endpoint(
+            headers: Dict[str, str], body: bytes
+        ) -> Tuple[int, str, bytes]:
+            text = await metrics.render()
+            return 200, "text/plain; version=0.0.4; charset=utf-8", text.encode()
+
+        server = HTTPServer(
+            METRICS_LISTEN, METRICS_PORT, {("GET", METRICS_PATH): metrics_endpoint}
+        )
+        try:
+            await server.start()
+        except OSError as exc:
+            # Metrics are optional; a taken port mustn't keep the bot down
+            logger.error("Metrics endpoint not started on port %s: %s", METRICS_PORT, exc)
+        else:
+            bot_data["metrics_server"] = server
+
+
+async def post_stop(application: Application) -> None:
+    """Forward albums and text bursts still being collected while the bot can send.
+
+    Outbox workers and running broadcasts are stopped; their state is
+    flushed on shutdown and they resume on the next start.
+    """
+    for name in ("text_batcher", "album_batcher"):
+        batcher = application.bot_data.get(name)
+        if batcher:
+            await batcher.flush_all()
+    outbox = application.bot_data.get("outbox")
+    if outbox:
+        await outbox.stop()
+    for task in list(application.bot_data.get("broadcasts", {}).values()):
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+
+async def post_shutdown(application: Application) -> None:
+    """Stop the flusher and write out whatever is still pending."""
+    bot_data = application.bot_data
+    server = bot_data.pop("metrics_server", None)
+    if server:
+        await server.stop()
+    task = bot_data.pop("state_flush_task", None)
+    if task:
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+    store = bot_data.get("state_store")
+    if store:
+        # Leave our unfinished work to the other processes
+        bot_data["state_journal"].delete("state_owners", bot_data["state_owner"])
+        await flush_state(bot_data)
+        store.close()
+    shared_state = bot_data.get("state")
+    if shared_state:
+        shared_state.close()
+    archive = bot_data.get("archive")
+    if archive:
+        await flush_archive(bot_data)
+        archive.close()
+    recorder = bot_data.get("capture")
+    if recorder:
+        recorder.close()
+
+
+def build_application(request: Optional[BaseRequest] = None) -> Application:
+    """Build the bot with all handlers; ``request`` replaces the HTTP layer."""
+    metrics = Metrics()
+    scheduler = OutboundScheduler()
+    tracer = APITracer()
+    if BOT_API_TRACE:
+        tracer.add_hook(log_api_call)
+    recorder = None
+    if CAPTURE_PATH:
+        recorder = TrafficRecorder(CAPTURE_PATH, CAPTURE_MAX_BYTES, CAPTURE_BACKUPS)
+    if recorder:
+        tracer.add_hook(recorder.record_call)
+    load = LoadController(scheduler)
+    stages: List[BotAPIStage] = [
+        LoadShedding(load, metrics),
+        UpdateAccounting(),
+        tracer,
+    ]
+    if CHAT_ACTION_COALESCE_SECONDS:
+        stages.insert(0, ChatActionCoalescer(metrics, CHAT_ACTION_COALESCE_SECONDS))
+    builder = (
+        ApplicationBuilder()
+        .token(TOKEN)
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+        .rate_limiter(BotAPIPipeline(scheduler, stages))
+        .request(
+            InstrumentedRequest(
+                request or HTTPXRequest(connection_pool_size=256), metrics
+            )
+        )
+    )
+    if request is not None:
+        builder = builder.get_updates_request(request)
+    # The capture needs the processor's hook even when updates run one by one
+    if CONCURRENT_UPDATES > 1 or recorder:
+        builder = builder.concurrent_updates(
+            OrderedUpdateProcessor(
+                CONCURRENT_UPDATES,
+                on_update=recorder.record_update if recorder else None,
+            )
+        )
+    application = builder.build()
+    application.bot_data["metrics"] = metrics
+    application.bot_data["api_tracer"] = tracer
+    application.bot_data["capture"] = recorder
+    application.bot_data["load"] = load
+
+    async def collect_outbound() -> Dict[str, float]:
+        return {
+            "zapata_outbound_queue_depth": scheduler.queue_depth,
+            "zapata_outbound_retries_total": scheduler.retries,
+            "zapata_load_level": load.level(),
+            "zapata_forwards_in_flight": load.in_flight,
+        }
+
+    metrics.add_collector(collect_outbound)
+
+    # Commands
+    application.add_handler(
+        CommandHandler("start", start, filters.ChatType.PRIVATE)
+    )
+    application.add_handler(CommandHandler("help", help_command))
+    application.add_handler(CommandHandler("blocked", blocked_command))
+    application.add_handler(CommandHandler("unblock", unblock_command))
+    application.add_handler(CommandHandler("history", history_command))
+    application.add_handler(CommandHandler("stats", stats_command))
+    application.add_handler(CommandHandler("broadcast", broadcast_command))
+    application.add_handler(CommandHandler("outbox", outbox_command))
+
+    # Messages
+    application.add_handler(
+        MessageHandler(
+            filters.ChatType.PRIVATE & ~filters.COMMAND,
+            handle_private_message,
+        )
+    )
+    group_messages = filters.REPLY
+    if THREADING_MODE == "topics":
+        # Topic service messages (created, closed, renamed...) aren't replies
+        group_messages = (
+            filters.REPLY | filters.IS_TOPIC_MESSAGE
+        ) & ~filters.StatusUpdate.ALL
+    application.add_handler(
+        MessageHandler(filters.ChatType.GROUPS & group_messages, handle_group_reply)
+    )
+
+    # Callbacks
+    application.add_handler(
+        CallbackQueryHandler(handle_block_callback, pattern=r"^block:")
+    )
+    application.add_handler(
+        CallbackQueryHandler(handle_unblock_callback, pattern=r"^unblock:")
+    )
+    application.add_handler(
+        CallbackQueryHandler(handle_blocked_page_callback, pattern=r"^blocked:")
+    )
+    application.add_handler(
+        CallbackQueryHandler(handle_history_page_callback, pattern=r"^history:")
+    )
+    application.add_handler(
+        CallbackQueryHandler(handle_outbox_callback, pattern=r"^outbox:")
+    )
+
+    # Membership changes (only delivered when explicitly requested below)
+    application.add_handler(
+        ChatMemberHandler(track_admin_membership, ChatMemberHandler.CHAT_MEMBER)
+    )
+    return application
+
+
+def export_archive(output: str, user_id: Optional[int] = None) -> int:
+    """Stream the archive to ``output`` ("-" for stdout) as JSON Lines."""
+    archive = ConversationArchive(ARCHIVE_DB_PATH)
+    try:
+        if output == "-":
+            return archive.export_jsonl(sys.stdout, user_id)
+        with open(output, "w", encoding="utf-8") as stream:
+            return archive.export_jsonl(stream, user_id)
+    finally:
+        archive.close()
+
+
+def main(argv: Optional[Sequence[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Zapata support bot.")
+    commands = parser.add_subparsers(dest="command")
+    export = commands.add_parser(
+        "export", help="write the conversation archive as JSON Lines and exit"
+    )
+    export.add_argument(
+        "output", nargs="?", default="-", help="file to write (default: stdout)"
+    )
+    export.add_argument("--user", type=int, help="only this user's messages")
+    args = parser.parse_args(argv)
+    if args.command == "export":
+        if not ARCHIVE_DB_PATH:
+            parser.error("ARCHIVE_DB_PATH is empty, there is no archive to export")
+        count = export_archive(args.output, args.user)
+        print(f"Exported {count} messages", file=sys.stderr)
+        return
+
+    logging.basicConfig(
+        format="%(asctime)s %(levelname)s %(name)s %(message)s",
+        level=logging.INFO,
+    )
+    application = build_application()
+
+    if RUN_MODE == "webhook":
+        asyncio.run(serve_webhook(application))
+    else:
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
+
+
+if __name__ == "__main__":
+    main()